@@ -0,0 +1,6 @@
+"""Local benchmark harness for the migration scripts.
+
+Run from the project root (migration-scripts):
+
+    python -m benchmarks.run --rows 10000 --output bench_results.json
+"""
@@ -0,0 +1,135 @@
+"""Synthetic input generators for the benchmark harness.
+
+All generators are deterministic for a given seed so that two benchmark runs
+on different releases see exactly the same input.
+"""
+import csv
+import hashlib
+import os
+import random
+
+ENROLMENT_HEADER = ['email', 'Groupe', 'Codes', 'cours complétés le']
+COURSE_BATCH_HEADER = ['Course Code', 'Course ID', 'Learning Profile', 'Batch Name', 'Batch ID', 'Start Date']
+FRAMEWORK_HEADER = [
+    'Domain_Code', 'Domain_Description', 'Competency_Code', 'Competency_Description',
+    'Sub-competency_Code', 'Sub-competency_Description', 'Code observable element', 'Observable elements',
+]
+
+
+def fake_numeric_id(value: str, digits: int = 19) -> str:
+    """Stable numeric identifier derived from value (same shape as Sunbird batch ids)."""
+    return str(int(hashlib.md5(value.encode('utf-8')).hexdigest(), 16))[:digits].rjust(digits, '0')
+
+
+def fake_do_id(value: str) -> str:
+    return f"do_{fake_numeric_id(value, 23)}"
+
+
+def course_code(i: int) -> str:
+    return f"FMPS_C{i:03d}"
+
+
+def learner_profile(i: int) -> str:
+    return f"FC{2020 + i}"
+
+
+def _ensure_dir(path: str):
+    dir_name = os.path.dirname(path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+
+def _random_date(rng: random.Random) -> str:
+    day, month, year = rng.randint(1, 28), rng.randint(1, 12), rng.choice((2023, 2024, 2025))
+    style = rng.random()
+    if style < 0.6:
+        return f"{day}/{month}/{year}"
+    if style < 0.8:
+        return f"{day:02d}/{month:02d}/{year}"
+    return f"{year}-{month:02d}-{day:02d}"
+
+
+def generate_enrolment_input(path: str, rows: int, courses: int = 50, profiles: int = 6,
+                             max_codes: int = 3, duplicate_rate: float = 0.05, seed: int = 42) -> int:
+    """Write a user_enrolments_input.csv with `rows` rows. Returns the row count."""
+    rng = random.Random(seed)
+    _ensure_dir(path)
+    user_pool = max(1, int(rows * (1 - duplicate_rate)))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(ENROLMENT_HEADER)
+        for i in range(rows):
+            user = i if i < user_pool else rng.randrange(user_pool)
+            picked = rng.sample(range(courses), rng.randint(1, min(max_codes, courses)))
+            writer.writerow([
+                f"learner{user}@example.org",
+                learner_profile(rng.randrange(profiles)),
+                ', '.join(course_code(c) for c in picked),
+                ', '.join(_random_date(rng) for _ in picked),
+            ])
+    return rows
+
+
+def generate_enrolment_delta(previous_path: str, path: str, new_rate: float = 0.02, changed_rate: float = 0.01,
+                             courses: int = 50, profiles: int = 6, seed: int = 43) -> int:
+    """
+    Write the "next week's export" of `previous_path`: the same rows, a `changed_rate` share with
+    a different completion date, plus `new_rate` new learners. Returns the row count.
+    """
+    rng = random.Random(seed)
+    _ensure_dir(path)
+    with open(previous_path, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    header, body = rows[0], rows[1:]
+    for row in body:
+        if rng.random() < changed_rate:
+            row[3] = ', '.join(_random_date(rng) for _ in row[2].split(','))
+    for i in range(int(len(body) * new_rate)):
+        picked = rng.sample(range(courses), rng.randint(1, min(3, courses)))
+        body.append([
+            f"newlearner{i}@example.org",
+            learner_profile(rng.randrange(profiles)),
+            ', '.join(course_code(c) for c in picked),
+            ', '.join(_random_date(rng) for _ in picked),
+        ])
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(body)
+    return len(body)
+
+
+def generate_course_batch_input(path: str, rows: int, courses: int = 50, profiles: int = 6, seed: int = 42) -> int:
+    """Write a course_batch_input.csv with `rows` distinct (course, batch) rows."""
+    rng = random.Random(seed)
+    _ensure_dir(path)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(COURSE_BATCH_HEADER)
+        for i in range(rows):
+            code = course_code(i % courses)
+            profile = learner_profile((i // courses) % profiles)
+            batch_name = f"{code}_{profile}" if i < courses * profiles else f"{code}_{profile}_{i}"
+            start = f"{rng.choice((2022, 2023))}/{rng.randint(1, 12):02d}/01"
+            writer.writerow([code, fake_do_id(code), profile, batch_name, fake_numeric_id(batch_name), start])
+    return rows
+
+
+def generate_framework_csv(path: str, rows: int, domains: int = 4, observables_per_subskill: int = 4,
+                           subskills_per_skill: int = 4) -> int:
+    """Write a fw-c-t.csv with `rows` observable elements spread over `domains` frameworks."""
+    _ensure_dir(path)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(FRAMEWORK_HEADER)
+        for i in range(rows):
+            subskill = i // observables_per_subskill
+            skill = subskill // subskills_per_skill
+            domain = skill % domains + 1
+            writer.writerow([
+                f"DC{domain}", f"Domain {domain}",
+                f"DC{domain}C{skill}", f"Skill {skill}",
+                f"DC{domain}C{skill}S{subskill}", f"Sub skill {subskill}",
+                f"DC{domain}C{skill}S{subskill}O{i}", f"Observable element {i}",
+            ])
+    return rows
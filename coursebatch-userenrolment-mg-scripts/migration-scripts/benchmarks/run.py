@@ -0,0 +1,530 @@
+# NOTE: Run this module from the project root (migration-scripts): python -m benchmarks.run
+"""Benchmark every migration pipeline stage against local stand-ins.
+
+Generates synthetic inputs, starts the stub Sunbird/ES server, then runs each
+stage in a fresh process (so peak RSS is per stage) and writes a JSON baseline
+with rows/sec, CPU time, p50/p99 per-operation latency and peak RSS.
+"""
+import argparse
+import csv
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import get_context
+
+import yaml
+
+from benchmarks import datagen
+from benchmarks.stubs import RECORDER, InMemoryCassandraCluster, StubServer, StubSettings, install_backend_stubs, instrument_http
+from common import logging_setup
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FRAMEWORK_DIR = os.path.join(PROJECT_ROOT, '..', '..', 'framework-creation-script')
+
+
+def _load_script(relpath: str, name: str, base: str = PROJECT_ROOT):
+    path = os.path.abspath(os.path.join(base, relpath))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- Stage definitions ------------------------------------------------------------
+
+def _enrolments_prepare_rows(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    process_csv.prepare_rows(process_csv.parse_csv(ctx['enrolment_input']))
+
+
+def _enrolments_prepare_columnar(ctx):
+    from common import columnar
+    columnar.prepare_enrolments(ctx['enrolment_input'])
+
+
+def _enrolments_prepare_parallel(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    process_csv.prepare_input(ctx['enrolment_input'], 'parallel', ctx['config'].get('ingest_workers'))
+
+
+def _enrolments_generate(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    process_csv.process(ctx['enrolment_input'], ctx['enrolment_output'], ctx['config'])
+
+
+def _enrolments_generate_delta(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    if not os.path.exists(ctx['enrolment_output']):
+        raise RuntimeError("user_enrolments.generate_delta needs the output of user_enrolments.generate")
+    previous = process_csv.load_previous_from_csvs(ctx['enrolment_input'], ctx['enrolment_output'])
+    process_csv.process(ctx['enrolment_delta_input'], ctx['enrolment_next_output'], ctx['config'],
+                        previous=previous, delta_csv=ctx['enrolment_delta_output'])
+
+
+def _enrolments_plan(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    process_csv.write_plan(ctx['enrolment_plan'], process_csv.plan_writes(process_csv.parse_output_csv(ctx['enrolment_output'])))
+
+
+def _enrolments_export(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    process_csv.export_bulk_load(process_csv.parse_output_csv(ctx['enrolment_output']), ctx['config'],
+                                 os.path.join(ctx['workdir'], 'export'))
+
+
+def _enrolments_update(ctx, dry_run=False):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    rows = process_csv.parse_output_csv(ctx['enrolment_output'])
+    process_csv.update_cassandra(rows, ctx['config'], dry_run)
+
+
+def _enrolments_update_dry_run(ctx):
+    _enrolments_update(ctx, dry_run=True)
+
+
+def _course_batch_update(ctx):
+    batches = _load_script('course_batch_update/process_course_batches.py', 'process_course_batches')
+    rows = batches.parse_csv(ctx['course_batch_input'])
+    batches.update_batches_via_api(rows, ctx['config'], False)
+
+
+def _course_batch_update_rerun(ctx):
+    # After course_batch.update: every batch is read back as already updated and no step is repeated
+    _course_batch_update(ctx)
+
+
+def _enrolments_verify(ctx):
+    process_csv = _load_script('user_enrolments_update/process_csv.py', 'process_csv')
+    rows = process_csv.parse_output_csv(ctx['enrolment_output'])
+    # What a completed update leaves in Cassandra
+    for row in process_csv.plan_writes(rows):
+        InMemoryCassandraCluster.seed('user_enrolments', (row['userId'],), courseid=row['courseId'], batchid=row['batchId'],
+                                      completedon=row['completedOn'], issued_certificates=None)
+    process_csv.verify_cassandra(rows, ctx['config'], os.path.join(ctx['workdir'], 'user_enrolments_verify.csv'))
+
+
+def _course_batch_verify(ctx):
+    batches = _load_script('course_batch_update/process_course_batches.py', 'process_course_batches')
+    rows = batches.parse_csv(ctx['course_batch_input'])
+    for row in rows:
+        InMemoryCassandraCluster.seed('course_batch', (row['courseId'],), batchid=row['batchId'], start_date=row['start_date'])
+    batches.verify_start_dates(rows, ctx['config'], os.path.join(ctx['workdir'], 'course_batch_verify.csv'))
+
+
+def _post_update_delete_es(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    ops.delete_from_elasticsearch_for_csv(ctx['enrolment_output'], ctx['config']['es_host'])
+
+
+def _post_update_reconcile_es(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    ops.reconcile_elasticsearch_for_csv(ctx['enrolment_output'], ctx['config']['es_host'],
+                                        os.path.join(ctx['workdir'], 'es_reconcile_report.csv'))
+
+
+def _post_update_generate_events(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    ops.generate_events_from_csv(ctx['enrolment_output'], ctx['event_template'], ctx['events_file'])
+
+
+def _fresh_ledger(ctx, name: str) -> str:
+    """Per-stage sent-events ledger, emptied so every push stage sends the whole file."""
+    path = os.path.join(ctx['workdir'], f"{name}.acked")
+    if os.path.exists(path):
+        os.remove(path)
+    return path
+
+
+def _post_update_push_kafka(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    config = ctx['config']
+    ops.push_events_to_kafka(ctx['events_file'], config['kafka_host'], config['kafka_topic'],
+                             batch_size=config.get('kafka_batch_size', 100), ledger_path=_fresh_ledger(ctx, 'push_kafka'))
+
+
+def _post_update_push_kafka_parallel(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    config = ctx['config']
+    ops.push_events_to_kafka(ctx['events_file'], config['kafka_host'], config['kafka_topic'],
+                             batch_size=config.get('kafka_batch_size', 100), key_field='userId', producers=4,
+                             ledger_path=_fresh_ledger(ctx, 'push_kafka_parallel'))
+
+
+def _post_update_generate_events_sharded(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    ops.generate_events_from_csv(ctx['enrolment_output'], ctx['event_template'], ctx['events_sharded'], shards=4, compression='gzip')
+
+
+def _post_update_push_kafka_sharded(ctx):
+    ops = _load_script('user_enrolments_update/post_update_ops.py', 'post_update_ops')
+    config = ctx['config']
+    manifest_path = ctx['events_sharded'] + ops.MANIFEST_SUFFIX
+    # Push every shard again, not just the ones a previous run left pending
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    for shard in manifest['shards']:
+        shard['status'] = 'pending'
+    ops.write_manifest(manifest_path, manifest)
+    ops.push_events_to_kafka(manifest_path, config['kafka_host'], config['kafka_topic'], key_field='userId', producers=4,
+                             ledger_path=_fresh_ledger(ctx, 'push_kafka_sharded'))
+
+
+def _pipeline_full(ctx):
+    # Every enrolment and post-update stage plus the course batches, streaming in one process
+    pipeline = _load_script('pipeline.py', 'pipeline')
+    config = dict(ctx['config'], kafka_ledger=_fresh_ledger(ctx, 'pipeline'))
+    paths = {
+        'course_batch_input': ctx['course_batch_input'],
+        'input': ctx['enrolment_input'],
+        'output': os.path.join(ctx['workdir'], 'pipeline_output.csv'),
+        'event_template': ctx['event_template'],
+        'events_output': os.path.join(ctx['workdir'], 'pipeline_events.jsonl'),
+    }
+    results = pipeline.build_pipeline(config, paths, dry_run=False).run()
+    failed = [name for name, result in results.items() if result['status'] != 'ok']
+    if failed:
+        raise RuntimeError(f"pipeline stages did not complete: {failed}")
+
+
+def _framework_step(step):
+    def run(ctx):
+        os.chdir(ctx['framework_workdir'])
+        fw = _load_script('create_frameworks.py', 'create_frameworks', base=ctx['framework_dir'])
+        if step == 'setup':
+            fw.create_frameworks(False)
+            fw.create_master_and_categories(False)
+        elif step == 'terms':
+            fw.create_terms(False)
+        elif step == 'terms_batched':
+            fw.create_terms_batched(False, 100)
+        elif step == 'associations':
+            fw.update_associations(False)
+        elif step == 'publish':
+            fw.publish_frameworks(False)
+        elif step == 'sync':
+            # Starts from the stub's current state: a no-op diff after the other framework stages
+            if os.path.exists('sync_journal.ndjson'):
+                os.remove('sync_journal.ndjson')
+            fw.sync_frameworks(False, 100)
+    return run
+
+
+# name -> (context key of the input whose rows are counted, stage function)
+STAGES = OrderedDict([
+    ('user_enrolments.prepare_rows', ('enrolment_input', _enrolments_prepare_rows)),
+    ('user_enrolments.prepare_columnar', ('enrolment_input', _enrolments_prepare_columnar)),
+    ('user_enrolments.prepare_parallel', ('enrolment_input', _enrolments_prepare_parallel)),
+    ('user_enrolments.generate', ('enrolment_input', _enrolments_generate)),
+    ('user_enrolments.generate_delta', ('enrolment_delta_input', _enrolments_generate_delta)),
+    ('user_enrolments.plan', ('enrolment_output', _enrolments_plan)),
+    ('user_enrolments.export', ('enrolment_output', _enrolments_export)),
+    ('user_enrolments.update_dry_run', ('enrolment_output', _enrolments_update_dry_run)),
+    ('user_enrolments.update', ('enrolment_output', _enrolments_update)),
+    ('user_enrolments.verify', ('enrolment_output', _enrolments_verify)),
+    ('course_batch.update', ('course_batch_input', _course_batch_update)),
+    ('course_batch.update_rerun', ('course_batch_input', _course_batch_update_rerun)),
+    ('course_batch.verify', ('course_batch_input', _course_batch_verify)),
+    ('post_update.delete_es', ('enrolment_output', _post_update_delete_es)),
+    ('post_update.reconcile_es', ('enrolment_output', _post_update_reconcile_es)),
+    ('post_update.generate_events', ('enrolment_output', _post_update_generate_events)),
+    ('post_update.push_kafka', ('events_file', _post_update_push_kafka)),
+    ('post_update.push_kafka_parallel', ('events_file', _post_update_push_kafka_parallel)),
+    ('post_update.generate_events_sharded', ('enrolment_output', _post_update_generate_events_sharded)),
+    ('post_update.push_kafka_sharded', ('events_file', _post_update_push_kafka_sharded)),
+    ('pipeline.full', ('enrolment_input', _pipeline_full)),
+    ('frameworks.setup', ('framework_csv', _framework_step('setup'))),
+    ('frameworks.terms', ('framework_csv', _framework_step('terms'))),
+    ('frameworks.terms_batched', ('framework_csv', _framework_step('terms_batched'))),
+    ('frameworks.associations', ('framework_csv', _framework_step('associations'))),
+    ('frameworks.publish', ('framework_csv', _framework_step('publish'))),
+    ('frameworks.sync', ('framework_csv', _framework_step('sync'))),
+])
+
+
+# --- Measurement ------------------------------------------------------------------
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def count_rows(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            return max(0, sum(1 for _ in csv.reader(f)) - 1)
+        return sum(1 for line in f if line.strip())
+
+
+def run_stage(name: str, ctx: dict) -> dict:
+    """Entry point of the per-stage child process."""
+    log_fd = os.open(os.path.join(ctx['workdir'], 'logs', f"{name}.log"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    install_backend_stubs(ctx['cassandra_latency_ms'], ctx['kafka_latency_ms'])
+    instrument_http()
+    logging_setup.setup_logging(os.path.join(ctx['workdir'], 'logs', f"{name}.jsonl"), ctx['config'])
+    input_key, fn = STAGES[name]
+    rows = count_rows(ctx[input_key])
+    result = {'rows': rows}
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        fn(ctx)
+    except BaseException as e:  # scripts call sys.exit() on fatal errors
+        result['error'] = f"{type(e).__name__}: {e}"
+    # Draining the log queue is part of the stage's cost
+    logging_setup.stop_logging()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    samples = RECORDER.samples
+    result.update({
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        'rows_per_sec': round(rows / wall, 2) if wall > 0 else 0.0,
+        'ops': len(samples),
+        'latency_ms': {
+            'p50': round(percentile(samples, 50) * 1000, 3),
+            'p99': round(percentile(samples, 99) * 1000, 3),
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 2),
+    })
+    return result
+
+
+def _stage_process(name: str, ctx: dict, conn):
+    conn.send(run_stage(name, ctx))
+    conn.close()
+
+
+def run_stage_isolated(name: str, ctx: dict) -> dict:
+    """Run a stage in a fresh (non-daemon, so it may start its own workers) spawned process."""
+    mp = get_context('spawn')
+    receiver, sender = mp.Pipe(duplex=False)
+    process = mp.Process(target=_stage_process, args=(name, ctx, sender), name=name)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = {'rows': 0, 'rows_per_sec': 0.0, 'latency_ms': {'p50': 0.0, 'p99': 0.0}, 'peak_rss_mb': 0.0,
+                  'error': f"stage process exited with code {process.exitcode}"}
+    return result
+
+
+# --- Cold start -------------------------------------------------------------------
+
+BACKEND_MODULES = ('yaml', 'requests', 'kafka', 'cassandra', 'pyarrow')
+
+
+def parse_importtime(stderr: str) -> list:
+    """(module, cumulative ms, nesting depth) for each line of `python -X importtime` output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), int(cumulative) / 1000.0, depth))
+    return imports
+
+
+def measure_cold_start(argv: list, runs: int) -> dict:
+    """Best of `runs` cold starts of `python -X importtime <argv> --help` (imports and argument parsing only)."""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv + ['--help'], cwd=PROJECT_ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        wall_ms = (time.perf_counter() - start) * 1000
+        top_level = [(name, ms) for name, ms, depth in parse_importtime(proc.stderr) if depth == 0]
+        result = {
+            'wall_ms': round(wall_ms, 1),
+            'import_ms': round(sum(ms for _, ms in top_level), 1),
+            'top_imports': [[name, round(ms, 1)] for name, ms in sorted(top_level, key=lambda item: -item[1])[:5]],
+            'backends': sorted({name.split('.')[0] for name, _, _ in parse_importtime(proc.stderr)} & set(BACKEND_MODULES)),
+        }
+        if proc.returncode != 0:
+            result['error'] = f"exit code {proc.returncode}"
+        if best is None or result['import_ms'] < best['import_ms']:
+            best = result
+    return best
+
+
+def cold_start_report(runs: int) -> dict:
+    migrate = _load_script('migrate.py', 'migrate')
+    return OrderedDict((command, measure_cold_start(['migrate.py', command], runs)) for command in migrate.COMMANDS)
+
+
+# --- Setup and reporting ----------------------------------------------------------
+
+def build_context(args, workdir: str, server_url: str) -> dict:
+    with open(os.path.join(PROJECT_ROOT, 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update({
+        'host': server_url,
+        'apikey': 'bench',
+        'access_token': 'bench',
+        'creator_access_token': 'bench',
+        'channel_id': 'bench',
+        'es_host': server_url,
+        'kafka_host': 'localhost:9092',
+        'cassandra_batch_sleep': 0,
+        'dry_run_plan': os.path.join(workdir, 'dry_run_plan.ndjson.gz'),
+    })
+    config['cassandra']['connection_url'] = 'localhost:9042'
+    if args.ingest_workers:
+        config['ingest_workers'] = args.ingest_workers
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+    framework_workdir = os.path.join(workdir, 'framework')
+    os.makedirs(framework_workdir, exist_ok=True)
+    with open(os.path.join(framework_workdir, 'config.json'), 'w') as f:
+        json.dump({'host': server_url, 'apikey': 'bench', 'channel_id': 'bench'}, f)
+    return {
+        'workdir': workdir,
+        'config': config,
+        'config_path': os.path.join(workdir, 'config.yaml'),
+        'enrolment_input': os.path.join(workdir, 'user_enrolments_input.csv'),
+        'enrolment_output': os.path.join(workdir, 'user_enrolments_output.csv'),
+        'enrolment_plan': os.path.join(workdir, 'user_enrolments_plan.csv'),
+        'enrolment_delta_input': os.path.join(workdir, 'user_enrolments_input_next.csv'),
+        'enrolment_next_output': os.path.join(workdir, 'user_enrolments_output_next.csv'),
+        'enrolment_delta_output': os.path.join(workdir, 'user_enrolments_output_next_delta.csv'),
+        'course_batch_input': os.path.join(workdir, 'course_batch_input.csv'),
+        'event_template': os.path.join(PROJECT_ROOT, 'user_enrolments_update', 'event_template.json'),
+        'events_file': os.path.join(workdir, 'events_to_push.jsonl'),
+        'events_sharded': os.path.join(workdir, 'events_sharded.jsonl'),
+        'framework_dir': os.path.abspath(args.framework_dir),
+        'framework_workdir': framework_workdir,
+        'framework_csv': os.path.join(framework_workdir, 'fw-c-t.csv'),
+        'cassandra_latency_ms': args.cassandra_latency_ms,
+        'kafka_latency_ms': args.kafka_latency_ms,
+    }
+
+
+def generate_inputs(args, ctx: dict):
+    datagen.generate_enrolment_input(ctx['enrolment_input'], args.rows, courses=args.courses,
+                                     duplicate_rate=args.duplicate_rate, seed=args.seed)
+    datagen.generate_enrolment_delta(ctx['enrolment_input'], ctx['enrolment_delta_input'],
+                                     courses=args.courses, seed=args.seed + 1)
+    datagen.generate_course_batch_input(ctx['course_batch_input'], args.course_batch_rows,
+                                        courses=args.courses, seed=args.seed)
+    datagen.generate_framework_csv(ctx['framework_csv'], args.framework_rows)
+
+
+def compare(current: dict, baseline: dict):
+    print(f"\n{'stage':34} {'rows/s':>12} {'base rows/s':>12} {'change':>8} {'rss MB':>8} {'base MB':>8}")
+    for name, stage in current['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base:
+            print(f"{name:34} {stage.get('rows_per_sec', 0):>12} {'-':>12}")
+            continue
+        before, after = base.get('rows_per_sec') or 0, stage.get('rows_per_sec') or 0
+        change = f"{(after / before - 1) * 100:+.1f}%" if before else '-'
+        print(f"{name:34} {after:>12} {before:>12} {change:>8} {stage.get('peak_rss_mb', 0):>8} {base.get('peak_rss_mb', 0):>8}")
+    if current.get('cold_start') and baseline.get('cold_start'):
+        print(f"\n{'cold start':34} {'import ms':>12} {'base ms':>12} {'change':>8}")
+        for command, start in current['cold_start'].items():
+            base = baseline['cold_start'].get(command)
+            if not base:
+                continue
+            before, after = base.get('import_ms') or 0, start.get('import_ms') or 0
+            change = f"{(after / before - 1) * 100:+.1f}%" if before else '-'
+            print(f"{'migrate ' + command:34} {after:>12} {before:>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the migration pipeline stages against local stand-ins. Run from the project root.')
+    parser.add_argument('--rows', type=int, default=2000, help='Rows in the synthetic enrolment input')
+    parser.add_argument('--course-batch-rows', type=int, default=500, help='Rows in the synthetic course batch input')
+    parser.add_argument('--framework-rows', type=int, default=500, help='Rows (observable elements) in the synthetic fw-c-t.csv')
+    parser.add_argument('--courses', type=int, default=50, help='Distinct course codes in the synthetic inputs')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='Fraction of enrolment rows reusing an earlier email')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Added latency per stub HTTP request')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra latency (0..jitter) per stub HTTP request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of stub HTTP requests answered with HTTP 500')
+    parser.add_argument('--cassandra-latency-ms', type=float, default=0.0, help='Latency per in-memory Cassandra statement')
+    parser.add_argument('--kafka-latency-ms', type=float, default=0.0, help='Latency per in-memory Kafka send')
+    parser.add_argument('--ingest-workers', type=int, help='Processes for user_enrolments.prepare_parallel (default: one per available CPU)')
+    parser.add_argument('--stages', default='all', help=f"Comma separated stages to run (default: all). Available: {', '.join(STAGES)}")
+    parser.add_argument('--framework-dir', default=DEFAULT_FRAMEWORK_DIR, help='Path to framework-creation-script')
+    parser.add_argument('--workdir', help='Directory for generated inputs, outputs and logs (default: a temp dir)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', help='Previous JSON results to compare against')
+    parser.add_argument('--cold-start-runs', type=int, default=3, help='Cold starts measured per migrate command with -X importtime (best is reported; 0 to skip)')
+    args = parser.parse_args()
+
+    stages = list(STAGES) if args.stages == 'all' else [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"Unknown stages: {unknown}")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='migration-bench-'))
+    os.makedirs(os.path.join(workdir, 'logs'), exist_ok=True)
+    server = StubServer(StubSettings(args.latency_ms, args.jitter_ms, args.error_rate, args.seed)).start()
+    ctx = build_context(args, workdir, server.url)
+    generate_inputs(args, ctx)
+    print(f"Benchmark workdir: {workdir} | stub server: {server.url}")
+
+    results = OrderedDict()
+    try:
+        for name in STAGES:
+            if name not in stages:
+                continue
+            results[name] = run_stage_isolated(name, ctx)
+            stage = results[name]
+            print(f"{name:34} rows={stage['rows']:<8} {stage['rows_per_sec']:>10} rows/s  "
+                  f"p50={stage['latency_ms']['p50']}ms p99={stage['latency_ms']['p99']}ms  "
+                  f"rss={stage['peak_rss_mb']}MB{'  ERROR: ' + stage['error'] if 'error' in stage else ''}")
+    finally:
+        server.stop()
+
+    cold_start = OrderedDict()
+    if args.cold_start_runs > 0:
+        cold_start = cold_start_report(args.cold_start_runs)
+        for command, start in cold_start.items():
+            print(f"{'cold start: migrate ' + command:34} import={start['import_ms']}ms wall={start['wall_ms']}ms  "
+                  f"backends={','.join(start['backends']) or '-'}{'  ERROR: ' + start['error'] if 'error' in start else ''}")
+
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'workdir')},
+        'stub_requests': dict(server.requests),
+        'stages': results,
+        'cold_start': cold_start,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
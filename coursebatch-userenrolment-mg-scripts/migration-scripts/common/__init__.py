@@ -0,0 +1 @@
+"""Helpers shared by the migration scripts (course_batch_update, user_enrolments_update)."""
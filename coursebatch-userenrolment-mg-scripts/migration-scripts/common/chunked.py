@@ -0,0 +1,140 @@
+"""
+Multi-process chunked ingest for very large input CSVs (`--ingest parallel`).
+
+The file is cut into byte ranges that each start at the beginning of a record,
+and each range is parsed and prepared in its own process, so preparation scales
+with the cores of the pod instead of running on one.
+
+A cut point is moved forward to the first newline outside a quoted field. In a
+CSV written the RFC 4180 way (csv module, Excel, pandas) a quote character only
+opens, closes or doubles inside a quoted field, so a newline is a record
+boundary exactly when the number of quotes before it is even; the quotes are
+counted with bytes.count, much faster than parsing. A file with an odd number of
+quotes in total is not such a CSV and is read in one range instead.
+
+Ranges are decoded on their own (a cut is after a newline byte, never inside a
+UTF-8 sequence), read with the csv module like parse_csv, and handed to the
+caller's prepare function in forked worker processes. The results come back in
+file order.
+"""
+import csv
+import gc
+import io
+import logging
+import math
+import os
+from typing import Any, Callable, Dict, List, Tuple
+
+DEFAULT_MIN_CHUNK_BYTES = 4 << 20
+CHUNKS_PER_WORKER = 4
+SCAN_BLOCK_BYTES = 8 << 20
+
+
+def available_cpus() -> int:
+    """CPUs this process may run on (its affinity mask, where the platform has one)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _count_quotes(f, start: int, end: int) -> int:
+    f.seek(start)
+    count, remaining = 0, end - start
+    while remaining > 0:
+        block = f.read(min(SCAN_BLOCK_BYTES, remaining))
+        if not block:
+            break
+        count += block.count(b'"')
+        remaining -= len(block)
+    return count
+
+
+def _next_boundary(f, pos: int, quotes: int) -> Tuple[int, int]:
+    """First offset at or after pos that follows a newline outside quotes, and the quote count up to it."""
+    f.seek(pos)
+    while True:
+        block = f.read(SCAN_BLOCK_BYTES)
+        if not block:
+            return pos, quotes
+        start = 0
+        while True:
+            newline = block.find(b'\n', start)
+            if newline == -1:
+                quotes += block.count(b'"', start)
+                pos += len(block) - start
+                break
+            quotes += block.count(b'"', start, newline)
+            if quotes % 2 == 0:
+                return pos + newline - start + 1, quotes
+            pos += newline - start + 1
+            start = newline + 1
+
+
+def split_records(path: str, chunks: int) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """
+    (header fields, [(start, end) byte ranges]) covering the records after the header in order,
+    each range starting at a record. Fewer ranges than asked for when records are long.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data_start, quotes = _next_boundary(f, 0, 0)
+        f.seek(0)
+        header_text = f.read(data_start).decode('utf-8')
+        header = next(csv.reader(io.StringIO(header_text, newline='')), [])
+        # quotes counts the quote characters before pos
+        bounds, pos = [data_start], data_start
+        for i in range(1, chunks):
+            target = data_start + (size - data_start) * i // chunks
+            if target <= pos:
+                continue
+            quotes += _count_quotes(f, pos, target)
+            pos, quotes = _next_boundary(f, target, quotes)
+            if pos >= size:
+                break
+            bounds.append(pos)
+        quotes += _count_quotes(f, pos, size)
+    if quotes % 2:
+        logging.warning(f"split_records: {path} has an unbalanced quote character; reading it as one range")
+        bounds = [data_start]
+    bounds.append(size)
+    return header, [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_rows(path: str, start: int, end: int, fieldnames: List[str]) -> List[Dict[str, Any]]:
+    """The records of one byte range as parse_csv returns them (dicts of trimmed values)."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    reader = csv.DictReader(io.StringIO(text, newline=''), fieldnames=fieldnames)
+    return [{k: (v.strip() if isinstance(v, str) else v) for k, v in row.items()} for row in reader]
+
+
+def map_chunks(path: str, prepare: Callable, workers: int = None, min_chunk_bytes: int = DEFAULT_MIN_CHUNK_BYTES) -> list:
+    """
+    prepare(path, start, end, fieldnames, worker) for every range of the file, in up to `workers`
+    forked processes (default: every available CPU); returns the results in file order. A file
+    too small to split, or a single worker, is prepared in this process.
+    """
+    workers = max(1, workers or available_cpus())
+    size = os.path.getsize(path)
+    chunks = max(1, min(workers * CHUNKS_PER_WORKER, math.ceil(size / max(1, min_chunk_bytes))))
+    header, ranges = split_records(path, chunks)
+    workers = min(workers, len(ranges))
+    logging.info(f"map_chunks: {path} ({size} bytes) split into {len(ranges)} ranges for {workers} worker processes")
+    if workers <= 1:
+        return [prepare(path, start, end, header, False) for start, end in ranges]
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    # Forked workers inherit the loaded modules (see logging_setup.setup_worker_logging). They only
+    # build acyclic rows, so they run without the cyclic garbage collector
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('fork'), initializer=gc.disable) as pool:
+        futures = [pool.submit(prepare, path, start, end, header, True) for start, end in ranges]
+        # The results unpickle into millions of small acyclic objects; without this the cyclic
+        # garbage collector rescans all of them every few thousand allocations while they arrive
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return [future.result() for future in futures]
+        finally:
+            if enabled:
+                gc.enable()
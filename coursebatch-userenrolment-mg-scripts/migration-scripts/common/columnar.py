@@ -0,0 +1,163 @@
+"""
+Vectorized (pyarrow) input preparation for the migration scripts.
+
+Optional alternative to the per-row csv module path (`--ingest columnar`). The
+whole CSV is loaded into Arrow columns by the multi-threaded pyarrow reader,
+trimmed, split and validated with Arrow compute kernels, and dates are parsed
+once per distinct value. Results and log messages match the row path:
+
+- prepare_enrolments: same output as process_csv.prepare_rows
+- prepare_course_batches: same output as process_course_batches.parse_csv
+
+Needs pyarrow (`pip install pyarrow`).
+"""
+import csv
+import logging
+import sys
+from typing import List, Tuple
+
+from common import records
+from common.dates import DateNormalizer
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+ENROLMENT_DATES_COLUMN = 'cours complétés le'
+COURSE_BATCH_REQUIRED = ['Course ID', 'Batch ID', 'Start Date']
+
+
+def _require_pyarrow():
+    if pa is None:
+        logging.error("pyarrow is not installed. Run 'pip install pyarrow' to use the columnar ingest mode.")
+        sys.exit(1)
+
+
+def read_table(path: str, strip_header: bool = False):
+    """Load a CSV as one record batch of trimmed, non-null string columns ('' for empty cells)."""
+    _require_pyarrow()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f), [])
+    table = pacsv.read_csv(
+        path,
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in header},
+                                             strings_can_be_null=False),
+    )
+    names = [name.strip() for name in table.column_names] if strip_header else table.column_names
+    columns = [pc.utf8_trim_whitespace(pc.fill_null(col, '')).combine_chunks() for col in table.columns]
+    return pa.RecordBatch.from_arrays(columns, names=names)
+
+
+def _parse_distinct(values, try_mmddyyyy: bool, normalizer: DateNormalizer):
+    """Parse each distinct date string once and map the results back onto `values`."""
+    distinct = pc.unique(values)
+    parsed = pa.array([normalizer.convert(v, try_mmddyyyy) for v in distinct.to_pylist()], type=pa.string())
+    return pc.take(parsed, pc.index_in(values, value_set=distinct))
+
+
+def prepare_enrolments(input_path: str) -> Tuple[List[records.PreparedRow], int]:
+    """Columnar equivalent of process_csv.parse_csv + prepare_rows. Returns (prepared, skipped)."""
+    table = read_table(input_path)
+    total_rows = table.num_rows
+    logging.info(f"prepare_enrolments: Loaded {total_rows} rows from {input_path}")
+    codes = pc.split_pattern(table['Codes'], ',')
+    dates = pc.split_pattern(table[ENROLMENT_DATES_COLUMN], ',')
+    counts = pc.list_value_length(codes)
+    mismatch = pc.not_equal(counts, pc.list_value_length(dates))
+    for email in pc.filter(table['email'], mismatch).to_pylist():
+        logging.warning(f"Codes and dates count mismatch for {email}")
+
+    keep = pc.invert(mismatch)
+    table = table.filter(keep)
+    codes, dates, counts = pc.filter(codes, keep), pc.filter(dates, keep), pc.filter(counts, keep)
+    # One element per (row, code) pair; parent is the row index into `table`
+    parent = pc.list_parent_indices(codes)
+    flat_codes = pc.utf8_trim_whitespace(pc.list_flatten(codes))
+    flat_dates = pc.utf8_trim_whitespace(pc.list_flatten(dates))
+    # If only one code/date, allow MM/DD/YYYY parsing
+    single = pc.equal(pc.take(counts, parent), 1)
+    normalizer = DateNormalizer.for_values(flat_dates.slice(0, 1000).to_pylist())
+    parsed = pa.array([''] * len(flat_dates), type=pa.string())
+    for flag in (True, False):
+        mask = single if flag else pc.invert(single)
+        positions = pc.indices_nonzero(mask)
+        if len(positions):
+            values = _parse_distinct(pc.take(flat_dates, positions), flag, normalizer)
+            parsed = pc.replace_with_mask(parsed, mask, values)
+
+    # A row with any invalid date is skipped entirely; report its first invalid date like the row path
+    invalid = pc.equal(parsed, '')
+    bad_rows = pc.unique(pc.filter(parent, invalid))
+    reported = set()
+    for row, date in zip(pc.filter(parent, invalid).to_pylist(), pc.filter(flat_dates, invalid).to_pylist()):
+        if row in reported:
+            continue
+        reported.add(row)
+        email, raw = table['email'][row].as_py(), table[ENROLMENT_DATES_COLUMN][row].as_py()
+        if counts[row].as_py() == 1:
+            logging.warning(f"Skipping row for {email}: invalid completion date '{date}' in '{raw}' (single entry, tried MM/DD/YYYY)")
+        else:
+            logging.warning(f"Skipping row for {email}: invalid completion date '{date}' in '{raw}'")
+    good = pc.invert(pc.is_in(parent, value_set=bad_rows))
+
+    emails, profiles = table['email'].to_pylist(), table['Groupe'].to_pylist()
+    prepared = []
+    current_row, entries = None, []
+    for row, code, completed_on in zip(pc.filter(parent, good).to_pylist(), pc.filter(flat_codes, good).to_pylist(),
+                                       pc.filter(parsed, good).to_pylist()):
+        if row != current_row:
+            if entries:
+                prepared.append(records.PreparedRow(email=emails[current_row], learnerProfileCode=profiles[current_row], entries=entries))
+            entries = []
+            current_row = row
+        entries.append((code, completed_on))
+    if entries:
+        prepared.append(records.PreparedRow(email=emails[current_row], learnerProfileCode=profiles[current_row], entries=entries))
+    skipped = total_rows - len(prepared)
+    logging.info(f"prepare_enrolments: {len(prepared)} valid rows, {skipped} skipped")
+    return prepared, skipped
+
+
+def prepare_course_batches(input_path: str) -> List[records.CourseBatch]:
+    """Columnar equivalent of process_course_batches.parse_csv."""
+    table = read_table(input_path, strip_header=True)
+    total_rows = table.num_rows
+    table = table.append_column('idx', pa.array(range(1, total_rows + 1), type=pa.int64()))
+    for field in COURSE_BATCH_REQUIRED:
+        if field not in table.column_names:
+            table = table.append_column(field, pa.array([''] * total_rows, type=pa.string()))
+
+    missing = pa.array([False] * total_rows)
+    for field in COURSE_BATCH_REQUIRED:
+        missing = pc.or_(missing, pc.equal(table[field], ''))
+    for row in table.filter(missing).to_pylist():
+        idx = row.pop('idx')
+        fields = [f for f in COURSE_BATCH_REQUIRED if not row.get(f)]
+        logging.warning(f"Row {idx} skipped: missing required fields: {fields} | {row}")
+    table = table.filter(pc.invert(missing))
+
+    normalizer = DateNormalizer.for_values(table['Start Date'].slice(0, 1000).to_pylist())
+    table = table.append_column('start_date', _parse_distinct(table['Start Date'], False, normalizer))
+    bad_dates = pc.equal(table['start_date'], '')
+    for row in table.filter(bad_dates).to_pylist():
+        idx = row.pop('idx')
+        row.pop('start_date')
+        logging.warning(f"Row {idx} skipped: invalid Start Date '{row['Start Date']}' | {row}")
+    table = table.filter(pc.invert(bad_dates))
+
+    # Keep the first occurrence of each (Course ID, Batch ID)
+    firsts = pa.Table.from_batches([table]).group_by(['Course ID', 'Batch ID']).aggregate([('idx', 'min')])['idx_min']
+    duplicates = pc.invert(pc.is_in(table['idx'], value_set=firsts))
+    for row in table.filter(duplicates).to_pylist():
+        logging.warning(f"Row {row['idx']} skipped: duplicate Course ID/Batch ID: {(row['Course ID'], row['Batch ID'])}")
+    table = table.filter(pc.invert(duplicates))
+
+    rows = [records.CourseBatch(courseId=c, batchId=b, start_date=d)
+            for c, b, d in zip(table['Course ID'].to_pylist(), table['Batch ID'].to_pylist(), table['start_date'].to_pylist())]
+    logging.info(f"prepare_course_batches: Total valid records processed: {len(rows)}")
+    logging.info(f"prepare_course_batches: Total rows skipped due to errors: {total_rows - len(rows)}")
+    return rows
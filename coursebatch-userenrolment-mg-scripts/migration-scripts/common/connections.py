@@ -0,0 +1,100 @@
+"""
+Process-wide connection pools for the migration scripts.
+
+One requests.Session (keep-alive HTTP connections), one Cassandra session per
+(host, port, keyspace) and one Kafka producer per bootstrap server are created
+on first use and reused by every later call in the process until close_all().
+A one-shot run saves the connect per row or batch; the worker (worker.py)
+keeps them warm from one job to the next. The backend libraries are imported
+only when a pool is first used.
+"""
+import atexit
+import logging
+import os
+import threading
+
+HTTP_POOL_SIZE = 32
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_http = None
+_cassandra = {}
+_kafka = {}
+
+
+def _forget_if_forked():
+    # A forked child must not use its parent's sockets; it builds its own pools
+    global _pid, _http, _cassandra, _kafka
+    if os.getpid() != _pid:
+        _pid, _http, _cassandra, _kafka = os.getpid(), None, {}, {}
+
+
+def http():
+    """Shared requests.Session for every API and Elasticsearch call."""
+    global _http
+    with _lock:
+        _forget_if_forked()
+        if _http is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http = session
+        return _http
+
+
+def cassandra_session(host: str, port: int, keyspace: str):
+    """Connected session for the keyspace, reused across calls. Raises what Cluster.connect raises."""
+    key = (host, int(port), keyspace)
+    with _lock:
+        _forget_if_forked()
+        if key not in _cassandra:
+            from cassandra.cluster import Cluster
+            cluster = Cluster([host], port=int(port))
+            _cassandra[key] = (cluster, cluster.connect(keyspace))
+            logging.info(f"Connected to Cassandra {host}:{port}/{keyspace}")
+        return _cassandra[key][1]
+
+
+def kafka_producer(bootstrap_servers: str):
+    """KafkaProducer for the bootstrap servers, reused across calls. Callers flush() but do not close() it."""
+    with _lock:
+        _forget_if_forked()
+        if bootstrap_servers not in _kafka:
+            from kafka import KafkaProducer
+            _kafka[bootstrap_servers] = KafkaProducer(bootstrap_servers=[bootstrap_servers])
+        return _kafka[bootstrap_servers]
+
+
+def stats() -> dict:
+    with _lock:
+        return {'http': _http is not None, 'cassandra': len(_cassandra), 'kafka': len(_kafka)}
+
+
+def close_all():
+    """Flush and close every pooled connection. Later calls open new ones."""
+    global _http, _cassandra, _kafka
+    with _lock:
+        if os.getpid() != _pid:
+            return
+        http_session, cassandra, kafka = _http, _cassandra, _kafka
+        _http, _cassandra, _kafka = None, {}, {}
+    for producer in kafka.values():
+        try:
+            producer.flush()
+            producer.close()
+        except Exception as e:
+            logging.error(f"Closing Kafka producer failed: {e}")
+    for cluster, session in cassandra.values():
+        try:
+            session.shutdown()
+            cluster.shutdown()
+        except Exception as e:
+            logging.error(f"Closing Cassandra session failed: {e}")
+    if http_session is not None:
+        http_session.close()
+
+
+atexit.register(close_all)
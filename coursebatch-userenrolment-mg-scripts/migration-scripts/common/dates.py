@@ -0,0 +1,132 @@
+"""
+Date normalization shared by the migration scripts.
+
+Parses the date strings found in the business team's CSVs and returns
+'YYYY-MM-DD 00:00:00' (or '' when the value cannot be parsed), with the same
+semantics as the original strptime loop:
+
+- D/M/Y and Y-M-D formats are tried first (DAY_FIRST_FORMATS),
+- MM/DD/YYYY formats (US_FORMATS) only when try_mmddyyyy is set, which the
+  enrolment script does for single code/date rows.
+
+Each format is a compiled regex built from the same field patterns strptime
+uses, so the result is identical without the exception-driven strptime calls.
+The day-first formats can never match the same string (the year width and
+position differ), so a normalizer may try them in the order most common in its
+column (`DateNormalizer.for_values`) without changing any result. Results are
+memoized per distinct string.
+"""
+import logging
+import re
+from collections import Counter
+from datetime import date
+
+OUTPUT_SUFFIX = ' 00:00:00'
+DAY_FIRST_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%Y/%m/%d", "%d/%m/%y", "%d-%m-%y")
+US_FORMATS = ("%m/%d/%Y", "%m-%d-%Y", "%m/%d/%y", "%m-%d-%y")
+DEFAULT_SAMPLE_SIZE = 500
+MAX_CACHE_SIZE = 100000
+
+# Field patterns copied from _strptime.TimeRE so matching stays identical to strptime
+_FIELDS = {
+    'd': r'(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'Y': r'(?P<Y>\d\d\d\d)',
+    'y': r'(?P<y>\d\d)',
+}
+
+
+def _compile(fmt: str):
+    pattern = re.sub(r'%([dmYy])', lambda m: _FIELDS[m.group(1)], re.escape(fmt))
+    return re.compile(pattern + r'\Z', re.IGNORECASE)
+
+
+_PATTERNS = {fmt: _compile(fmt) for fmt in DAY_FIRST_FORMATS + US_FORMATS}
+
+
+def _parse(fmt: str, value: str) -> str:
+    """Return the normalized date if `value` matches `fmt` exactly and is a real date, else ''."""
+    match = _PATTERNS[fmt].match(value)
+    if not match:
+        return ''
+    fields = match.groupdict()
+    if fields.get('Y') is not None:
+        year = int(fields['Y'])
+    else:
+        # strptime maps two digit years 69-99 to 19xx and 00-68 to 20xx
+        year = int(fields['y'])
+        year += 1900 if year >= 69 else 2000
+    month, day = int(fields['m']), int(fields['d'])
+    try:
+        date(year, month, day)
+    except ValueError:
+        return ''
+    return f"{year}-{month:02d}-{day:02d}{OUTPUT_SUFFIX}"
+
+
+def infer_format_order(values, sample_size: int = DEFAULT_SAMPLE_SIZE) -> tuple:
+    """Order DAY_FIRST_FORMATS by how often each matches a sample of `values`."""
+    hits = Counter()
+    for i, value in enumerate(values):
+        if i >= sample_size:
+            break
+        if not value or not isinstance(value, str):
+            continue
+        value = value.strip()
+        for fmt in DAY_FIRST_FORMATS:
+            if _parse(fmt, value):
+                hits[fmt] += 1
+                break
+    # sorted() is stable, so unseen formats keep their original relative order
+    return tuple(sorted(DAY_FIRST_FORMATS, key=lambda fmt: -hits[fmt]))
+
+
+class DateNormalizer:
+    """Memoizing date parser; build one per CSV column with `for_values`."""
+
+    def __init__(self, format_order: tuple = DAY_FIRST_FORMATS):
+        self.format_order = format_order
+        self._cache = {}
+
+    @classmethod
+    def for_values(cls, values, sample_size: int = DEFAULT_SAMPLE_SIZE) -> 'DateNormalizer':
+        normalizer = cls(infer_format_order(values, sample_size))
+        logging.debug(f"Date format order inferred from sample: {normalizer.format_order}")
+        return normalizer
+
+    def convert(self, date_str: str, try_mmddyyyy: bool = False) -> str:
+        """
+        Parse a date string in common user formats and return 'YYYY-MM-DD 00:00:00'.
+        Accepts e.g. '1/3/2024', '01/03/2024', '2024-03-01', '2024/03/01', etc.
+        Tries MM/DD/YYYY as well if try_mmddyyyy is True (for the single code/date case).
+        Returns empty string if invalid.
+        """
+        if not date_str or not isinstance(date_str, str):
+            return ''
+        key = (date_str, try_mmddyyyy)
+        result = self._cache.get(key)
+        if result is None:
+            value = date_str.strip()
+            result = ''
+            for fmt in self.format_order:
+                result = _parse(fmt, value)
+                if result:
+                    break
+            if not result and try_mmddyyyy:
+                for fmt in US_FORMATS:
+                    result = _parse(fmt, value)
+                    if result:
+                        break
+            if len(self._cache) < MAX_CACHE_SIZE:
+                self._cache[key] = result
+        if not result:
+            logging.warning(f"Could not parse date: '{date_str.strip()}' (tried multiple formats, MM/DD/YYYY allowed={try_mmddyyyy})")
+        return result
+
+
+_default = DateNormalizer()
+
+
+def convert_date(date_str: str, try_mmddyyyy: bool = False) -> str:
+    """Module-level convert using a shared memoizing normalizer (default format order)."""
+    return _default.convert(date_str, try_mmddyyyy)
@@ -0,0 +1,88 @@
+"""
+Dry-run plan artifacts for the migration scripts.
+
+Instead of logging every statement and payload a dry run would send, the
+scripts record each intended operation as one compact JSON line in a plan file
+(gzip-compressed when the path ends in .gz). At the end a short summary is
+logged: operation counts, the plan path and the first few operations as a
+sample. A `<plan>.stats.json` file next to the plan keeps the counts.
+
+Config keys (CLI flags override them):
+
+    dry_run_plan: data/dry_run_plan.ndjson.gz   # default: next to the script
+    dry_run_sample: 5                           # operations echoed to the log
+"""
+import gzip
+import json
+import logging
+import os
+from collections import Counter
+
+DEFAULT_SAMPLE = 5
+
+
+class PlanWriter:
+    """Append-only NDJSON writer for the operations a dry run would perform."""
+
+    def __init__(self, path: str, sample: int = DEFAULT_SAMPLE):
+        self.path = path
+        self.sample = max(0, int(sample))
+        self.counts = Counter()
+        self.samples = []
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        if path.endswith('.gz'):
+            self._file = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+
+    @classmethod
+    def from_config(cls, config: dict, default_path: str) -> 'PlanWriter':
+        config = config or {}
+        return cls(config.get('dry_run_plan') or default_path, config.get('dry_run_sample', DEFAULT_SAMPLE))
+
+    def add(self, op: str, **fields):
+        entry = {'op': op}
+        entry.update(fields)
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        self._file.write(line + '\n')
+        self.counts[op] += 1
+        if len(self.samples) < self.sample:
+            self.samples.append(line)
+
+    def close(self) -> dict:
+        """Close the plan, write <plan>.stats.json and log the summary. Returns the stats."""
+        if self._file.closed:
+            return self.stats()
+        self._file.close()
+        stats = self.stats()
+        with open(f"{self.path}.stats.json", 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=2)
+        logging.info(f"[DRY RUN] {stats['total']} operations written to {self.path}: "
+                     + ', '.join(f"{op}={count}" for op, count in sorted(self.counts.items())))
+        for line in self.samples:
+            logging.info(f"[DRY RUN] sample: {line}")
+        return stats
+
+    def stats(self) -> dict:
+        return {'plan': self.path, 'total': sum(self.counts.values()), 'operations': dict(sorted(self.counts.items()))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_cli_arguments(parser):
+    parser.add_argument('--dry-run-plan', help="Dry run: file the intended operations are written to (.gz to compress). Overrides config 'dry_run_plan'")
+    parser.add_argument('--dry-run-sample', type=int, help=f"Dry run: number of planned operations echoed to the log (default {DEFAULT_SAMPLE}). Overrides config 'dry_run_sample'")
+
+
+def apply_cli_arguments(args, config: dict):
+    """Copy --dry-run-plan/--dry-run-sample into config so PlanWriter.from_config sees them."""
+    if getattr(args, 'dry_run_plan', None):
+        config['dry_run_plan'] = args.dry_run_plan
+    if getattr(args, 'dry_run_sample', None) is not None:
+        config['dry_run_sample'] = args.dry_run_sample
@@ -0,0 +1,66 @@
+"""
+Message keys and partition assignment for the certificate request events.
+
+Keys are read straight from the serialized event line (no JSON parse on the
+hot path), and partitions are computed with the same murmur2 hash as Kafka's
+default partitioner, so a message sent to an explicit partition lands exactly
+where a keyed send would have put it.
+"""
+import json
+import re
+
+KEY_FIELDS = ('userId', 'batchId', 'courseId')
+# Where each field lives in a BE_JOB_REQUEST event (each name occurs once in the event)
+_KEY_PATHS = {
+    'userId': ('edata', 'userId'),
+    'batchId': ('edata', 'related', 'batchId'),
+    'courseId': ('edata', 'related', 'courseId'),
+    'mid': ('mid',),
+}
+_KEY_PATTERNS = {field: re.compile(rb'"' + field.encode() + rb'"\s*:\s*"([^"\\]*)"') for field in _KEY_PATHS}
+
+
+def extract_key(line: bytes, field: str) -> bytes:
+    """Return the UTF-8 value of `field` in a serialized event, or b'' if it is missing."""
+    match = _KEY_PATTERNS[field].search(line)
+    if match:
+        return match.group(1)
+    # Escaped characters in the value: fall back to a real parse
+    try:
+        value = json.loads(line)
+        for part in _KEY_PATHS[field]:
+            value = value[part]
+        return str(value).encode('utf-8')
+    except (ValueError, KeyError, TypeError):
+        return b''
+
+
+def murmur2(data: bytes) -> int:
+    """Kafka's murmur2 (org.apache.kafka.common.utils.Utils.murmur2) as an unsigned 32-bit int."""
+    length = len(data)
+    m = 0x5bd1e995
+    h = (0x9747b28c ^ length) & 0xffffffff
+    for i in range(0, length - length % 4, 4):
+        k = data[i] | (data[i + 1] << 8) | (data[i + 2] << 16) | (data[i + 3] << 24)
+        k = (k * m) & 0xffffffff
+        k ^= k >> 24
+        k = (k * m) & 0xffffffff
+        h = ((h * m) & 0xffffffff) ^ k
+    tail = length & ~3
+    extra = length % 4
+    if extra == 3:
+        h ^= data[tail + 2] << 16
+    if extra >= 2:
+        h ^= data[tail + 1] << 8
+    if extra >= 1:
+        h ^= data[tail]
+        h = (h * m) & 0xffffffff
+    h ^= h >> 13
+    h = (h * m) & 0xffffffff
+    h ^= h >> 15
+    return h
+
+
+def partition_for(key: bytes, partitions: int) -> int:
+    """Partition Kafka's default partitioner picks for a non-empty key."""
+    return (murmur2(key) & 0x7fffffff) % partitions
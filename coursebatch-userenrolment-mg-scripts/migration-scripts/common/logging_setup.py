@@ -0,0 +1,126 @@
+"""
+Shared logging setup for the migration scripts.
+
+Records are handed to a queue in the calling thread and written by a background
+QueueListener, so the hot loops never block on console or file I/O. The log
+file is JSON lines; the console stays human readable. Per-row success messages
+go through `sample()` so only 1 in N is written at INFO (all of them at DEBUG);
+warnings and errors are never sampled.
+
+Optional `logging` section in config.yaml:
+
+    logging:
+      level: INFO
+      dir: data/logs           # default: next to the script
+      max_bytes: 104857600     # per file, default 100 MB
+      backup_count: 10
+      sample_every: 1000       # log 1 in N per-row success messages at INFO
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 10
+DEFAULT_SAMPLE_EVERY = 1000
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+_listener = None
+_sample_every = DEFAULT_SAMPLE_EVERY
+_sample_counts = defaultdict(int)
+_sample_lock = threading.Lock()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg (and exc when present)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(log_file: str, config: dict = None, stream=None):
+    """Route all logging through a background writer. Safe to call more than once."""
+    global _listener, _sample_every
+    if _listener is not None:
+        return
+    settings = (config or {}).get('logging') or {}
+    level = getattr(logging, str(settings.get('level', 'INFO')).upper(), logging.INFO)
+    _sample_every = max(1, int(settings.get('sample_every', DEFAULT_SAMPLE_EVERY)))
+    if settings.get('dir'):
+        log_file = os.path.join(settings['dir'], os.path.basename(log_file))
+    dir_name = os.path.dirname(log_file)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+    file_handler = RotatingFileHandler(
+        log_file,
+        maxBytes=int(settings.get('max_bytes', DEFAULT_MAX_BYTES)),
+        backupCount=int(settings.get('backup_count', DEFAULT_BACKUP_COUNT)),
+        encoding='utf-8',
+    )
+    file_handler.setFormatter(JsonLinesFormatter())
+    console_handler = logging.StreamHandler(stream or sys.stdout)
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def setup_worker_logging(level: int = logging.INFO):
+    """
+    In a forked worker process: drop the inherited queue handler (its writer thread
+    only runs in the parent) and log plain text to stderr, tagged with the process name.
+    """
+    global _listener
+    _listener = None
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(processName)s] %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def sample(key: str) -> bool:
+    """True if this per-row success message for `key` should be logged (every Nth, or always at DEBUG)."""
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        return True
+    with _sample_lock:
+        count = _sample_counts[key]
+        _sample_counts[key] = count + 1
+    return count % _sample_every == 0
@@ -0,0 +1,343 @@
+"""
+Run metrics for the migration scripts.
+
+Keeps counters and latency histograms in process, optionally serves them in the
+Prometheus text format on `/metrics` (plus a JSON view on `/summary`), and can
+write a final JSON summary when the run ends. No third-party dependencies.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: tuple, extra: dict = None) -> str:
+    items = list(key) + sorted((extra or {}).items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        with _lock:
+            self.values[_label_key(labels)] += amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0.0)
+
+    def render(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(key)} {value:g}"
+
+    def snapshot(self) -> dict:
+        return {','.join(f"{k}={v}" for k, v in key) or 'total': value for key, value in sorted(self.values.items())}
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with _lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+            series['max'] = max(series['max'], value)
+
+    def quantile(self, q: float, series: dict) -> float:
+        """Upper bound of the bucket holding the q-quantile (max observed value for the overflow bucket)."""
+        target = q * series['count']
+        cumulative = 0
+        for upper, count in zip(self.buckets, series['counts']):
+            cumulative += count
+            if cumulative >= target:
+                return upper
+        return series['max']
+
+    def render(self):
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for upper, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(key, {'le': f'{upper:g}'})} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {series['count']}"
+            yield f"{self.name}_sum{_format_labels(key)} {series['sum']:.6f}"
+            yield f"{self.name}_count{_format_labels(key)} {series['count']}"
+
+    def snapshot(self) -> dict:
+        out = {}
+        for key, series in sorted(self.series.items()):
+            count = series['count']
+            out[','.join(f"{k}={v}" for k, v in key) or 'total'] = {
+                'count': count,
+                'mean_ms': round(series['sum'] / count * 1000, 3) if count else 0.0,
+                'p50_ms': round(self.quantile(0.5, series) * 1000, 3) if count else 0.0,
+                'p99_ms': round(self.quantile(0.99, series) * 1000, 3) if count else 0.0,
+                'max_ms': round(series['max'] * 1000, 3),
+            }
+        return out
+
+
+ROWS_PROCESSED = Counter('migration_rows_processed_total', 'Rows processed successfully per stage')
+ROWS_FAILED = Counter('migration_rows_failed_total', 'Rows skipped or failed per stage')
+API_REQUESTS = Counter('migration_api_requests_total', 'HTTP API calls per endpoint and status')
+API_LATENCY = Histogram('migration_api_request_duration_seconds', 'HTTP API call latency per endpoint')
+CASSANDRA_WRITES = Counter('migration_cassandra_writes_total', 'Cassandra statements executed per table and status')
+CASSANDRA_LATENCY = Histogram('migration_cassandra_write_duration_seconds', 'Cassandra statement latency per table')
+KAFKA_SENT = Counter('migration_kafka_messages_sent_total', 'Messages handed to the Kafka producer per topic')
+KAFKA_ACKED = Counter('migration_kafka_messages_acked_total', 'Messages acknowledged by Kafka per topic')
+KAFKA_FAILED = Counter('migration_kafka_messages_failed_total', 'Messages Kafka failed to deliver per topic')
+CACHE_LOOKUPS = Counter('migration_cache_lookups_total', 'Lookup cache hits and misses per cache')
+
+ALL_METRICS = [ROWS_PROCESSED, ROWS_FAILED, API_REQUESTS, API_LATENCY, CASSANDRA_WRITES, CASSANDRA_LATENCY,
+               KAFKA_SENT, KAFKA_ACKED, KAFKA_FAILED, CACHE_LOOKUPS]
+
+_stages = {}
+_started_at = time.time()
+_servers = {}
+
+
+class StageProgress:
+    """Rows done/failed for one stage, with rate and ETA for the progress log lines."""
+
+    def __init__(self, name: str, total: int = None):
+        self.name = name
+        self.total = total
+        self.started = time.time()
+        self.processed = 0
+        self.failed = 0
+
+    def ok(self, n: int = 1):
+        self.processed += n
+        ROWS_PROCESSED.inc(n, stage=self.name)
+
+    def fail(self, n: int = 1):
+        self.failed += n
+        ROWS_FAILED.inc(n, stage=self.name)
+
+    @property
+    def done(self) -> int:
+        return self.processed + self.failed
+
+    def rate(self) -> float:
+        elapsed = time.time() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta_seconds(self):
+        rate = self.rate()
+        if not self.total or not rate:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+    def status(self) -> str:
+        """Suffix for progress log lines, e.g. '(1200/5000, 85.3 rows/s, ETA 44s)'."""
+        parts = [f"{self.done}/{self.total}" if self.total else f"{self.done}", f"{self.rate():.1f} rows/s"]
+        eta = self.eta_seconds()
+        if eta is not None:
+            parts.append(f"ETA {int(eta)}s")
+        if self.failed:
+            parts.append(f"{self.failed} failed")
+        return f"({', '.join(parts)})"
+
+    def snapshot(self) -> dict:
+        elapsed = time.time() - self.started
+        return {
+            'total': self.total,
+            'processed': self.processed,
+            'failed': self.failed,
+            'elapsed_s': round(elapsed, 3),
+            'rows_per_sec': round(self.rate(), 2),
+            'eta_s': None if self.eta_seconds() is None else round(self.eta_seconds(), 1),
+        }
+
+
+def stage(name: str, total: int = None) -> StageProgress:
+    """Start (or restart) progress tracking for a stage."""
+    progress = StageProgress(name, total)
+    _stages[name] = progress
+    return progress
+
+
+def call_api(endpoint: str, fn, *args, **kwargs):
+    """Call `fn(*args, **kwargs)` (e.g. requests.post) and record its latency and status under `endpoint`."""
+    start = time.perf_counter()
+    try:
+        resp = fn(*args, **kwargs)
+    except Exception as e:
+        API_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+        API_REQUESTS.inc(endpoint=endpoint, status=type(e).__name__)
+        raise
+    API_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+    API_REQUESTS.inc(endpoint=endpoint, status=str(getattr(resp, 'status_code', 'unknown')))
+    return resp
+
+
+def execute_cassandra(session, query, table: str = 'unknown', parameters=None):
+    """Run session.execute and record the write latency and outcome for `table`."""
+    start = time.perf_counter()
+    try:
+        result = session.execute(query, parameters) if parameters is not None else session.execute(query)
+    except Exception:
+        CASSANDRA_LATENCY.observe(time.perf_counter() - start, table=table)
+        CASSANDRA_WRITES.inc(table=table, status='error')
+        raise
+    CASSANDRA_LATENCY.observe(time.perf_counter() - start, table=table)
+    CASSANDRA_WRITES.inc(table=table, status='ok')
+    return result
+
+
+def kafka_send(producer, topic: str, **kwargs):
+    """producer.send(topic, ...) with sent/acked/failed counters attached to the returned future."""
+    future = producer.send(topic, **kwargs)
+    KAFKA_SENT.inc(topic=topic)
+    future.add_callback(lambda _metadata: KAFKA_ACKED.inc(topic=topic))
+    future.add_errback(lambda _exc: KAFKA_FAILED.inc(topic=topic))
+    return future
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def render_prometheus() -> str:
+    lines = []
+    with _lock:
+        for metric in ALL_METRICS:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for name, progress in _stages.items():
+            snap = progress.snapshot()
+            lines.append(f'migration_stage_rows_per_second{{stage="{name}"}} {snap["rows_per_sec"]:g}')
+            if progress.total is not None:
+                lines.append(f'migration_stage_rows_expected{{stage="{name}"}} {progress.total}')
+            if snap['eta_s'] is not None:
+                lines.append(f'migration_stage_eta_seconds{{stage="{name}"}} {snap["eta_s"]:g}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> dict:
+    with _lock:
+        caches = {}
+        for key, value in CACHE_LOOKUPS.values.items():
+            labels = dict(key)
+            entry = caches.setdefault(labels['cache'], {'hit': 0, 'miss': 0})
+            entry[labels['result']] += int(value)
+        for entry in caches.values():
+            lookups = entry['hit'] + entry['miss']
+            entry['hit_rate'] = round(entry['hit'] / lookups, 4) if lookups else 0.0
+        return {
+            'elapsed_s': round(time.time() - _started_at, 3),
+            'stages': {name: progress.snapshot() for name, progress in _stages.items()},
+            'api_requests': API_REQUESTS.snapshot(),
+            'api_latency': API_LATENCY.snapshot(),
+            'cassandra_writes': CASSANDRA_WRITES.snapshot(),
+            'cassandra_latency': CASSANDRA_LATENCY.snapshot(),
+            'kafka': {
+                'sent': KAFKA_SENT.snapshot(),
+                'acked': KAFKA_ACKED.snapshot(),
+                'failed': KAFKA_FAILED.snapshot(),
+            },
+            'caches': caches,
+        }
+
+
+def start_server(port: int, host: str = '0.0.0.0'):
+    """Serve /metrics and /summary from a daemon thread. Returns the server (the running one if already started)."""
+    if (host, port) in _servers:
+        return _servers[(host, port)]
+    # Imported here: http.server is only needed when the endpoint is enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/metrics':
+                body, content_type = render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+            elif path == '/summary':
+                body, content_type = json.dumps(summary()).encode('utf-8'), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    _servers[(host, port)] = server
+    logging.info(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def write_summary(path: str):
+    dir_name = os.path.dirname(path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary(), f, indent=2, ensure_ascii=False)
+    logging.info(f"Metrics summary written to {path}")
+
+
+def add_cli_arguments(parser):
+    """Add the --metrics-port / --metrics-summary options shared by all scripts."""
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port at /metrics (default: config metrics_port, disabled if unset)')
+    parser.add_argument('--metrics-summary', default=None,
+                        help='Write a JSON summary of the run metrics to this path when the run ends')
+
+
+def setup_from_args(args, config: dict = None):
+    """Start the metrics server if requested on the command line or in config (metrics_port)."""
+    port = getattr(args, 'metrics_port', None)
+    if port is None and config:
+        port = config.get('metrics_port')
+    if port is not None:
+        return start_server(int(port))
+    return None
+
+
+def finish_from_args(args):
+    path = getattr(args, 'metrics_summary', None)
+    if path:
+        write_summary(path)
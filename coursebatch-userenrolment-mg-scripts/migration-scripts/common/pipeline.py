@@ -0,0 +1,194 @@
+"""
+In-process DAG runner for the migration stages.
+
+Every stage runs in its own thread of one process. A stage can stream chunks of
+records to the next stage through a bounded channel: a full channel blocks the
+producer, so memory stays bounded and a slow stage throttles the ones before
+it. A stage can also wait for other stages to finish first (`after`) and for a
+manual approval before it starts (`gate`).
+
+A stage function is called as fn(inputs, emit): `inputs` iterates over the
+chunks of its source stage (None without a source) and emit(chunk) passes a
+chunk on to the stages that consume this one. When the source stage fails or
+is skipped, iterating `inputs` raises SourceStopped after the chunks it did
+emit, and the stage ends with the source's status instead of ok.
+"""
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from common import profiling
+
+DEFAULT_QUEUE_SIZE = 1000
+
+_END = object()
+
+
+class SourceStopped(Exception):
+    """Raised to a stage reading from a source stage that did not complete."""
+
+    def __init__(self, source: str, status: str):
+        super().__init__(f"source stage {source} {status}")
+        self.status = status
+
+
+class Channel:
+    """Bounded queue of chunks from a stage to one consumer stage."""
+
+    def __init__(self, name: str, maxsize: int = DEFAULT_QUEUE_SIZE, source: str = None):
+        self.name = name
+        self.source = source
+        self.source_status = 'ok'
+        self._queue = queue.Queue(maxsize)
+        self._abandoned = threading.Event()
+
+    def put(self, item) -> bool:
+        """Block while the channel is full. Returns False (dropping the item) once the consumer has stopped."""
+        while not self._abandoned.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self, status: str = 'ok'):
+        """End the chunks; status is the source stage's, and anything but ok stops the consumer."""
+        self.source_status = status
+        self.put(_END)
+
+    def abandon(self):
+        """Called when the consumer stops early, so the producer does not block forever."""
+        self._abandoned.set()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                if self.source_status != 'ok':
+                    raise SourceStopped(self.source, self.source_status)
+                return
+            yield item
+
+
+class Stage:
+    def __init__(self, name: str, fn, source: str = None, after=(), gate: bool = False):
+        self.name = name
+        self.fn = fn
+        self.source = source
+        self.after = tuple(after)
+        self.gate = gate
+        self.input = None
+        self.outputs = []
+        self.done = threading.Event()
+        self.result = {'status': 'pending'}
+
+
+class Pipeline:
+    """Stages added in dependency order and run concurrently by run()."""
+
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE, approve=None):
+        self.queue_size = queue_size
+        self.approve = approve or console_gate
+        self.stages = OrderedDict()
+
+    def add(self, name: str, fn, source: str = None, after=(), gate: bool = False):
+        for dependency in ([source] if source else []) + list(after):
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        stage = Stage(name, fn, source, after, gate)
+        if source:
+            stage.input = Channel(f"{source}->{name}", self.queue_size, source)
+            self.stages[source].outputs.append(stage.input)
+        self.stages[name] = stage
+        return stage
+
+    def run(self) -> OrderedDict:
+        """Run every stage and return {stage: {'status', 'seconds', 'error'?}}; status is ok, failed or skipped."""
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._run_stage, args=(stage,), name=f"stage-{stage.name}", daemon=True)
+                   for stage in self.stages.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results = OrderedDict((name, stage.result) for name, stage in self.stages.items())
+        logging.info(f"Pipeline finished in {time.perf_counter() - started:.1f}s: "
+                     + ', '.join(f"{name}={result['status']}" for name, result in results.items()))
+        return results
+
+    def _run_stage(self, stage: Stage):
+        try:
+            for name in stage.after:
+                self.stages[name].done.wait()
+            blocked = [name for name in stage.after if self.stages[name].result['status'] != 'ok']
+            if blocked:
+                self._skip(stage, f"waits for {', '.join(blocked)}, which did not complete")
+                return
+            if stage.gate and not self.approve(stage.name):
+                self._skip(stage, 'not approved at its gate')
+                return
+            logging.info(f"Stage {stage.name} started")
+            stage.result = {'status': 'running'}
+            start = time.perf_counter()
+
+            def emit(chunk):
+                for channel in stage.outputs:
+                    channel.put(chunk)
+
+            try:
+                with profiling.stage(stage.name):
+                    stage.fn(stage.input, emit)
+                stage.result = {'status': 'ok'}
+            except SourceStopped as e:
+                (logging.warning if e.status == 'skipped' else logging.error)(f"Stage {stage.name} stopped: {e}")
+                stage.result = {'status': e.status, 'error': f"stopped: {e}"}
+            except BaseException as e:  # the scripts call sys.exit() on fatal errors
+                logging.error(f"Stage {stage.name} failed: {type(e).__name__}: {e}", exc_info=not isinstance(e, SystemExit))
+                stage.result = {'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+            stage.result['seconds'] = round(time.perf_counter() - start, 3)
+            logging.info(f"Stage {stage.name} {stage.result['status']} in {stage.result['seconds']}s")
+        finally:
+            if stage.input is not None:
+                stage.input.abandon()
+            for channel in stage.outputs:
+                channel.close(stage.result['status'])
+            stage.done.set()
+
+    def _skip(self, stage: Stage, reason: str):
+        logging.warning(f"Stage {stage.name} skipped: {reason}")
+        stage.result = {'status': 'skipped', 'error': reason}
+
+
+_gate_lock = threading.Lock()
+
+
+def console_gate(name: str) -> bool:
+    """Ask on the terminal before a gated stage starts."""
+    with _gate_lock:
+        answer = input(f"Proceed to stage '{name}'? (y/n): ")
+    return answer.strip().lower().startswith('y')
+
+
+def file_gate(directory: str, poll_seconds: float = 5.0):
+    """Gate that waits for <directory>/<stage>.approve (or .reject) to appear, for runs without a terminal."""
+    def approve(name: str) -> bool:
+        os.makedirs(directory, exist_ok=True)
+        approved, rejected = os.path.join(directory, f"{name}.approve"), os.path.join(directory, f"{name}.reject")
+        logging.info(f"Stage {name} is waiting at its gate: create {approved} to proceed or {rejected} to skip it")
+        while True:
+            if os.path.exists(approved):
+                return True
+            if os.path.exists(rejected):
+                return False
+            time.sleep(poll_seconds)
+    return approve
+
+
+def default_gate(directory: str):
+    """Console prompt when stdin is a terminal, approval files otherwise."""
+    return console_gate if sys.stdin.isatty() else file_gate(directory)
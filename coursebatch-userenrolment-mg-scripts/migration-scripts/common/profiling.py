@@ -0,0 +1,327 @@
+"""
+Per-stage profiling for the migration scripts (--profile).
+
+    full    cProfile and tracemalloc for each stage: wall vs CPU time, the
+            functions with the most own and cumulative time, peak traced memory
+            and the lines whose allocations are still alive at the end of the
+            stage. Several times slower; for investigating a slow run.
+    sample  a background thread records the stack of each stage's thread every
+            `interval` seconds (default 10 ms). It shows where the wall time
+            goes, including waits on HTTP, Cassandra and Kafka, for about 1% of
+            overhead, so it can stay on in production runs.
+
+Output goes to <dir>/<script>-<YYYYmmdd-HHMMSS>/ (dir defaults to data/profiles):
+
+    report.json        every stage: wall/CPU time, top functions, memory
+    <stage>.prof       cProfile stats (full; pstats, snakeviz)
+    <stage>.folded     collapsed stacks (sample; flamegraph.pl, speedscope)
+
+and a one-line summary per stage in the log. Config keys (CLI flags override
+them): profile (full | sample), profile_dir, profile_interval.
+
+Stages running at the same time (pipeline.py) each get their own CPU profile
+and samples; memory figures are process-wide.
+"""
+import atexit
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+MODES = ('full', 'sample')
+DEFAULT_DIR = 'data/profiles'
+DEFAULT_INTERVAL = 0.01
+DEFAULT_TOP = 15
+MAX_STACK_DEPTH = 64
+MB = 1024 * 1024
+
+_session = None
+_atexit_registered = False
+# Why sessions may not be started in this process (see disable)
+_disabled = None
+_in_stage = threading.local()
+
+
+def _label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return round(peak / MB if sys.platform == 'darwin' else peak / 1024, 2)
+
+
+class StackSampler(threading.Thread):
+    """Counts the call stacks of the watched threads at a fixed interval."""
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.interval = interval
+        self._targets = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def watch(self, ident: int, stacks: Counter):
+        with self._lock:
+            self._targets[ident] = stacks
+
+    def unwatch(self, ident: int):
+        with self._lock:
+            self._targets.pop(ident, None)
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        labels = self._labels
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                targets = list(self._targets.items())
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            for ident, stacks in targets:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                if stack:
+                    stacks[tuple(reversed(stack))] += 1
+
+
+def summarize_samples(stacks: Counter, top: int) -> dict:
+    """Top functions by samples on top of the stack (own) and anywhere in it (cumulative)."""
+    total = sum(stacks.values())
+    own, cumulative = Counter(), Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for label in set(stack):
+            cumulative[label] += count
+
+    def rows(counter):
+        return [{'function': label, 'samples': count, 'share': round(count / total, 4)} for label, count in counter.most_common(top)]
+
+    return {'samples': total, 'own': rows(own), 'cumulative': rows(cumulative)}
+
+
+def summarize_cprofile(profile, top: int) -> dict:
+    import pstats
+    stats = pstats.Stats(profile).stats
+    entries = [{'function': f"{func} ({os.path.basename(path)}:{line})", 'calls': nc, 'own_s': round(tt, 4), 'cumulative_s': round(ct, 4)}
+               for (path, line, func), (cc, nc, tt, ct, callers) in stats.items()]
+    return {
+        'own': sorted(entries, key=lambda e: e['own_s'], reverse=True)[:top],
+        'cumulative': sorted(entries, key=lambda e: e['cumulative_s'], reverse=True)[:top],
+    }
+
+
+class Profiler:
+    """One profiling session: a directory of per-stage results and the report that lists them."""
+
+    def __init__(self, mode: str, output_dir: str, name: str = 'run', interval: float = DEFAULT_INTERVAL, top: int = DEFAULT_TOP):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profile mode '{mode}', expected one of {MODES}")
+        self.mode = mode
+        self.top = top
+        self.name = name
+        self.dir = os.path.join(output_dir, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        os.makedirs(self.dir, exist_ok=True)
+        self.stages = []
+        self._names = Counter()
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        self._sampler = None
+        self._finished = False
+        if mode == 'sample':
+            self._sampler = StackSampler(interval)
+            self._sampler.start()
+        else:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+        logging.info(f"Profiling ({mode}) to {self.dir}")
+
+    def _stage_file(self, name: str) -> str:
+        with self._lock:
+            self._names[name] += 1
+            count = self._names[name]
+        return name if count == 1 else f"{name}-{count}"
+
+    @contextmanager
+    def stage(self, name: str):
+        file_name = self._stage_file(name)
+        record = {'stage': name, 'mode': self.mode, 'thread': threading.current_thread().name}
+        profile, stacks, start_snapshot = None, None, None
+        if self.mode == 'full':
+            import cProfile
+            import tracemalloc
+            tracemalloc.reset_peak()
+            start_snapshot = tracemalloc.take_snapshot()
+            start_traced = tracemalloc.get_traced_memory()[0]
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:  # another profiler is active in this thread or process
+                logging.warning(f"profile: no CPU profile for stage {name}: {e}")
+                profile = None
+        else:
+            stacks = Counter()
+            self._sampler.watch(threading.get_ident(), stacks)
+        wall_start, cpu_start, thread_cpu_start = time.perf_counter(), time.process_time(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            record.update({
+                'wall_s': round(wall, 4),
+                'cpu_s': round(time.process_time() - cpu_start, 4),
+                'thread_cpu_s': round(time.thread_time() - thread_cpu_start, 4),
+            })
+            if profile is not None:
+                profile.disable()
+            # Wall time the stage's thread was not on a CPU: network, disk, locks and sleeps
+            record['wait_share'] = round(max(0.0, 1 - record['thread_cpu_s'] / wall), 4) if wall > 0 else 0.0
+            if self.mode == 'full':
+                self._finish_full(record, file_name, profile, start_snapshot, start_traced)
+            else:
+                self._sampler.unwatch(threading.get_ident())
+                self._finish_sample(record, file_name, stacks)
+            record['peak_rss_mb'] = peak_rss_mb()
+            with self._lock:
+                self.stages.append(record)
+            self._log(record)
+
+    def _finish_full(self, record: dict, file_name: str, profile, start_snapshot, start_traced: int):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        growth = tracemalloc.take_snapshot().compare_to(start_snapshot, 'lineno')
+        record['memory'] = {
+            'peak_traced_mb': round(peak / MB, 2),
+            'peak_over_start_mb': round((peak - start_traced) / MB, 2),
+            'retained_mb': round((current - start_traced) / MB, 2),
+            'top_retained': [{'line': str(stat.traceback[0]), 'size_kb': round(stat.size_diff / 1024, 1), 'count': stat.count_diff}
+                             for stat in growth[:self.top] if stat.size_diff > 0],
+        }
+        if profile is not None:
+            path = os.path.join(self.dir, f"{file_name}.prof")
+            profile.dump_stats(path)
+            record['cprofile'] = path
+            record['functions'] = summarize_cprofile(profile, self.top)
+
+    def _finish_sample(self, record: dict, file_name: str, stacks: Counter):
+        path = os.path.join(self.dir, f"{file_name}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        record['folded'] = path
+        record['functions'] = summarize_samples(stacks, self.top)
+
+    def _log(self, record: dict):
+        functions = record.get('functions', {})
+        if self.mode == 'full':
+            top = ', '.join(f"{e['function']} {e['own_s']}s" for e in functions.get('own', [])[:3])
+            memory = f", peak traced {record['memory']['peak_traced_mb']} MB"
+        else:
+            top = ', '.join(f"{e['function']} {e['share']:.0%}" for e in functions.get('own', [])[:3])
+            memory = ''
+        logging.info(f"profile {record['stage']}: wall {record['wall_s']}s, cpu {record['cpu_s']}s "
+                     f"(thread {record['thread_cpu_s']}s, {record['wait_share']:.0%} waiting){memory}, peak RSS {record['peak_rss_mb']} MB"
+                     + (f"; top: {top}" if top else ''))
+
+    def finish(self) -> str:
+        """Write report.json and stop sampling. Returns the report path."""
+        if self._finished:
+            return os.path.join(self.dir, 'report.json')
+        self._finished = True
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._started_tracemalloc:
+            import tracemalloc
+            tracemalloc.stop()
+        path = os.path.join(self.dir, 'report.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'script': self.name, 'mode': self.mode, 'argv': sys.argv, 'python': sys.version.split()[0],
+                       'stages': self.stages}, f, indent=2)
+        logging.info(f"Profile report written to {path}")
+        return path
+
+
+def start(mode: str, output_dir: str = DEFAULT_DIR, name: str = 'run', interval: float = DEFAULT_INTERVAL) -> Profiler:
+    """Start the process-wide session, finishing the previous one."""
+    global _session, _atexit_registered
+    finish()
+    _session = Profiler(mode, output_dir, name, interval)
+    if not _atexit_registered:
+        # Registered after logging is set up, so it runs while the log writer still works
+        atexit.register(finish)
+        _atexit_registered = True
+    return _session
+
+
+@contextmanager
+def _tracked(name: str):
+    _in_stage.active = True
+    try:
+        with _session.stage(name):
+            yield
+    finally:
+        _in_stage.active = False
+
+
+def stage(name: str):
+    """Context manager profiling one stage; does nothing without a session or inside another stage of this thread."""
+    if _session is None or getattr(_in_stage, 'active', False):
+        return nullcontext()
+    return _tracked(name)
+
+
+def finish():
+    global _session
+    if _session is not None:
+        session, _session = _session, None
+        session.finish()
+
+
+def add_cli_arguments(parser):
+    parser.add_argument('--profile', nargs='?', const='full', choices=MODES,
+                        help="Profile each stage: full (cProfile + tracemalloc, slow) or sample (stack sampling, cheap). "
+                             "A bare --profile means full. Overrides config 'profile'")
+    parser.add_argument('--profile-dir', help=f"Directory for the profile reports. Overrides config 'profile_dir' (default {DEFAULT_DIR})")
+    parser.add_argument('--profile-interval', type=float,
+                        help=f"Seconds between stack samples in sample mode. Overrides config 'profile_interval' (default {DEFAULT_INTERVAL})")
+
+
+def disable(reason: str):
+    """Start no more sessions in this process; setup_from_args logs the reason instead."""
+    global _disabled
+    _disabled = reason
+
+
+def setup_from_args(args, config: dict = None, name: str = 'run'):
+    """Start a session if --profile (or config 'profile') asks for one."""
+    config = config or {}
+    mode = getattr(args, 'profile', None) or config.get('profile')
+    if not mode:
+        return None
+    if _disabled:
+        logging.warning(f"profile: Not profiling {name}: {_disabled}")
+        return None
+    if mode not in MODES:
+        logging.error(f"profile must be one of {MODES}, got '{mode}'.")
+        sys.exit(1)
+    return start(mode, getattr(args, 'profile_dir', None) or config.get('profile_dir', DEFAULT_DIR), name,
+                 float(getattr(args, 'profile_interval', None) or config.get('profile_interval', DEFAULT_INTERVAL)))
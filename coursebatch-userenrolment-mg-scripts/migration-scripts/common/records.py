@@ -0,0 +1,130 @@
+"""
+Compact in-memory records for the migration scripts.
+
+A million-row input used to be held as a million dicts with the same keys,
+each with its own copy of the course code, course id and name, batch name and
+id, learner profile code and date -- values shared by thousands of rows. The
+records here are slotted classes (no per-row dict: one pointer per field), and
+the fields that repeat across rows are passed through sys.intern, so every
+distinct value is stored once for the whole run.
+
+They are slotted dataclasses that read like the dicts they replace --
+record['userId'], record.get(...), dict(record), csv.DictWriter -- so the
+stages take either. Treat them as read-only; a stage that needs a changed
+record builds a new one.
+
+    Enrolment      an output row of generate (process_csv.OUTPUT_FIELDS)
+    PlannedWrite   an Enrolment plus sourceRecords (process_csv.plan_writes)
+    PreparedRow    a validated input row: email, learnerProfileCode, entries
+    CourseBatch    a course batch input row: courseId, batchId, start_date
+"""
+import sys
+from collections.abc import Mapping
+from dataclasses import dataclass, fields
+
+_intern = sys.intern
+
+
+def intern(value):
+    """sys.intern for strings; anything else (None, numbers) as it is."""
+    return _intern(value) if type(value) is str else value
+
+
+class Record(Mapping):
+    """Base of the records: a mapping of FIELDS to values, FIELDS being the dataclass fields."""
+    __slots__ = ()
+    FIELDS = ()
+    # Fields whose values repeat across rows
+    INTERNED = ()
+
+    def __post_init__(self):
+        for field in self.INTERNED:
+            value = getattr(self, field)
+            if type(value) is str:
+                setattr(self, field, _intern(value))
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """Build from a dict (CSV row, JSON object); other keys are dropped, missing fields are ''."""
+        if isinstance(mapping, cls):
+            return mapping
+        get = mapping.get
+        return cls(*[get(field, '') for field in cls.FIELDS])
+
+    def __getitem__(self, field):
+        if field in self._KEYS:
+            return getattr(self, field)
+        raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self._KEYS else default
+
+    def keys(self):
+        return self._KEYS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __reduce__(self):
+        # Rebuilt through __init__, so records prepared in another process (--ingest parallel) are interned here too
+        return type(self), tuple(getattr(self, field) for field in self.FIELDS)
+
+
+def record(cls):
+    """Class decorator for the records: a slotted dataclass of the annotated fields, in order."""
+    cls = dataclass(slots=True, eq=False)(cls)
+    cls.FIELDS = tuple(field.name for field in fields(cls))
+    # An ordered, set-like keys() shared by every record of the class (csv.DictWriter subtracts it)
+    cls._KEYS = dict.fromkeys(cls.FIELDS).keys()
+    return cls
+
+
+@record
+class Enrolment(Record):
+    email: str = ''
+    userId: str = ''
+    userName: str = ''
+    learnerProfileCode: str = ''
+    courseCode: str = ''
+    courseId: str = ''
+    courseName: str = ''
+    batchName: str = ''
+    batchId: str = ''
+    completedOn: str = ''
+    INTERNED = ('learnerProfileCode', 'courseCode', 'courseId', 'courseName', 'batchName', 'batchId', 'completedOn')
+
+
+@record
+class PlannedWrite(Enrolment):
+    sourceRecords: int = 1
+
+
+@record
+class PreparedRow(Record):
+    """entries holds (course code, completedOn) pairs; kept as a tuple of tuples."""
+    email: str = ''
+    learnerProfileCode: str = ''
+    entries: tuple = ()
+    INTERNED = ('learnerProfileCode',)
+
+    def __post_init__(self):
+        Record.__post_init__(self)
+        self.entries = tuple([(_intern(code), _intern(completed_on)) for code, completed_on in self.entries])
+
+
+@record
+class CourseBatch(Record):
+    courseId: str = ''
+    batchId: str = ''
+    start_date: str = ''
+    INTERNED = ('courseId', 'start_date')
+
+
+def to_json(value):
+    """json.dumps default= for records."""
+    if isinstance(value, Record):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
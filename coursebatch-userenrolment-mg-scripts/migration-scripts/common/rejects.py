@@ -0,0 +1,170 @@
+"""
+Failure journal (rejects file) for the migration stages.
+
+Every row a stage gives up on -- a user/course/batch lookup, a Cassandra write,
+a course batch API call, an Elasticsearch delete, a Kafka send -- is appended
+to the run's rejects file as one JSON line:
+
+    {"stage": "update", "row": {...}, "error": "WriteTimeout", "status": null,
+     "kind": "transient", "message": "...", "context": {...}, "at": "..."}
+
+row holds what the stage needs to process the row again, context the settings
+it was processed with (output CSV, ES host, Kafka topic and ledger). kind
+separates failures worth retrying as they are (timeouts, connection errors,
+HTTP 408/429/5xx, Cassandra Unavailable, retriable Kafka errors) from permanent
+ones (other HTTP 4xx, lookups without a match, rejected CQL) that fail the
+same way until the data is fixed. Errors it cannot place count as
+transient, so the default retry leaves nothing recoverable behind.
+
+`python migrate.py retry-failed --rejects <file>` reprocesses only those rows
+(see retry_failed.py). Each run starts its file afresh, so an empty file means
+nothing failed. Default path: <rejects_dir>/<script>-<command>.ndjson; config
+rejects_dir (default data/rejects), --rejects overrides the file.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+
+DEFAULT_DIR = 'data/rejects'
+TRANSIENT_STATUSES = {408, 425, 429}
+# Matched against the exception's class and its bases, so the drivers need not be importable here
+TRANSIENT_ERRORS = {
+    'TimeoutError', 'ConnectionError', 'Timeout', 'ChunkedEncodingError',                      # builtins, requests
+    'OperationTimedOut', 'Unavailable', 'NoHostAvailable', 'CoordinationFailure', 'OverloadedErrorMessage',  # cassandra-driver
+    'KafkaTimeoutError', 'KafkaConnectionError', 'NodeNotReadyError',                           # kafka-python
+}
+# Failures the scripts detect themselves
+PERMANENT_ERRORS = {'NotFound'}
+
+_journal = None
+_atexit_registered = False
+
+
+def error_status(error) -> int:
+    """HTTP status carried by a requests exception, if any."""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def classify(error=None, status: int = None) -> str:
+    """'transient' or 'permanent' for an exception (or the name of a failure) and/or an HTTP status."""
+    status = status or error_status(error)
+    if status:
+        if status in TRANSIENT_STATUSES or status >= 500:
+            return 'transient'
+        if status >= 400:
+            return 'permanent'
+    if isinstance(error, str):
+        return 'permanent' if error in PERMANENT_ERRORS else 'transient'
+    retriable = getattr(error, 'retriable', None)
+    if isinstance(retriable, bool):  # kafka-python errors say so themselves
+        return 'transient' if retriable else 'permanent'
+    if error is not None and not any(cls.__name__ in TRANSIENT_ERRORS for cls in type(error).__mro__):
+        # Left to classify: driver errors such as InvalidRequest or Unauthorized, and bad responses
+        if type(error).__module__.split('.')[0] in ('cassandra', 'kafka'):
+            return 'permanent'
+    return 'transient'
+
+
+class Journal:
+    """Append-only NDJSON file of rejected rows. One unbuffered O_APPEND write per row, so threads
+    (Kafka callbacks) and forked producer processes can share it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        open(path, 'wb').close()
+        self._file = open(path, 'ab', buffering=0)
+        self._lock = threading.Lock()
+
+    def add(self, entry: dict):
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line.encode('utf-8'))
+
+    def close(self) -> Counter:
+        """Close the file and log what it holds. Returns the counts per (stage, kind)."""
+        with self._lock:
+            if self._file.closed:
+                return Counter()
+            self._file.close()
+        # Counted from the file, which forked processes wrote to as well
+        counts = Counter((entry['stage'], entry['kind']) for entry in read(self.path))
+        if not counts:
+            logging.info(f"rejects: No rows rejected ({self.path} is empty)")
+            return counts
+        kinds = Counter()
+        for (_, kind), count in counts.items():
+            kinds[kind] += count
+        logging.warning(f"rejects: {sum(counts.values())} rows rejected ({kinds['transient']} transient, {kinds['permanent']} permanent) "
+                        f"written to {self.path}: " + ', '.join(f"{stage}/{kind}={count}" for (stage, kind), count in sorted(counts.items())))
+        logging.warning(f"rejects: Retry them with: python migrate.py retry-failed --rejects {self.path} --dry_run false")
+        return counts
+
+
+def record(stage: str, row: dict, error=None, status: int = None, message: str = None, context: dict = None):
+    """Journal a row `stage` could not process. error is the exception or the name of the failure; does nothing without a journal."""
+    if _journal is None:
+        return
+    status = status or error_status(error)
+    _journal.add({
+        'stage': stage,
+        'row': row,
+        'error': type(error).__name__ if isinstance(error, BaseException) else error or ('HTTPError' if status else None),
+        'status': status,
+        'kind': classify(error, status),
+        'message': (message if message is not None else str(error or ''))[:500],
+        'context': context or {},
+        'at': datetime.now().isoformat(timespec='seconds'),
+    })
+
+
+def carry(entry: dict):
+    """Copy an entry of an earlier journal unchanged (rows retry-failed leaves for later)."""
+    if _journal is not None:
+        _journal.add(entry)
+
+
+def read(path: str) -> list:
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    return entries
+
+
+def open_journal(path: str) -> Journal:
+    """Start the process-wide journal (emptying the file), closing the previous one."""
+    global _journal, _atexit_registered
+    close()
+    _journal = Journal(path)
+    if not _atexit_registered:
+        atexit.register(close)
+        _atexit_registered = True
+    return _journal
+
+
+def close() -> Counter:
+    """Close the journal; returns its counts per (stage, kind)."""
+    global _journal
+    if _journal is None:
+        return Counter()
+    journal, _journal = _journal, None
+    return journal.close()
+
+
+def add_cli_arguments(parser):
+    parser.add_argument('--rejects', help=f"Rejects file the rows that fail are journaled to. Default: <config 'rejects_dir' or {DEFAULT_DIR}>/<script>-<command>.ndjson")
+
+
+def setup_from_args(args, config: dict = None, name: str = 'run') -> Journal:
+    config = config or {}
+    path = getattr(args, 'rejects', None) or os.path.join(config.get('rejects_dir') or DEFAULT_DIR, f"{name}.ndjson")
+    return open_journal(path)
@@ -0,0 +1,147 @@
+"""
+Read-back verification of the Cassandra updates.
+
+The rows a run meant to write are grouped by partition key and each partition
+is read with one prepared SELECT. Up to `concurrency` SELECTs are in flight at
+once (execute_async with a sliding window), so a 200k-row migration is checked
+in the time of a few thousand round trips. Only the rows that differ from the
+plan, are missing or could not be read are written to the report CSV.
+"""
+import csv
+import logging
+import os
+import sys
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+from common import metrics
+
+DEFAULT_CONCURRENCY = 64
+REPORT_FIELDS = ['table', 'userid', 'courseid', 'batchid', 'field', 'expected', 'actual', 'problem']
+
+
+def normalize_timestamp(value) -> str:
+    """'YYYY-MM-DD HH:MM:SS' for a driver datetime or a timestamp / date string; '' for null."""
+    if value is None or value == '':
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    text = str(value).strip().replace('T', ' ')
+    # Drop fractions and offsets ('2024-01-05 00:00:00.000Z', '+0000'); the updates write UTC midnights
+    text = text[:19]
+    return text if len(text) > 10 else f"{text} 00:00:00"
+
+
+def is_empty(value) -> bool:
+    return value is None or (hasattr(value, '__len__') and len(value) == 0)
+
+
+def cassandra_session(host: str, port: int, keyspace: str):
+    try:
+        import cassandra.cluster  # noqa: F401
+    except ImportError:
+        logging.error("cassandra-driver is not installed. Run 'pip install cassandra-driver' to verify the updates.")
+        sys.exit(1)
+    from common import connections
+    try:
+        return connections.cassandra_session(host, port, keyspace)
+    except Exception as e:
+        logging.error(f"[CASSANDRA] Connection failed: {e}")
+        sys.exit(1)
+
+
+def read_partitions(session, query: str, partitions: Iterable[tuple], concurrency: int = DEFAULT_CONCURRENCY):
+    """Yield (partition, rows or exception) for each partition key, in order, with up to `concurrency` reads in flight."""
+    statement = session.prepare(query)
+    window = deque()
+
+    def collect():
+        partition, future = window.popleft()
+        try:
+            return partition, list(future.result())
+        except Exception as e:
+            return partition, e
+
+    for partition in partitions:
+        window.append((partition, session.execute_async(statement, partition)))
+        if len(window) >= concurrency:
+            yield collect()
+    while window:
+        yield collect()
+
+
+def group_by_partition(entries: Iterable[Tuple[tuple, tuple, Dict[str, Any]]]) -> 'OrderedDict[tuple, Dict[tuple, Dict[str, Any]]]':
+    """(partition key, clustering key, expected columns) entries grouped by partition, partitions in sorted order."""
+    grouped = OrderedDict()
+    for partition, key, columns in sorted(entries, key=lambda entry: entry[0] + entry[1]):
+        grouped.setdefault(partition, {})[key] = columns
+    return grouped
+
+
+def verify_partitions(session, table: str, query: str, expected: 'OrderedDict[tuple, Dict[tuple, Dict[str, Any]]]',
+                      partition_columns: tuple, clustering_columns: tuple, checks: Dict[str, Callable[[Any, Any], bool]],
+                      report_path: str, concurrency: int = DEFAULT_CONCURRENCY) -> Counter:
+    """
+    Compare every expected row with what Cassandra returns and write the differences to report_path.
+
+    expected maps partition key -> {clustering key -> {column: expected value}} (see group_by_partition);
+    query selects one partition with the key as its parameters. checks[column](expected, actual) says
+    whether a value matches. Returns the counts of verified, mismatched, missing and unread rows.
+    """
+    counts = Counter()
+    progress = metrics.stage('verify', total=sum(len(rows) for rows in expected.values()))
+    next_log = 10000
+    dir_name = os.path.dirname(report_path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    with open(report_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+
+        def report(partition, key, problem, field='', expected_value='', actual=''):
+            entry = dict(zip(partition_columns + clustering_columns, partition + key))
+            entry.update({'table': table, 'field': field, 'expected': expected_value, 'actual': actual, 'problem': problem})
+            writer.writerow(entry)
+
+        for partition, result in read_partitions(session, query, expected.keys(), concurrency):
+            wanted = expected[partition]
+            if isinstance(result, Exception):
+                logging.error(f"[VERIFY] Read failed for {table} partition {partition}: {result}")
+                for key in wanted:
+                    report(partition, key, f"read_failed: {type(result).__name__}")
+                counts['unread'] += len(wanted)
+                progress.fail(len(wanted))
+                continue
+            found = {tuple(str(getattr(row, column)) for column in clustering_columns): row for row in result}
+            for key, columns in wanted.items():
+                row = found.get(key)
+                if row is None:
+                    report(partition, key, 'missing')
+                    counts['missing'] += 1
+                    progress.fail()
+                    continue
+                differences = [(column, value, getattr(row, column)) for column, value in columns.items()
+                               if not checks[column](value, getattr(row, column))]
+                for column, value, actual in differences:
+                    report(partition, key, 'mismatch', column, value, actual)
+                if differences:
+                    counts['mismatched'] += 1
+                    progress.fail()
+                else:
+                    counts['verified'] += 1
+                    progress.ok()
+            if progress.done >= next_log:
+                logging.info(f"verify: Checked {progress.done} rows so far... {progress.status()}")
+                next_log += 10000
+    logging.info(f"verify: {table}: {counts['verified']} rows match, {counts['mismatched']} differ, {counts['missing']} missing, "
+                 f"{counts['unread']} unread {progress.status()}; report written to {report_path}")
+    return counts
+
+
+def split_host_port(url: str, default_port: int = 9042) -> Tuple[str, int]:
+    url = url.replace('cassandra://', '')
+    if ':' in url:
+        host, port = url.rsplit(':', 1)
+        return host, int(port)
+    return url, default_port
@@ -1,34 +1,30 @@
 # NOTE: Run this script from the project root (migration-scripts) for all default paths to work.
 import csv
-import yaml
 import logging
 import os
 import sys
 
 import argparse
-import requests
 from datetime import datetime
 from typing import List, Dict, Any, Tuple, Set
-from logging.handlers import RotatingFileHandler
 
-# Setup logging to file and console
-log_file = os.path.join(os.path.dirname(__file__), 'course_batch_update.log')
-log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=2)
-file_handler.setFormatter(log_formatter)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import connections, dryrun, logging_setup, metrics, profiling, records, rejects, verify
+from common.dates import DateNormalizer
+
+LOG_FILE = os.path.join(os.path.dirname(__file__), 'course_batch_update.log')
+DRY_RUN_PLAN = os.path.join(os.path.dirname(__file__), 'course_batch_dry_run_plan.ndjson')
 
 import time
 import json
 
 import platform
 
-def update_cassandra_start_date(courseId, batchId, start_date, config, dry_run):
+def update_cassandra_start_date(courseId, batchId, start_date, config, dry_run, plan=None):
     """
     Update start_date in Cassandra for the given courseId and batchId.
-    Uses config['cassandra'] for connection details.
+    Uses config['cassandra'] for connection details. In a dry run the query goes to `plan` when given.
+    Returns the exception of a failed update, None otherwise.
     """
     cassandra_cfg = config.get('cassandra', {})
     keyspace = cassandra_cfg.get('keyspace', 'sunbird_courses')
@@ -37,25 +33,29 @@ def update_cassandra_start_date(courseId, batchId, start_date, config, dry_run):
     cassandra_port = cassandra_cfg.get('port', 9042)
     query = f"UPDATE {keyspace}.{table} SET start_date = '{start_date}' WHERE courseid='{courseId}' AND batchid='{batchId}';"
     if dry_run:
-        logging.info(f"[DRY RUN] Would execute Cassandra query: {query}")
+        if plan is not None:
+            plan.add(f"UPDATE {table}", cql=query)
+        else:
+            logging.info(f"[DRY RUN] Would execute Cassandra query: {query}")
     else:
         try:
-            from cassandra.cluster import Cluster
             import traceback
-            logging.info(f"[CASSANDRA] About to execute: {query}")
-            logging.info(f"[CASSANDRA] start_date type: {type(start_date)}, value: {start_date}")
-            cluster = Cluster([cassandra_url], port=cassandra_port)
-            session = cluster.connect(keyspace)
-            session.execute(query)
-            logging.info(f"[CASSANDRA] Executed: {query}")
-            session.shutdown()
-            cluster.shutdown()
+            logging.debug(f"[CASSANDRA] About to execute: {query}")
+            logging.debug(f"[CASSANDRA] start_date type: {type(start_date)}, value: {start_date}")
+            # One session for all rows (and all jobs of a worker) instead of a new cluster per row
+            session = connections.cassandra_session(cassandra_url, cassandra_port, keyspace)
+            metrics.execute_cassandra(session, query, table=table)
+            if logging_setup.sample('cassandra_execute'):
+                logging.info(f"[CASSANDRA] Executed: {query}")
         except Exception as e:
             logging.error(f"[CASSANDRA] Failed: {query} | Error: {repr(e)}\nTraceback: {traceback.format_exc()}")
+            return e
+    return None
 
 # Removed: cassandra imports and logic
 
 def load_config(path: str) -> dict:
+    import yaml
     if not os.path.exists(path):
         print(f"\nERROR: Config file '{path}' not found.")
         print("Make sure you are running this command from the project root and using the correct --config path (e.g., 'config.yaml').\n")
@@ -63,14 +63,10 @@ def load_config(path: str) -> dict:
     with open(path, 'r') as f:
         return yaml.safe_load(f)
 
-def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)s %(message)s',
-        handlers=[logging.StreamHandler(sys.stdout)]
-    )
+def setup_logging(config: dict = None):
+    logging_setup.setup_logging(LOG_FILE, config)
 
-def parse_csv(input_path: str) -> List[Dict[str, Any]]:
+def parse_csv(input_path: str) -> List[records.CourseBatch]:
     """
     Reads and cleans the input CSV, removing trailing spaces from all fields in all rows.
     Maps relevant columns to expected keys for processing. Adds robust validation and logs summary.
@@ -81,38 +77,40 @@ def parse_csv(input_path: str) -> List[Dict[str, Any]]:
     seen = set()
     with open(input_path, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
-        count = 0
-        for idx, row in enumerate(reader, 1):
-            # Remove trailing spaces from all fields
-            clean_row = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items()}
-            # Check required fields
-            missing = [f for f in required_fields if not clean_row.get(f)]
-            if missing:
-                logging.warning(f"Row {idx} skipped: missing required fields: {missing} | {clean_row}")
-                skipped += 1
-                continue
-            # Parse and validate date
-            parsed_date = convert_date(clean_row['Start Date'])
-            if not parsed_date:
-                logging.warning(f"Row {idx} skipped: invalid Start Date '{clean_row['Start Date']}' | {clean_row}")
-                skipped += 1
-                continue
-            # Check for duplicates (courseId, batchId)
-            key = (clean_row['Course ID'], clean_row['Batch ID'])
-            if key in seen:
-                logging.warning(f"Row {idx} skipped: duplicate Course ID/Batch ID: {key}")
-                skipped += 1
-                continue
-            seen.add(key)
-            mapped_row = {
-                'courseId': clean_row['Course ID'],
-                'batchId': clean_row['Batch ID'],
-                'start_date': parsed_date,
-            }
-            rows.append(mapped_row)
-            count += 1
-            if count % 100 == 0:
-                logging.info(f"parse_csv: Processed {count} valid records so far...")
+        # Remove trailing spaces from all fields
+        clean_rows = [{k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items()} for row in reader]
+    # Date format order is inferred once for the Start Date column
+    date_normalizer = DateNormalizer.for_values(r.get('Start Date') for r in clean_rows)
+    count = 0
+    for idx, clean_row in enumerate(clean_rows, 1):
+        # Check required fields
+        missing = [f for f in required_fields if not clean_row.get(f)]
+        if missing:
+            logging.warning(f"Row {idx} skipped: missing required fields: {missing} | {clean_row}")
+            skipped += 1
+            continue
+        # Parse and validate date
+        parsed_date = date_normalizer.convert(clean_row['Start Date'])
+        if not parsed_date:
+            logging.warning(f"Row {idx} skipped: invalid Start Date '{clean_row['Start Date']}' | {clean_row}")
+            skipped += 1
+            continue
+        # Check for duplicates (courseId, batchId)
+        key = (clean_row['Course ID'], clean_row['Batch ID'])
+        if key in seen:
+            logging.warning(f"Row {idx} skipped: duplicate Course ID/Batch ID: {key}")
+            skipped += 1
+            continue
+        seen.add(key)
+        mapped_row = records.CourseBatch(
+            courseId=clean_row['Course ID'],
+            batchId=clean_row['Batch ID'],
+            start_date=parsed_date,
+        )
+        rows.append(mapped_row)
+        count += 1
+        if count % 100 == 0:
+            logging.info(f"parse_csv: Processed {count} valid records so far...")
     logging.info(f"parse_csv: Total valid records processed: {count}")
     logging.info(f"parse_csv: Total rows skipped due to errors: {skipped}")
     return rows
@@ -120,30 +118,120 @@ def parse_csv(input_path: str) -> List[Dict[str, Any]]:
 
 # write_csv removed as per simplification request
 
-def convert_date(date_str: str) -> str:
+BATCH_STATE_SOURCES = ('api', 'cassandra', 'none')
+# courseIds per batch/list request and batches per page
+BATCH_LIST_COURSES = 50
+BATCH_LIST_PAGE = 500
+STEPS = ('CASSANDRA_START_DATE', 'REMOVE_TEMPLATE', 'ADD_TEMPLATE', 'UPDATE_START_DATE')
+
+def fetch_batch_states_api(course_ids: List[str], config: dict) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Current templates, start date, status and enrollment type of every batch of the courses, from batch/list."""
+    url = f"{config['host']}/api/course/v1/batch/list"
+    headers = {
+        'Authorization': f"Bearer {config['apikey']}",
+        'Content-Type': 'application/json',
+        'x-authenticated-user-token': config['creator_access_token'],
+        'X-Channel-Id': config['channel_id'],
+    }
+    states = {}
+    for start in range(0, len(course_ids), BATCH_LIST_COURSES):
+        chunk = course_ids[start:start + BATCH_LIST_COURSES]
+        offset = 0
+        while True:
+            data = {
+                "request": {
+                    "filters": {"courseId": chunk},
+                    "fields": ["identifier", "courseId", "startDate", "status", "enrollmentType", "certTemplates"],
+                    "limit": BATCH_LIST_PAGE,
+                    "offset": offset,
+                }
+            }
+            try:
+                resp = metrics.call_api('batch_list', connections.http().post, url, headers=headers, json=data, timeout=30)
+                resp.raise_for_status()
+                response = resp.json().get('result', {}).get('response', {})
+            except Exception as e:
+                # Those batches get every step, as without a prefetch
+                logging.warning(f"[PREFETCH] batch/list failed for {len(chunk)} courses, their batches are updated in full: {e}")
+                break
+            content = response.get('content', [])
+            for batch in content:
+                states[(batch.get('courseId'), batch.get('identifier'))] = {
+                    'templates': set((batch.get('certTemplates') or {}).keys()),
+                    'start_date': batch.get('startDate'),
+                    'status': batch.get('status'),
+                    'enrollment_type': batch.get('enrollmentType'),
+                }
+            offset += len(content)
+            if not content or offset >= response.get('count', 0):
+                break
+    return states
+
+def fetch_batch_states_cassandra(course_ids: List[str], config: dict) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """The same state read from course_batch, one SELECT per courseid partition."""
+    cassandra_cfg = config.get('cassandra', {})
+    keyspace = cassandra_cfg.get('keyspace', 'sunbird_courses')
+    table = cassandra_cfg.get('course_batch_table', 'course_batch')
+    host, port = verify.split_host_port(cassandra_cfg.get('connection_url', 'localhost'), cassandra_cfg.get('port', 9042))
+    session = verify.cassandra_session(host, port, keyspace)
+    query = f"SELECT batchid, cert_templates, start_date, status, enrollmenttype FROM {keyspace}.{table} WHERE courseid = ?"
+    states = {}
+    for (course_id,), result in verify.read_partitions(session, query, [(course_id,) for course_id in course_ids],
+                                                        int(config.get('verify_concurrency', verify.DEFAULT_CONCURRENCY))):
+        if isinstance(result, Exception):
+            logging.warning(f"[PREFETCH] course_batch read failed for courseId={course_id}, its batches are updated in full: {result}")
+            continue
+        for row in result:
+            states[(course_id, str(row.batchid))] = {
+                'templates': set((row.cert_templates or {}).keys()),
+                'start_date': row.start_date,
+                'status': row.status,
+                'enrollment_type': row.enrollmenttype,
+            }
+    return states
+
+def fetch_batch_states(rows: List[Dict[str, Any]], config: dict, source: str = 'api') -> Dict[Tuple[str, str], Dict[str, Any]]:
+    if source == 'none':
+        return {}
+    course_ids = sorted({row['courseId'] for row in rows})
+    if source == 'cassandra':
+        states = fetch_batch_states_cassandra(course_ids, config)
+    else:
+        states = fetch_batch_states_api(course_ids, config)
+    found = sum(1 for row in rows if (row['courseId'], row['batchId']) in states)
+    logging.info(f"fetch_batch_states: Current state of {found}/{len(rows)} batches read from {source} for {len(course_ids)} courses")
+    return states
+
+def pending_steps(state: Dict[str, Any], start_date: str, template_id: str, remove_template_identifier: str,
+                  source: str = 'api') -> Set[str]:
     """
-    Robustly parse a date string in common user formats and return 'YYYY-MM-DD 00:00:00'.
-    Accepts e.g. '1/3/2024', '01/03/2024', '2024-03-01', '2024/03/01', etc.
-    Returns empty string if invalid.
+    The steps a batch still needs; all of them when its state is unknown. A state read from Cassandra
+    never skips the batch/update call: its start_date is the column CASSANDRA_START_DATE writes
+    directly, so it matches after a run whose API update then failed.
     """
-    if not date_str or not isinstance(date_str, str):
-        return ''
-    date_str = date_str.strip()
-    for fmt in ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%Y/%m/%d", "%d/%m/%y", "%d-%m-%y"):
-        try:
-            dt = datetime.strptime(date_str, fmt)
-            return dt.strftime("%Y-%m-%d 00:00:00")
-        except Exception:
-            continue
-    logging.warning(f"Could not parse date: '{date_str}'")
-    return ''
+    if state is None:
+        return set(STEPS)
+    steps = set()
+    same_date = verify.normalize_timestamp(state['start_date'])[:10] == start_date[:10]
+    if not same_date:
+        steps.add('CASSANDRA_START_DATE')
+    if remove_template_identifier in state['templates']:
+        steps.add('REMOVE_TEMPLATE')
+    if template_id not in state['templates']:
+        steps.add('ADD_TEMPLATE')
+    # The update also opens the batch; unknown values are not held against it
+    if (source == 'cassandra' or not same_date
+            or state['status'] not in (None, 1) or state['enrollment_type'] not in (None, 'open')):
+        steps.add('UPDATE_START_DATE')
+    return steps
 
-def update_batches_via_api(rows: List[Dict[str, Any]], config: dict, dry_run: bool):
+def update_batches_via_api(rows: List[Dict[str, Any]], config: dict, dry_run: bool, batch_state: str = 'api'):
     """
     For each row, call the following APIs in order:
     1. Remove the old template
     2. Add the new template
     3. Update the start date
+    Steps the batch's current state (batch_state: read from 'api', 'cassandra' or 'none') shows as done are skipped.
     """
     import ast
     import copy
@@ -167,124 +255,228 @@ def update_batches_via_api(rows: List[Dict[str, Any]], config: dict, dry_run: bo
     if 'signatoryList' in template_for_add and isinstance(template_for_add['signatoryList'], str):
         template_for_add['signatoryList'] = json.loads(template_for_add['signatoryList'])
     remove_template_identifier = config['remove_template_identifier']
-    for idx, row in enumerate(rows, 1):
-        courseId = row['courseId']
-        batchId = row['batchId']
-        start_date = row['start_date']
-        # --- Cassandra update step ---
-        update_cassandra_start_date(courseId, batchId, start_date, config, dry_run)
+    # Reruns only touch the steps a batch still needs (also in a dry run, so its plan shows them)
+    states = fetch_batch_states(rows, config, batch_state)
+    skipped = {step: 0 for step in STEPS}
+    untouched = 0
+    progress = metrics.stage('update_batches', total=len(rows))
+    plan = dryrun.PlanWriter.from_config(config, DRY_RUN_PLAN) if dry_run else None
+    try:
+        for idx, row in enumerate(rows, 1):
+            row_ok = True
+            courseId = row['courseId']
+            batchId = row['batchId']
+            start_date = row['start_date']
+            steps = pending_steps(states.get((courseId, batchId)), start_date, template_id, remove_template_identifier, batch_state)
+            for step in STEPS:
+                if step not in steps:
+                    skipped[step] += 1
+            if not steps:
+                untouched += 1
+                progress.ok()
+                continue
+            # The first failed step of the row goes to the rejects file; a retry reruns the row
+            failure = None
+            # --- Cassandra update step ---
+            if 'CASSANDRA_START_DATE' in steps:
+                error = update_cassandra_start_date(courseId, batchId, start_date, config, dry_run, plan)
+                if error is not None:
+                    row_ok = False
+                    failure = ('CASSANDRA_START_DATE', {'error': error})
 
-        # --- 1. Remove old template ---
-        remove_url = f"{host}/api/course/batch/cert/v1/template/remove"
-        remove_headers = {
-            'Authorization': f"Bearer {apikey}",
-            'Content-Type': 'application/json',
-            'x-authenticated-user-token': creator_access_token
-        }
-        remove_payload = {
-            "request": {
-                "batch": {
-                    "courseId": courseId,
-                    "batchId": batchId,
-                    "template": {"identifier": remove_template_identifier}
-                }
+            # --- 1. Remove old template ---
+            remove_url = f"{host}/api/course/batch/cert/v1/template/remove"
+            remove_headers = {
+                'Authorization': f"Bearer {apikey}",
+                'Content-Type': 'application/json',
+                'x-authenticated-user-token': creator_access_token
             }
-        }
-        # --- 2. Add new template ---
-        add_url = f"{host}/api/course/batch/cert/v1/template/add"
-        add_headers = remove_headers.copy()
-        add_payload = {
-            "request": {
-                "batch": {
-                    "courseId": courseId,
-                    "batchId": batchId,
-                    "template": template_for_add
+            remove_payload = {
+                "request": {
+                    "batch": {
+                        "courseId": courseId,
+                        "batchId": batchId,
+                        "template": {"identifier": remove_template_identifier}
+                    }
                 }
             }
-        }
-        # --- 3. Update start date ---
-        update_url = f"{host}/api/course/v1/batch/update"
-        update_headers = {
-            'Authorization': f"Bearer {apikey}",
-            'Content-Type': 'application/json',
-            'x-authenticated-user-token': creator_access_token,
-            'X-Channel-Id': channel_id
-        }
-        # Convert start_date to ISO format
-        start_date = row['start_date']
-        try:
-            dt = datetime.strptime(start_date, "%Y-%m-%d 00:00:00")
-            # Try multiple ISO 8601 formats for API
-            iso_start_date = dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-            iso_start_date_alt = dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")
-        except Exception:
-            iso_start_date = start_date  # fallback
-            iso_start_date_alt = start_date
-        # Try both formats in API call
-        iso_start_dates = [iso_start_date, iso_start_date_alt]
-        # --- Execute or print (dry_run) ---
-        for step, url, headers, payload in [
-            ("REMOVE_TEMPLATE", remove_url, remove_headers, remove_payload),
-            ("ADD_TEMPLATE", add_url, add_headers, add_payload)
-        ]:
-            if dry_run:
-                logging.info(f"[DRY RUN] {step} {url}\nPayload: {json.dumps(payload, ensure_ascii=False)}")
-            else:
-                try:
-                    resp = requests.patch(url, headers=headers, json=payload, timeout=15)
-                    if resp.ok:
-                        logging.info(f"[SUCCESS] {step} for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Input: {json.dumps(payload, ensure_ascii=False)}")
-                    else:
-                        logging.error(f"[FAILURE] {step} for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Input: {json.dumps(payload, ensure_ascii=False)} | Response: {resp.text}")
-                except Exception as e:
-                    logging.error(f"[EXCEPTION] {step} for courseId={courseId}, batchId={batchId} | Input: {json.dumps(payload, ensure_ascii=False)} | Error: {e}")
-        # --- Try both ISO formats for UPDATE_START_DATE ---
-        for iso_date in iso_start_dates:
-            update_payload = {
+            # --- 2. Add new template ---
+            add_url = f"{host}/api/course/batch/cert/v1/template/add"
+            add_headers = remove_headers.copy()
+            add_payload = {
                 "request": {
-                    "enrollmentType": "open",
-                    "startDate": iso_date,
-                    "status": 1,
-                    "courseId": courseId,
-                    "id": batchId
+                    "batch": {
+                        "courseId": courseId,
+                        "batchId": batchId,
+                        "template": template_for_add
+                    }
                 }
             }
-            if dry_run:
-                logging.info(f"[DRY RUN] UPDATE_START_DATE {update_url}\nPayload: {json.dumps(update_payload, ensure_ascii=False)}")
+            # --- 3. Update start date ---
+            update_url = f"{host}/api/course/v1/batch/update"
+            update_headers = {
+                'Authorization': f"Bearer {apikey}",
+                'Content-Type': 'application/json',
+                'x-authenticated-user-token': creator_access_token,
+                'X-Channel-Id': channel_id
+            }
+            # Convert start_date to ISO format
+            start_date = row['start_date']
+            try:
+                dt = datetime.strptime(start_date, "%Y-%m-%d 00:00:00")
+                # Try multiple ISO 8601 formats for API
+                iso_start_date = dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+                iso_start_date_alt = dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+            except Exception:
+                iso_start_date = start_date  # fallback
+                iso_start_date_alt = start_date
+            # Try both formats in API call
+            iso_start_dates = [iso_start_date, iso_start_date_alt]
+            # --- Execute or print (dry_run) ---
+            endpoints = {"REMOVE_TEMPLATE": 'cert_template_remove', "ADD_TEMPLATE": 'cert_template_add'}
+            for step, url, headers, payload in [
+                ("REMOVE_TEMPLATE", remove_url, remove_headers, remove_payload),
+                ("ADD_TEMPLATE", add_url, add_headers, add_payload)
+            ]:
+                if step not in steps:
+                    continue
+                if dry_run:
+                    # The template body is the same for every row; the plan only names it
+                    template = payload['request']['batch']['template'].get('identifier', template_id)
+                    plan.add(step, url=url, courseId=courseId, batchId=batchId, template=template)
+                else:
+                    try:
+                        resp = metrics.call_api(endpoints[step], connections.http().patch, url, headers=headers, json=payload, timeout=15)
+                        if resp.ok:
+                            if logging_setup.sample(step):
+                                logging.info(f"[SUCCESS] {step} for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Input: {json.dumps(payload, ensure_ascii=False)}")
+                        else:
+                            row_ok = False
+                            failure = failure or (step, {'status': resp.status_code, 'message': resp.text})
+                            logging.error(f"[FAILURE] {step} for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Input: {json.dumps(payload, ensure_ascii=False)} | Response: {resp.text}")
+                    except Exception as e:
+                        row_ok = False
+                        failure = failure or (step, {'error': e})
+                        logging.error(f"[EXCEPTION] {step} for courseId={courseId}, batchId={batchId} | Input: {json.dumps(payload, ensure_ascii=False)} | Error: {e}")
+            # --- Try both ISO formats for UPDATE_START_DATE ---
+            start_date_updated = dry_run or 'UPDATE_START_DATE' not in steps
+            update_failure = None
+            for iso_date in (iso_start_dates if 'UPDATE_START_DATE' in steps else []):
+                update_payload = {
+                    "request": {
+                        "enrollmentType": "open",
+                        "startDate": iso_date,
+                        "status": 1,
+                        "courseId": courseId,
+                        "id": batchId
+                    }
+                }
+                if dry_run:
+                    # The alternate ISO format is only a fallback for a failed update
+                    plan.add("UPDATE_START_DATE", url=update_url, courseId=courseId, batchId=batchId, startDate=iso_date)
+                    break
+                else:
+                    try:
+                        resp = metrics.call_api('batch_update', connections.http().patch, update_url, headers=update_headers, json=update_payload, timeout=15)
+                        if resp.ok:
+                            if logging_setup.sample('UPDATE_START_DATE'):
+                                logging.info(f"[SUCCESS] UPDATE_START_DATE for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Input: {json.dumps(update_payload, ensure_ascii=False)}")
+                            start_date_updated = True
+                            break  # Success, stop trying alternate formats
+                        else:
+                            update_failure = ('UPDATE_START_DATE', {'status': resp.status_code, 'message': resp.text})
+                            logging.error(f"[FAILURE] UPDATE_START_DATE for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Attempted startDate: {iso_date} | Input: {json.dumps(update_payload, ensure_ascii=False)} | Response: {resp.text}")
+                    except Exception as e:
+                        update_failure = ('UPDATE_START_DATE', {'error': e})
+                        logging.error(f"[EXCEPTION] UPDATE_START_DATE for courseId={courseId}, batchId={batchId} | Attempted startDate: {iso_date} | Input: {json.dumps(update_payload, ensure_ascii=False)} | Error: {e}")
+            if row_ok and start_date_updated:
+                progress.ok()
             else:
-                try:
-                    resp = requests.patch(update_url, headers=update_headers, json=update_payload, timeout=15)
-                    if resp.ok:
-                        logging.info(f"[SUCCESS] UPDATE_START_DATE for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Input: {json.dumps(update_payload, ensure_ascii=False)}")
-                        break  # Success, stop trying alternate formats
-                    else:
-                        logging.error(f"[FAILURE] UPDATE_START_DATE for courseId={courseId}, batchId={batchId} | Status: {resp.status_code} | Attempted startDate: {iso_date} | Input: {json.dumps(update_payload, ensure_ascii=False)} | Response: {resp.text}")
-                except Exception as e:
-                    logging.error(f"[EXCEPTION] UPDATE_START_DATE for courseId={courseId}, batchId={batchId} | Attempted startDate: {iso_date} | Input: {json.dumps(update_payload, ensure_ascii=False)} | Error: {e}")
-        if idx % 100 == 0:
-            logging.info(f"update_batches_via_api: Processed {idx} records so far...")
-    logging.info(f"update_batches_via_api: Total records processed: {len(rows)}")
+                step, details = failure or update_failure
+                rejects.record('course_batches', {'courseId': courseId, 'batchId': batchId, 'start_date': start_date},
+                               context={'step': step}, **details)
+                progress.fail()
+            if idx % 100 == 0:
+                logging.info(f"update_batches_via_api: Processed {idx} records so far... {progress.status()}")
+    finally:
+        if plan is not None:
+            plan.close()
+    if states:
+        logging.info(f"update_batches_via_api: Already applied: {untouched} batches needed no change; steps skipped: "
+                     + ', '.join(f"{step}={count}" for step, count in skipped.items()))
+    logging.info(f"update_batches_via_api: Total records processed: {len(rows)} {progress.status()}")
+
+def verify_start_dates(rows: List[Dict[str, Any]], config: dict, report_path: str, concurrency: int = verify.DEFAULT_CONCURRENCY):
+    """
+    Read back start_date of every (courseId, batchId), one SELECT per courseid partition of course_batch,
+    and write the batches that are missing or have another start_date to report_path.
+    """
+    cassandra_cfg = config.get('cassandra', {})
+    keyspace = cassandra_cfg.get('keyspace', 'sunbird_courses')
+    table = cassandra_cfg.get('course_batch_table', 'course_batch')
+    expected = verify.group_by_partition(((row['courseId'],), (row['batchId'],), {'start_date': row['start_date']}) for row in rows)
+    logging.info(f"verify_start_dates: Reading back {len(rows)} batches in {len(expected)} partitions ({concurrency} reads in flight)")
+    host, port = verify.split_host_port(cassandra_cfg.get('connection_url', 'localhost'), cassandra_cfg.get('port', 9042))
+    session = verify.cassandra_session(host, port, keyspace)
+    query = f"SELECT batchid, start_date FROM {keyspace}.{table} WHERE courseid = ?"
+    checks = {'start_date': lambda expected_value, actual: verify.normalize_timestamp(actual) == verify.normalize_timestamp(expected_value)}
+    return verify.verify_partitions(session, table, query, expected, ('courseid',), ('batchid',), checks, report_path, concurrency)
 
 # --- Main CLI ---
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Process course batches.')
     parser.add_argument('--input', default='course_batch_update/course_batch_input.csv', help='Input CSV path (default: course_batch_update/course_batch_input.csv)')
     parser.add_argument('--config', default='config.yaml', help='Config YAML path')
     parser.add_argument('--dry-run', default='true', choices=['true', 'false'], help='Dry run (true/false, default: true)')
-    args = parser.parse_args()
-
-    setup_logging()
+    parser.add_argument('--ingest', choices=['rows', 'columnar'], help="Input preparation: 'rows' (default, csv module) or 'columnar' (pyarrow, vectorized; needs pyarrow). Overrides config 'ingest'")
+    parser.add_argument('--batch-state', choices=BATCH_STATE_SOURCES, help="Where the batches' current templates and start dates are read from, to skip the steps already applied: api (batch/list), cassandra (course_batch; the batch/update call is then always sent) or none. Overrides config 'batch_state' (default api)")
+    parser.add_argument('--verify', action='store_true', help='Read start_date of every input batch back from Cassandra and report the differences instead of updating')
+    parser.add_argument('--verify-report', default='course_batch_update/verify_mismatches.csv', help='CSV of the batches that are missing or differ (default: course_batch_update/verify_mismatches.csv)')
+    parser.add_argument('--verify-concurrency', type=int, help=f"SELECTs in flight at once for --verify. Overrides config 'verify_concurrency' (default {verify.DEFAULT_CONCURRENCY})")
+    dryrun.add_cli_arguments(parser)
+    metrics.add_cli_arguments(parser)
+    profiling.add_cli_arguments(parser)
+    rejects.add_cli_arguments(parser)
+    args = parser.parse_args(argv)
 
     config = load_config(args.config)
+    setup_logging(config)
+    metrics.setup_from_args(args, config)
+    profiling.setup_from_args(args, config, 'process_course_batches')
+    dryrun.apply_cli_arguments(args, config)
 
     input_csv = args.input
     dry_run = args.dry_run.lower() == 'true'
 
-    logging.info(f"Reading input from: {input_csv}")
-    rows = parse_csv(input_csv)
+    ingest = args.ingest or config.get('ingest', 'rows')
+    logging.info(f"Reading input from: {input_csv} (ingest={ingest})")
+    with profiling.stage('read'):
+        if ingest == 'columnar':
+            from common import columnar
+            rows = columnar.prepare_course_batches(input_csv)
+        else:
+            rows = parse_csv(input_csv)
+    if args.verify:
+        with profiling.stage('verify'):
+            counts = verify_start_dates(rows, config, args.verify_report,
+                                        args.verify_concurrency or int(config.get('verify_concurrency', verify.DEFAULT_CONCURRENCY)))
+        profiling.finish()
+        metrics.finish_from_args(args)
+        if counts['verified'] < sum(counts.values()):
+            sys.exit(1)
+        return
     logging.info(f"Processing {len(rows)} records...")
-    update_batches_via_api(rows, config, dry_run)
+    batch_state = args.batch_state or config.get('batch_state', 'api')
+    if batch_state not in BATCH_STATE_SOURCES:
+        logging.error(f"batch_state must be one of {BATCH_STATE_SOURCES}, got '{batch_state}'.")
+        sys.exit(1)
+    rejects.setup_from_args(args, config, 'process_course_batches')
+    with profiling.stage('update'):
+        update_batches_via_api(rows, config, dry_run, batch_state)
     logging.info("Processing complete.")
+    rejects.close()
+    profiling.finish()
+    metrics.finish_from_args(args)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
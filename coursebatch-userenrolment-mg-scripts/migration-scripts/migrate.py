@@ -0,0 +1,106 @@
+# NOTE: Run this script from the project root (migration-scripts) for all default paths to work.
+"""
+Single entry point for every migration stage.
+
+    python migrate.py <command> [options]
+
+Each command runs the main() of the script that implements it, with the same
+options (`python migrate.py <command> --help`). Only that script is imported,
+and the scripts import Cassandra, Kafka, YAML and HTTP libraries only when a
+stage uses them, so a pod running one stage does not pay for the others.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+from collections import OrderedDict
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# command -> (script, arguments put before the user's, help)
+COMMANDS = OrderedDict([
+    ('generate', ('user_enrolments_update/process_csv.py', ['generate'], 'Build user_enrolments_output.csv from the enrolment input CSV')),
+    ('plan', ('user_enrolments_update/process_csv.py', ['plan'], 'Write the deduplicated Cassandra write plan')),
+    ('export', ('user_enrolments_update/process_csv.py', ['export'], 'Write cqlsh COPY / DSBulk files instead of updating')),
+    ('update', ('user_enrolments_update/process_csv.py', ['update'], 'Update user_enrolments in Cassandra')),
+    ('verify', ('user_enrolments_update/process_csv.py', ['verify'], 'Read the updated user_enrolments rows back and report the differences')),
+    ('course-batches', ('course_batch_update/process_course_batches.py', [], 'Update course batch certificate templates and start dates')),
+    ('verify-course-batches', ('course_batch_update/process_course_batches.py', ['--verify'], 'Read the course batch start dates back and report the differences')),
+    ('delete-es', ('user_enrolments_update/post_update_ops.py', ['delete-es'], 'Delete the old certificates from Elasticsearch')),
+    ('reconcile-es', ('user_enrolments_update/post_update_ops.py', ['reconcile-es'], 'Check Elasticsearch for certificates delete-es left and re-delete only those')),
+    ('generate-events', ('user_enrolments_update/post_update_ops.py', ['generate-events'], 'Write the certificate generation events')),
+    ('push-kafka', ('user_enrolments_update/post_update_ops.py', ['push-kafka'], 'Push the events to Kafka')),
+    ('post-update', ('user_enrolments_update/post_update_ops.py', ['all'], 'Run delete-es, generate-events and push-kafka in sequence')),
+    ('pipeline', ('pipeline.py', [], 'Run every stage in one process, streaming records between them')),
+    ('retry-failed', ('retry_failed.py', [], 'Reprocess only the rows a run journaled to its rejects file')),
+    ('worker', ('worker.py', [], 'Keep running and take jobs (any command above) over local HTTP or a spool directory')),
+])
+
+# Options every script takes on its top-level parser; moved in front of the script's subcommand
+SHARED_OPTIONS = ('--metrics-port', '--metrics-summary', '--profile', '--profile-dir', '--profile-interval', '--rejects')
+# Shared options whose value may be left out, with the value it defaults to
+OPTIONAL_VALUES = {'--profile': ('full', ('full', 'sample'))}
+
+
+def split_shared_options(args: list):
+    """Split args into (shared options with their values, everything else)."""
+    shared, rest = [], []
+    args = list(args)
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        name = arg.split('=', 1)[0]
+        if name not in SHARED_OPTIONS:
+            rest.append(arg)
+        elif '=' in arg:
+            shared.append(arg)
+        elif name in OPTIONAL_VALUES:
+            # Written as --option=value so it cannot take the subcommand as its value
+            default, values = OPTIONAL_VALUES[name]
+            if i + 1 < len(args) and args[i + 1] in values:
+                i += 1
+                default = args[i]
+            shared.append(f"{name}={default}")
+        else:
+            shared += [arg, args[i + 1] if i + 1 < len(args) else '']
+            i += 1
+        i += 1
+    return shared, rest
+
+
+def load_script(script: str):
+    """Import a script by its path relative to the project root (imported once per process)."""
+    name = os.path.splitext(os.path.basename(script))[0]
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(PROJECT_ROOT, script))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_command(command: str):
+    """Import the script behind a command and return its main()."""
+    return load_script(COMMANDS[command][0]).main
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='migrate.py',
+        description='Migration scripts entry point. Run from the project root.',
+        epilog='Commands:\n' + '\n'.join(f"  {command:22} {help_text}" for command, (_, _, help_text) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command', help='Stage to run (see below)')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Options of the stage (see python migrate.py <command> --help)')
+    args = parser.parse_args(argv)
+    script, prefix, _ = COMMANDS[args.command]
+    # Usage and error messages of the stage name the script that implements it
+    sys.argv[0] = os.path.join(PROJECT_ROOT, script)
+    shared, rest = split_shared_options(args.args)
+    load_command(args.command)(shared + prefix + rest)
+
+
+if __name__ == '__main__':
+    main()
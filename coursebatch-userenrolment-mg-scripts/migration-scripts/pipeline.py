@@ -0,0 +1,312 @@
+# NOTE: Run this script from the project root (migration-scripts) for all default paths to work.
+"""
+Whole migration in one process, as a DAG of stages instead of one Kubernetes Job per step.
+
+    course_batches                                   (templates and start dates)
+    generate -> update -> delete_es -> generate_events -> push_kafka (after course_batches)
+
+Records stream from stage to stage through bounded queues as soon as they are
+resolved: the first Cassandra writes go out while the input is still being
+resolved. update passes on one record per (userId, courseId, batchId), the
+plan_rule winner, once the whole input is read and only if its write went
+through; delete_es passes on only the records it deleted. So a record is only
+deleted from Elasticsearch after its enrolment was updated, and only pushed to
+Kafka after that. A stage whose source stage fails (or is skipped) stops
+instead of finishing on part of the records. course_batches runs next to the
+enrolment stages; push_kafka waits for it, because certificates are issued
+from the batch templates.
+
+--gate STAGE holds a stage until it is approved: a y/n prompt on a terminal,
+otherwise <gates-dir>/<stage>.approve (or .reject) has to be created, e.g. with
+kubectl exec. --skip re-runs only part of the migration; a skipped generate
+streams the existing output CSV instead.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from time import sleep
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import connections, dryrun, logging_setup, metrics, profiling, rejects
+from common.kafka_partitioning import extract_key
+from common.pipeline import DEFAULT_QUEUE_SIZE, Pipeline, default_gate
+from migrate import load_script
+
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.log')
+STAGES = ('course_batches', 'generate', 'update', 'delete_es', 'generate_events', 'push_kafka')
+SKIPPABLE = ('course_batches', 'generate', 'update', 'delete_es')
+DEFAULT_GATES_DIR = 'data/gates'
+
+
+def load_config(path: str) -> dict:
+    import yaml
+    if not os.path.exists(path):
+        print(f"\nERROR: Config file '{path}' not found.")
+        sys.exit(1)
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def stage_plan_config(config: dict, stage: str, default_dir: str) -> dict:
+    """Config whose dry_run_plan is the stage's own file, so concurrent stages do not write the same plan."""
+    stage_config = dict(config)
+    base = config.get('dry_run_plan')
+    if base:
+        stage_config['dry_run_plan'] = os.path.join(os.path.dirname(base), f"{stage}_{os.path.basename(base)}")
+    else:
+        stage_config['dry_run_plan'] = os.path.join(default_dir, f"{stage}_dry_run_plan.ndjson")
+    return stage_config
+
+
+def build_pipeline(config: dict, paths: dict, dry_run: bool, gates=(), skip=(), queue_size: int = DEFAULT_QUEUE_SIZE,
+                   approve=None) -> Pipeline:
+    """
+    paths: course_batch_input, input, output, event_template, events_output.
+    The migration stages share the loaded scripts; each stage keeps its own metrics stage name.
+    """
+    process_csv = load_script('user_enrolments_update/process_csv.py')
+    process_course_batches = load_script('course_batch_update/process_course_batches.py')
+    post_update_ops = load_script('user_enrolments_update/post_update_ops.py')
+    ingest = config.get('ingest', 'rows')
+    plan_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def course_batches(inputs, emit):
+        if 'course_batches' in skip:
+            logging.info("course_batches: skipped")
+            return
+        if ingest == 'columnar':
+            from common import columnar
+            rows = columnar.prepare_course_batches(paths['course_batch_input'])
+        else:
+            rows = process_course_batches.parse_csv(paths['course_batch_input'])
+        logging.info(f"course_batches: Processing {len(rows)} records...")
+        process_course_batches.update_batches_via_api(rows, stage_plan_config(config, 'course_batches', plan_dir), dry_run,
+                                                      config.get('batch_state', 'api'))
+
+    def generate(inputs, emit):
+        if 'generate' not in skip:
+            process_csv.process(paths['input'], paths['output'], config, ingest=ingest, sink=emit)
+            return
+        # Re-run from an earlier generate: stream its output CSV
+        if not os.path.exists(paths['output']):
+            logging.error(f"Output CSV '{paths['output']}' not found. Run the pipeline without --skip generate first.")
+            sys.exit(1)
+        rows = process_csv.parse_output_csv(paths['output'])
+        logging.info(f"generate: skipped, streaming {len(rows)} records from {paths['output']}")
+        batch_size = config.get('batch_size', 50)
+        for start in range(0, len(rows), batch_size):
+            emit(rows[start:start + batch_size])
+
+    def update(inputs, emit):
+        # Streaming version of update_cassandra: one write per record that wins over the record already
+        # written for its key (plan_rule), in batches of batch_size. A later record can still win over a
+        # written one, so the winners are passed on at the end of the input, and only those written.
+        rule = config.get('plan_rule', 'latest')
+        batch_size = config.get('batch_size', 50)
+        sleep_time = config.get('cassandra_batch_sleep', 0.1)
+        table = config.get('cassandra', {}).get('user_enrolments_table', 'user_enrolments')
+        winners, stored = {}, {}
+        pending = []
+        progress = metrics.stage('update')
+        plan = None
+        if dry_run and 'update' not in skip:
+            plan = dryrun.PlanWriter.from_config(stage_plan_config(config, 'update', plan_dir), None)
+
+        def flush():
+            if not pending:
+                return
+            queries = process_csv.generate_cassandra_queries(pending, config)
+            failed = ()
+            if plan is not None:
+                for q in queries:
+                    plan.add(f"UPDATE {table}", cql=q)
+                progress.ok(len(queries))
+            else:
+                failed = set(process_csv.execute_cassandra_queries(queries, config['cassandra'], progress, pending))
+                sleep(sleep_time)
+            for i, row in enumerate(pending):
+                if i not in failed:
+                    stored[(row['userId'], row['courseId'], row['batchId'])] = row
+            logging.info(f"update: Processed {progress.done} queries so far... {progress.status()}")
+            pending.clear()
+
+        try:
+            for chunk in inputs:
+                for row in chunk:
+                    key = (row['userId'], row['courseId'], row['batchId'])
+                    if all(key) and process_csv.supersedes(row, winners.get(key), rule):
+                        winners[key] = row
+                        if 'update' not in skip:
+                            pending.append(row)
+                if len(pending) >= batch_size:
+                    flush()
+            flush()
+        finally:
+            if plan is not None:
+                plan.close()
+        if 'update' in skip:
+            # Written by an earlier run
+            stored = winners
+        written = [row for key, row in winners.items() if stored.get(key) is row]
+        logging.info(f"update: Total queries processed: {progress.done} for {len(winners)} keys")
+        if len(written) < len(winners):
+            logging.warning(f"update: {len(winners) - len(written)} records whose latest write failed are not passed on")
+        for start in range(0, len(written), batch_size):
+            emit(written[start:start + batch_size])
+
+    def delete_es(inputs, emit):
+        es_host = config.get('es_host')
+        if not es_host and 'delete_es' not in skip:
+            logging.error("es_host not found in config file.")
+            sys.exit(1)
+        progress = metrics.stage('delete_es')
+        plan = None
+        if dry_run and 'delete_es' not in skip:
+            plan = dryrun.PlanWriter.from_config(stage_plan_config(config, 'delete_es', plan_dir), None)
+        try:
+            for chunk in inputs:
+                if 'delete_es' in skip:
+                    emit(chunk)
+                    continue
+                # Only the records whose old certificates are gone go on to get new ones
+                deleted = []
+                for row in chunk:
+                    if plan is not None:
+                        plan.add('ES DELETE', userId=row['userId'], batchId=row['batchId'])
+                    elif not post_update_ops.delete_from_elasticsearch(es_host, row['userId'], row['batchId']):
+                        progress.fail()
+                        continue
+                    progress.ok()
+                    deleted.append(row)
+                if deleted:
+                    emit(deleted)
+        finally:
+            if plan is not None:
+                plan.close()
+        logging.info(f"delete_es: Total records processed: {progress.done} {progress.status()}")
+
+    def generate_events(inputs, emit):
+        with open(paths['event_template'], 'r', encoding='utf-8') as f:
+            template = json.load(f)
+        progress = metrics.stage('generate_events')
+        dir_name = os.path.dirname(paths['events_output'])
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        post_update_ops.set_aside(paths['events_output'] + post_update_ops.MANIFEST_SUFFIX)
+        with open(paths['events_output'], 'wb') as f:
+            for chunk in inputs:
+                events = [post_update_ops.dumps_event(post_update_ops.build_event(row, template)) for row in chunk]
+                f.write(b''.join(event + b'\n' for event in events))
+                progress.ok(len(events))
+                emit(events)
+        logging.info(f"generate_events: {progress.done} events written to {paths['events_output']}")
+
+    def push_kafka(inputs, emit):
+        kafka_host = config.get('kafka_host')
+        kafka_topic = config.get('kafka_topic')
+        if not kafka_host or not kafka_topic:
+            logging.error("kafka_host or kafka_topic not found in config file.")
+            sys.exit(1)
+        key_field = config.get('kafka_key')
+        ledger_path = config.get('kafka_ledger') or post_update_ops.default_ledger_path(paths['events_output'])
+        ledger = post_update_ops.SentLedger(ledger_path)
+        context = {'kafka_host': kafka_host, 'topic': kafka_topic, 'ledger': ledger_path}
+        progress = metrics.stage('push_kafka')
+        already_sent = 0
+        if dry_run:
+            producer = None
+            plan = dryrun.PlanWriter.from_config(stage_plan_config(config, 'push_kafka', plan_dir), None)
+        else:
+            producer = connections.kafka_producer(kafka_host)
+            plan = None
+        try:
+            for events in inputs:
+                for event in events:
+                    mid = extract_key(event, 'mid')
+                    if mid and mid in ledger:
+                        already_sent += 1
+                        continue
+                    key = (extract_key(event, key_field) or None) if key_field else None
+                    if plan is not None:
+                        plan.add('KAFKA SEND', topic=kafka_topic, mid=mid.decode('utf-8'), key=key.decode('utf-8') if key else None)
+                    else:
+                        post_update_ops.send_event(producer, kafka_topic, event, key, mid, ledger, context=context)
+                    progress.ok()
+        finally:
+            if producer is not None:
+                producer.flush()
+            if plan is not None:
+                plan.close()
+            ledger.close()
+        if already_sent:
+            logging.info(f"push_kafka: Skipped {already_sent} events already acknowledged according to {ledger_path}")
+        logging.info(f"push_kafka: Total events processed: {progress.done}")
+
+    pipeline = Pipeline(queue_size, approve)
+    pipeline.add('course_batches', course_batches, gate='course_batches' in gates)
+    pipeline.add('generate', generate, gate='generate' in gates)
+    pipeline.add('update', update, source='generate', gate='update' in gates)
+    pipeline.add('delete_es', delete_es, source='update', gate='delete_es' in gates)
+    pipeline.add('generate_events', generate_events, source='delete_es', gate='generate_events' in gates)
+    pipeline.add('push_kafka', push_kafka, source='generate_events', after=['course_batches'], gate='push_kafka' in gates)
+    return pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the whole migration in one process: course batches, generate, update, ES delete, "
+                                                 "event generation and Kafka push, streaming records between the stages. Run from the project root.")
+    parser.add_argument('--config', default='config.yaml', help='Path to config.yaml (relative to project root)')
+    parser.add_argument('--course-batch-input', default='course_batch_update/course_batch_input.csv', help='Course batch input CSV')
+    parser.add_argument('--input', default='user_enrolments_update/user_enrolments_input.csv', help='User enrolments input CSV')
+    parser.add_argument('--output', default='user_enrolments_update/user_enrolments_output.csv', help='Resolved user enrolments CSV written by generate')
+    parser.add_argument('--event-template', default='user_enrolments_update/event_template.json', help='Certificate event template')
+    parser.add_argument('--events-output', default='events_to_push.jsonl', help='Events file written by generate_events')
+    parser.add_argument('--dry_run', type=str, choices=['true', 'false'], help='Override dry_run from config (true/false)')
+    parser.add_argument('--gate', action='append', choices=STAGES, default=None,
+                        help="Hold this stage until it is approved (repeatable). Overrides config 'pipeline_gates'")
+    parser.add_argument('--gates-dir', help=f"Directory of <stage>.approve / <stage>.reject files when there is no terminal. Overrides config 'pipeline_gates_dir' (default {DEFAULT_GATES_DIR})")
+    parser.add_argument('--skip', action='append', choices=SKIPPABLE, default=[],
+                        help='Do not run this stage (repeatable); records still pass through it. A skipped generate streams --output')
+    parser.add_argument('--queue-size', type=int, help=f"Chunks buffered between two stages. Overrides config 'pipeline_queue_size' (default {DEFAULT_QUEUE_SIZE})")
+    dryrun.add_cli_arguments(parser)
+    metrics.add_cli_arguments(parser)
+    profiling.add_cli_arguments(parser)
+    rejects.add_cli_arguments(parser)
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    logging_setup.setup_logging(LOG_FILE, config)
+    metrics.setup_from_args(args, config)
+    profiling.setup_from_args(args, config, 'pipeline')
+    rejects.setup_from_args(args, config, 'pipeline')
+    dryrun.apply_cli_arguments(args, config)
+    dry_run = config.get('dry_run', True)
+    if args.dry_run is not None:
+        dry_run = args.dry_run.lower() == 'true'
+    gates = args.gate if args.gate is not None else config.get('pipeline_gates') or []
+    unknown = [gate for gate in gates if gate not in STAGES]
+    if unknown:
+        logging.error(f"pipeline_gates must name stages of {STAGES}, got {unknown}.")
+        sys.exit(1)
+    paths = {
+        'course_batch_input': args.course_batch_input,
+        'input': args.input,
+        'output': args.output,
+        'event_template': args.event_template,
+        'events_output': args.events_output,
+    }
+    logging.info(f"Starting pipeline (dry_run={dry_run}, gates={gates or 'none'}, skip={args.skip or 'none'})")
+    pipeline = build_pipeline(config, paths, dry_run, gates, args.skip,
+                              args.queue_size or int(config.get('pipeline_queue_size', DEFAULT_QUEUE_SIZE)),
+                              default_gate(args.gates_dir or config.get('pipeline_gates_dir', DEFAULT_GATES_DIR)))
+    results = pipeline.run()
+    rejects.close()
+    profiling.finish()
+    metrics.finish_from_args(args)
+    if any(result['status'] != 'ok' for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# NOTE: Run this script from the project root (migration-scripts) for all default paths to work.
+"""
+Reprocess only the rows a run journaled to its rejects file (common/rejects.py).
+
+    python migrate.py retry-failed --rejects data/rejects/process_csv-update.ndjson --dry_run false
+
+The rows are grouped by the stage that rejected them and handed back to the same
+code, with the context they were first processed with:
+
+    course_batches  update_batches_via_api (steps already applied are skipped)
+    generate        the lookups again; the records resolved now are appended to
+                    the original output CSV and written to <output>_retry.csv,
+                    so update and the post-update steps can run on just them
+    update          the Cassandra writes of update_cassandra
+    delete_es       delete_from_elasticsearch against the original ES host
+    push_kafka      the events again, to the original topic, with acks recorded
+                    in the original ledger
+
+Only transient failures are retried unless --include-permanent is given (once
+the data is fixed). The rejects file is then rewritten with the rows that fail
+again plus the ones not retried, and the file it replaces is kept as
+<rejects>.retried, so the same command can be rerun until the file is empty.
+Without --dry_run false the rows are only counted.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from collections import Counter, OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import connections, logging_setup, metrics, profiling, rejects
+from common.kafka_partitioning import extract_key
+from migrate import load_script
+
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retry_failed.log')
+
+
+def load_config(path: str) -> dict:
+    import yaml
+    if not os.path.exists(path):
+        print(f"\nERROR: Config file '{path}' not found.")
+        sys.exit(1)
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def retry_output_path(output_csv: str) -> str:
+    root, ext = os.path.splitext(output_csv)
+    return f"{root}_retry{ext or '.csv'}"
+
+
+def unique_rows(entries: list) -> list:
+    """The rows of the entries, each once (a Kafka event can be journaled by two errbacks, a user by each of its courses)."""
+    rows = OrderedDict()
+    for entry in entries:
+        rows.setdefault(json.dumps(entry['row'], sort_keys=True), entry['row'])
+    return list(rows.values())
+
+
+def by_context(entries: list, *keys) -> 'OrderedDict[tuple, list]':
+    groups = OrderedDict()
+    for entry in entries:
+        groups.setdefault(tuple(entry.get('context', {}).get(key) for key in keys), []).append(entry)
+    return groups
+
+
+def retry_course_batches(entries: list, config: dict):
+    process_course_batches = load_script('course_batch_update/process_course_batches.py')
+    process_course_batches.update_batches_via_api(unique_rows(entries), config, False, config.get('batch_state', 'api'))
+
+
+def retry_generate(entries: list, config: dict):
+    process_csv = load_script('user_enrolments_update/process_csv.py')
+    for (output_csv,), group in by_context(entries, 'output').items():
+        output_csv = output_csv or 'user_enrolments_update/user_enrolments_output.csv'
+        retry_csv = retry_output_path(output_csv)
+        recovered = process_csv.process(None, retry_csv, config, prepared=unique_rows(group), rejects_context={'output': output_csv})
+        if recovered:
+            with open(output_csv, 'a', newline='', encoding='utf-8') as f:
+                csv.DictWriter(f, fieldnames=process_csv.OUTPUT_FIELDS).writerows(recovered)
+        logging.info(f"retry_generate: {len(recovered)} records resolved, appended to {output_csv} and written to {retry_csv}; "
+                     f"run update and the post-update steps with {retry_csv} for them")
+
+
+def retry_update(entries: list, config: dict):
+    process_csv = load_script('user_enrolments_update/process_csv.py')
+    process_csv.update_cassandra(unique_rows(entries), config, False)
+
+
+def retry_delete_es(entries: list, config: dict):
+    post_update_ops = load_script('user_enrolments_update/post_update_ops.py')
+    progress = metrics.stage('delete_es', total=len(entries))
+    for (es_host,), group in by_context(entries, 'es_host').items():
+        es_host = es_host or config.get('es_host')
+        for row in unique_rows(group):
+            if post_update_ops.delete_from_elasticsearch(es_host, row['userId'], row['batchId']):
+                progress.ok()
+            else:
+                progress.fail()
+    logging.info(f"retry_delete_es: Total records processed: {progress.done} {progress.status()}")
+
+
+def retry_push_kafka(entries: list, config: dict):
+    post_update_ops = load_script('user_enrolments_update/post_update_ops.py')
+    progress = metrics.stage('push_kafka', total=len(entries))
+    already_sent = 0
+    for (kafka_host, topic, ledger_path), group in by_context(entries, 'kafka_host', 'topic', 'ledger').items():
+        kafka_host, topic = kafka_host or config.get('kafka_host'), topic or config.get('kafka_topic')
+        producer = connections.kafka_producer(kafka_host)
+        ledger = post_update_ops.SentLedger(ledger_path) if ledger_path else None
+        context = {'kafka_host': kafka_host, 'topic': topic, 'ledger': ledger_path}
+        for row in unique_rows(group):
+            event = row['event'].encode('utf-8')
+            mid = extract_key(event, 'mid')
+            # Delivered since, e.g. by a rerun of push-kafka
+            if mid and ledger is not None and mid in ledger:
+                already_sent += 1
+                continue
+            post_update_ops.send_event(producer, topic, event, row['key'].encode('utf-8') if row.get('key') else None, mid, ledger,
+                                       context=context)
+            progress.ok()
+        producer.flush()
+        if ledger is not None:
+            ledger.close()
+    logging.info(f"retry_push_kafka: {progress.done} events sent, {already_sent} already acknowledged")
+
+
+# In the order of the migration
+RETRIERS = OrderedDict([
+    ('course_batches', retry_course_batches),
+    ('generate', retry_generate),
+    ('update', retry_update),
+    ('delete_es', retry_delete_es),
+    ('push_kafka', retry_push_kafka),
+])
+
+
+def select(entries: list, include_permanent: bool = False, stages=None):
+    """Split the entries into {stage: entries to retry} and the entries left as they are."""
+    retry, keep = OrderedDict((stage, []) for stage in RETRIERS), []
+    for entry in entries:
+        if entry['stage'] in retry and (include_permanent or entry['kind'] != 'permanent') and (not stages or entry['stage'] in stages):
+            retry[entry['stage']].append(entry)
+        else:
+            keep.append(entry)
+    return retry, keep
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess only the rows a migration run journaled to its rejects file. Run from the project root.")
+    parser.add_argument('--config', default='config.yaml', help='Path to config.yaml (relative to project root)')
+    parser.add_argument('--rejects', required=True, help=f"Rejects file of the run to recover (e.g. {rejects.DEFAULT_DIR}/process_csv-update.ndjson); rewritten with what still fails")
+    parser.add_argument('--include-permanent', action='store_true', help='Also retry permanent failures (HTTP 4xx, lookups without a match), e.g. after fixing the data')
+    parser.add_argument('--stage', action='append', choices=list(RETRIERS), help='Only retry the rows of this stage (repeatable)')
+    parser.add_argument('--dry_run', '--dry-run', dest='dry_run', choices=['true', 'false'], help="Only count the rows that would be retried (true/false). Overrides config 'dry_run'")
+    metrics.add_cli_arguments(parser)
+    profiling.add_cli_arguments(parser)
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    logging_setup.setup_logging(LOG_FILE, config)
+    metrics.setup_from_args(args, config)
+    profiling.setup_from_args(args, config, 'retry_failed')
+    dry_run = config.get('dry_run', True)
+    if args.dry_run is not None:
+        dry_run = args.dry_run.lower() == 'true'
+    if not os.path.exists(args.rejects):
+        logging.error(f"Rejects file '{args.rejects}' not found.")
+        sys.exit(1)
+
+    entries = rejects.read(args.rejects)
+    retry, keep = select(entries, args.include_permanent, args.stage)
+    to_retry = sum(len(stage_entries) for stage_entries in retry.values())
+    kinds = Counter(entry['kind'] for entry in keep)
+    logging.info(f"retry-failed: {len(entries)} rejected rows in {args.rejects}: {to_retry} to retry ("
+                 + ', '.join(f"{stage}={len(stage_entries)}" for stage, stage_entries in retry.items() if stage_entries)
+                 + f"), {len(keep)} left as they are ({kinds['permanent']} permanent)")
+    if not to_retry or dry_run:
+        if to_retry:
+            logging.info("[DRY RUN] Nothing retried; pass --dry_run false to reprocess the rows.")
+        profiling.finish()
+        metrics.finish_from_args(args)
+        return
+    # Rows that fail again are journaled by the stages themselves
+    os.replace(args.rejects, f"{args.rejects}.retried")
+    rejects.open_journal(args.rejects)
+    for entry in keep:
+        rejects.carry(entry)
+    for stage, fn in RETRIERS.items():
+        if retry[stage]:
+            logging.info(f"retry-failed: Retrying {len(retry[stage])} {stage} rows")
+            with profiling.stage(stage):
+                fn(retry[stage], config)
+    counts = rejects.close()
+    failed_again = sum(counts.values()) - len(keep)
+    logging.info(f"retry-failed: {to_retry - failed_again} of {to_retry} rows recovered, {failed_again} failed again")
+    profiling.finish()
+    metrics.finish_from_args(args)
+    if failed_again:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
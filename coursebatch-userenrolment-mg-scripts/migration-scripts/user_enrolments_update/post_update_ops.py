@@ -1,55 +1,85 @@
 import csv
-import yaml
 import logging
-import requests
 import sys
 import os
 import uuid
 from typing import Dict, List
 from datetime import datetime
-from kafka import KafkaProducer
 import json
 import copy
+import gzip
+import hashlib
+import threading
 import argparse
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import connections, logging_setup, metrics, profiling, rejects
+from common.kafka_partitioning import KEY_FIELDS, extract_key, partition_for
+
+LOG_FILE = os.path.join(os.path.dirname(__file__), 'user_enrolments_post_update.log')
+VALIDATE_MODES = ('none', 'light', 'full')
+# Namespace for deterministic event ids: the same enrolment always yields the same mid
+MID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'fmps.generate.certificate.request')
+
+# Optional fast JSON encoders for event generation; the output is the same JSON without spaces
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# process_csv.PLAN_RULES: delete-es and generate-events act on the records update wrote
+PLAN_RULES = ('latest', 'earliest', 'last')
+PLAN_RULE_HELP = ("Which duplicate (userId, courseId, batchId) record is used: latest (default) or earliest completedOn, "
+                  "or last in input order. Overrides config 'plan_rule'")
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+MANIFEST_SUFFIX = '.manifest.json'
+
+def dumps_event(event: Dict) -> bytes:
+    """Serialize an event to UTF-8 JSON bytes, using orjson or msgspec when installed."""
+    if orjson is not None:
+        return orjson.dumps(event)
+    if msgspec is not None:
+        return msgspec.json.encode(event)
+    return json.dumps(event, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
 def load_config(path: str) -> dict:
+    import yaml
     if not os.path.exists(path):
         print(f"\nERROR: Config file '{path}' not found.")
         sys.exit(1)
     with open(path, 'r') as f:
         return yaml.safe_load(f)
 
-# Setup logging to file and console
-from logging.handlers import RotatingFileHandler
-log_file = os.path.join(os.path.dirname(__file__), 'user_enrolments_post_update.log')
-log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=2)
-file_handler.setFormatter(log_formatter)
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(log_formatter)
-logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
-
-def setup_logging():
-    # This function is now a no-op for backward compatibility with calls in main()
-    pass
-
-def delete_from_elasticsearch_for_csv(csv_path: str, es_host: str):
+def setup_logging(config: dict = None):
+    logging_setup.setup_logging(LOG_FILE, config)
+
+def read_winners(csv_path: str, rule: str = 'latest') -> List[Dict]:
+    """
+    The records of an output CSV that update writes: one per (userId, courseId, batchId), the one
+    that wins under plan_rule (process_csv.plan_writes). Records without a full key are left out.
+    """
+    from migrate import load_script
+    process_csv = load_script('user_enrolments_update/process_csv.py')
+    return process_csv.plan_writes(process_csv.parse_output_csv(csv_path), rule)
+
+def delete_from_elasticsearch_for_csv(csv_path: str, es_host: str, rule: str = 'latest'):
     count = 0
-    with open(csv_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            user_id = row.get('userId')
-            batch_id = row.get('batchId')
-            if not user_id or not batch_id:
-                logging.warning(f"Skipping row with missing userId or batchId: {row}")
-                continue
-            delete_from_elasticsearch(es_host, user_id, batch_id)
-            count += 1
-            if count % 100 == 0:
-                logging.info(f"delete_from_elasticsearch_for_csv: Processed {count} records so far...")
+    progress = metrics.stage('delete_es')
+    for row in read_winners(csv_path, rule):
+        if delete_from_elasticsearch(es_host, row['userId'], row['batchId']):
+            progress.ok()
+        else:
+            progress.fail()
+        count += 1
+        if count % 100 == 0:
+            logging.info(f"delete_from_elasticsearch_for_csv: Processed {count} records so far... {progress.status()}")
     logging.info(f"delete_from_elasticsearch_for_csv: Total records processed: {count}")
 
-def delete_from_elasticsearch(es_host: str, user_id: str, batch_id: str):
+def delete_from_elasticsearch(es_host: str, user_id: str, batch_id: str) -> bool:
     url = f"{es_host}/trainingcertificate/_delete_by_query"
     headers = {'Content-Type': 'application/json'}
     data = {
@@ -63,13 +93,169 @@ def delete_from_elasticsearch(es_host: str, user_id: str, batch_id: str):
         }
     }
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=30)
+        resp = metrics.call_api('es_delete_by_query', connections.http().post, url, headers=headers, json=data, timeout=30)
         if resp.status_code == 200:
-            logging.info(f"Deleted from ES for userId={user_id}, batchId={batch_id}: {resp.json()}")
-        else:
-            logging.error(f"Failed to delete from ES for userId={user_id}, batchId={batch_id}: {resp.status_code} {resp.text}")
+            if logging_setup.sample('es_delete_by_query'):
+                logging.info(f"Deleted from ES for userId={user_id}, batchId={batch_id}: {resp.json()}")
+            return True
+        logging.error(f"Failed to delete from ES for userId={user_id}, batchId={batch_id}: {resp.status_code} {resp.text}")
+        rejects.record('delete_es', {'userId': user_id, 'batchId': batch_id}, status=resp.status_code, message=resp.text,
+                       context={'es_host': es_host})
     except Exception as e:
         logging.error(f"Exception during ES delete for userId={user_id}, batchId={batch_id}: {e}")
+        rejects.record('delete_es', {'userId': user_id, 'batchId': batch_id}, error=e, context={'es_host': es_host})
+    return False
+
+ES_INDEX = 'trainingcertificate'
+# Recipient ids per terms filter (index.max_terms_count defaults to 65536) and buckets per composite page
+ES_TERMS_CHUNK = 10000
+ES_COMPOSITE_PAGE = 1000
+RECONCILE_FIELDS = ['userId', 'batchId', 'certificates', 'status']
+
+def read_delete_pairs(csv_path: str) -> Dict[str, set]:
+    """The (userId, batchId) pairs delete-es removes for this CSV, as batchId -> userIds."""
+    pairs = {}
+    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            if row.get('userId') and row.get('batchId'):
+                pairs.setdefault(row['batchId'], set()).add(row['userId'])
+    return pairs
+
+def reconcile_chunks(pairs: Dict[str, set], chunk: int = ES_TERMS_CHUNK):
+    """Yield (batchIds, userIds) filters covering every pair with at most `chunk` user ids each."""
+    batches, users = [], set()
+    for batch_id in sorted(pairs):
+        batch_users = sorted(pairs[batch_id])
+        if len(batch_users) > chunk:
+            # A batch with more learners than one filter holds is queried on its own, in slices
+            for start in range(0, len(batch_users), chunk):
+                yield [batch_id], batch_users[start:start + chunk]
+            continue
+        if len(users | set(batch_users)) > chunk:
+            yield batches, sorted(users)
+            batches, users = [], set()
+        batches.append(batch_id)
+        users.update(batch_users)
+    if batches:
+        yield batches, sorted(users)
+
+def check_aggregatable(es_host: str, fields: List[str]):
+    """
+    Exit with an error unless every field is aggregatable in ES_INDEX: the terms filters and composite
+    sources of the reconcile need keyword fields, and a text field would silently match nothing.
+    A mapping that cannot be read is only logged; the searches then fail and leave their pairs unchecked.
+    """
+    url = f"{es_host}/{ES_INDEX}/_field_caps"
+    try:
+        resp = connections.http().get(url, params={'fields': ','.join(fields + [f"{field}.keyword" for field in fields])}, timeout=30)
+        if resp.status_code != 200:
+            raise RuntimeError(f"{resp.status_code} {resp.text[:500]}")
+        caps = resp.json().get('fields', {})
+    except Exception as e:
+        logging.warning(f"[RECONCILE] Could not check the mapping of {ES_INDEX}: {e}")
+        return
+    unusable = []
+    for field in fields:
+        types = caps.get(field)
+        if types and all(cap.get('aggregatable') for cap in types.values()):
+            continue
+        problem = f"{field} is not in the mapping" if not types else f"{field} is {'/'.join(sorted(types))}, not aggregatable"
+        if f"{field}.keyword" in caps:
+            problem += f" (use {field}.keyword)"
+        unusable.append(problem)
+    if unusable:
+        logging.error(f"[RECONCILE] Cannot aggregate on {ES_INDEX}: {'; '.join(unusable)}. "
+                      f"Set es_batch_field / es_recipient_field in the config to keyword fields.")
+        sys.exit(1)
+
+def find_leftover_certificates(es_host: str, pairs: Dict[str, set], batch_field: str = 'training.batchId',
+                               recipient_field: str = 'recipient.id'):
+    """
+    Certificates still indexed for the pairs, found with terms-filtered composite aggregations on
+    (batchId, recipient.id) instead of one search per pair. Returns ({(userId, batchId): certificates},
+    unchecked pairs whose search failed, number of searches).
+    """
+    url = f"{es_host}/{ES_INDEX}/_search"
+    headers = {'Content-Type': 'application/json'}
+    leftovers, unchecked, searches = {}, set(), 0
+    for batch_ids, user_ids in reconcile_chunks(pairs):
+        # The filter is the cross product of the lists; only the pairs of the CSV count
+        wanted = {(user_id, batch_id) for batch_id in batch_ids for user_id in pairs[batch_id].intersection(user_ids)}
+        composite = {'size': ES_COMPOSITE_PAGE, 'sources': [{'batchId': {'terms': {'field': batch_field}}},
+                                                            {'userId': {'terms': {'field': recipient_field}}}]}
+        body = {
+            'size': 0,
+            'query': {'bool': {'filter': [{'terms': {batch_field: batch_ids}}, {'terms': {recipient_field: user_ids}}]}},
+            'aggs': {'pairs': {'composite': composite}},
+        }
+        while True:
+            searches += 1
+            try:
+                resp = metrics.call_api('es_reconcile_search', connections.http().post, url, headers=headers, json=body, timeout=60)
+                if resp.status_code != 200:
+                    raise RuntimeError(f"{resp.status_code} {resp.text[:500]}")
+                aggregation = resp.json()['aggregations']['pairs']
+            except Exception as e:
+                logging.error(f"[RECONCILE] Search failed for {len(batch_ids)} batches and {len(user_ids)} users: {e}")
+                unchecked.update(wanted)
+                break
+            for bucket in aggregation['buckets']:
+                pair = (bucket['key']['userId'], bucket['key']['batchId'])
+                if pair in wanted:
+                    leftovers[pair] = bucket['doc_count']
+            if len(aggregation['buckets']) < ES_COMPOSITE_PAGE or not aggregation.get('after_key'):
+                break
+            composite['after'] = aggregation['after_key']
+    return leftovers, unchecked, searches
+
+def refresh_index(es_host: str):
+    """Make the re-issued deletes visible to the next search."""
+    try:
+        connections.http().post(f"{es_host}/{ES_INDEX}/_refresh", timeout=60)
+    except Exception as e:
+        logging.warning(f"[RECONCILE] Refresh of {ES_INDEX} failed, the re-check may still see deleted certificates: {e}")
+
+def reconcile_elasticsearch_for_csv(csv_path: str, es_host: str, report_path: str, redelete: bool = True,
+                                    batch_field: str = 'training.batchId', recipient_field: str = 'recipient.id') -> Dict[str, int]:
+    """
+    Check that delete-es left no certificates for the CSV's (userId, batchId) pairs, re-delete only the
+    leftovers, check those again and write every leftover or unchecked pair to report_path.
+    """
+    check_aggregatable(es_host, [batch_field, recipient_field])
+    pairs = read_delete_pairs(csv_path)
+    total = sum(len(users) for users in pairs.values())
+    progress = metrics.stage('reconcile_es', total=total)
+    leftovers, unchecked, searches = find_leftover_certificates(es_host, pairs, batch_field, recipient_field)
+    logging.info(f"reconcile_elasticsearch_for_csv: {total} pairs in {len(pairs)} batches checked with {searches} searches: "
+                 f"{sum(leftovers.values())} certificates left for {len(leftovers)} pairs, {len(unchecked)} pairs unchecked")
+    status = {pair: 'leftover' for pair in leftovers}
+    if redelete and leftovers:
+        for user_id, batch_id in sorted(leftovers):
+            delete_from_elasticsearch(es_host, user_id, batch_id)
+        refresh_index(es_host)
+        retry = {}
+        for user_id, batch_id in leftovers:
+            retry.setdefault(batch_id, set()).add(user_id)
+        remaining, still_unchecked, _ = find_leftover_certificates(es_host, retry, batch_field, recipient_field)
+        for pair in leftovers:
+            status[pair] = 'remaining' if pair in remaining else 'unchecked' if pair in still_unchecked else 'deleted'
+        logging.info(f"reconcile_elasticsearch_for_csv: Re-deleted {len(leftovers)} pairs, "
+                     f"{len(remaining) + len(still_unchecked)} still not confirmed")
+    status.update({pair: 'unchecked' for pair in unchecked})
+    dir_name = os.path.dirname(report_path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    with open(report_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=RECONCILE_FIELDS)
+        writer.writeheader()
+        for (user_id, batch_id), state in sorted(status.items(), key=lambda item: (item[0][1], item[0][0])):
+            writer.writerow({'userId': user_id, 'batchId': batch_id, 'certificates': leftovers.get((user_id, batch_id), ''), 'status': state})
+    counts = {state: list(status.values()).count(state) for state in ('leftover', 'deleted', 'remaining', 'unchecked')}
+    failed = counts['leftover'] + counts['remaining'] + counts['unchecked']
+    progress.ok(total - failed)
+    progress.fail(failed)
+    logging.info(f"reconcile_elasticsearch_for_csv: {counts} {progress.status()}; report written to {report_path}")
+    return counts
 
 def build_event(record: Dict, template: Dict) -> Dict:
     event = copy.deepcopy(template)
@@ -88,90 +274,491 @@ def build_event(record: Dict, template: Dict) -> Dict:
     event['edata']['userId'] = user_id
     event['edata']['courseName'] = course_name
     event['object']['id'] = user_id
-    event['mid'] = f"LMS.{str(uuid.uuid4())}"
+    event['mid'] = event_mid(record)
     return event
 
+def event_mid(record: Dict) -> str:
+    """Deterministic event id, so regenerated events for the same enrolment keep their mid."""
+    name = f"{record['userId']}|{record['courseId']}|{record['batchId']}|{record['completedOn']}"
+    return f"LMS.{uuid.uuid5(MID_NAMESPACE, name)}"
+
+class SentLedger:
+    """
+    Append-only file of the mids Kafka has acknowledged. A re-push skips events whose mid is
+    listed, so retries do not queue duplicate certificate jobs. Each ack is one O_APPEND write,
+    so several producer processes can share the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.delivered = set()
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.delivered = {line.strip() for line in f if line.strip()}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, mid: bytes) -> bool:
+        return mid in self.delivered
+
+    def record(self, mid: bytes):
+        # Called from the producer's I/O thread when the broker acks
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab', buffering=0)
+            self._file.write(mid + b'\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def default_ledger_path(events_file: str) -> str:
+    return f"{events_file}.acked"
+
+def set_aside(path: str):
+    """Rename an events output of the other layout (plain file or manifest) left by an earlier run to <path>.old."""
+    if os.path.exists(path):
+        os.replace(path, f"{path}.old")
+        logging.warning(f"Moved {path}, written by an earlier run, to {path}.old so push-kafka does not pick it up")
+
 def write_events_to_file(events: List[Dict], output_file: str):
     import os
     dir_name = os.path.dirname(output_file)
     if dir_name:
         os.makedirs(dir_name, exist_ok=True)
-    with open(output_file, 'w', encoding='utf-8') as f:
+    set_aside(output_file + MANIFEST_SUFFIX)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    with open(output_file, 'wb') as f:
         for idx, event in enumerate(events, 1):
-            event_json = json.dumps(event, ensure_ascii=False)
-            print(event_json)  # Print each event to stdout
-            f.write(event_json + '\n')
+            event_json = dumps_event(event)
+            if debug:
+                logging.debug(event_json.decode('utf-8'))
+            f.write(event_json + b'\n')
             if idx % 100 == 0:
                 logging.info(f"write_events_to_file: Written {idx} events so far...")
     logging.info(f"write_events_to_file: Total events written: {len(events)}")
 
-def push_events_to_kafka(events_file: str, kafka_host: str, kafka_topic: str, batch_size: int = 100):
-    producer = KafkaProducer(
-        bootstrap_servers=[kafka_host],
-        value_serializer=lambda v: json.dumps(v, ensure_ascii=False).encode('utf-8')
-    )
+def open_events(path: str, mode: str = 'rb'):
+    """Open a plain, .gz or .zst events file in binary mode."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=6) if 'w' in mode else gzip.open(path, mode)
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            logging.error("zstandard is not installed. Run 'pip install zstandard' to read or write .zst event shards.")
+            sys.exit(1)
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+def write_event_shards(events: List[Dict], output_file: str, shards: int = 1, compression: str = 'gzip') -> str:
+    """
+    Write events as `shards` NDJSON files (<output_file>-00000-of-0000N.ndjson[.gz|.zst]) plus
+    <output_file>.manifest.json listing each shard with its event count, size and SHA-256.
+    push-kafka records per-shard progress in the manifest, so a failed push restarts per shard.
+    """
+    dir_name = os.path.dirname(output_file)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    set_aside(output_file)
+    shards = max(1, min(shards, len(events) or 1))
+    per_shard = -(-len(events) // shards)
+    entries = []
+    for index in range(shards):
+        name = f"{os.path.basename(output_file)}-{index:05d}-of-{shards:05d}.ndjson{COMPRESSIONS[compression]}"
+        path = os.path.join(dir_name, name)
+        chunk = events[index * per_shard:(index + 1) * per_shard]
+        with open_events(path, 'wb') as f:
+            for event in chunk:
+                f.write(dumps_event(event) + b'\n')
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        entries.append({'file': name, 'events': len(chunk), 'bytes': os.path.getsize(path), 'sha256': digest.hexdigest(),
+                        'status': 'pending'})
+        logging.info(f"write_event_shards: Written {len(chunk)} events to {path}")
+    manifest_path = output_file + MANIFEST_SUFFIX
+    write_manifest(manifest_path, {'events': len(events), 'compression': compression, 'shards': entries})
+    logging.info(f"write_event_shards: Total events written: {len(events)} in {shards} shards, manifest {manifest_path}")
+    return manifest_path
+
+def write_manifest(path: str, manifest: Dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def resolve_events_manifest(events_file: str) -> str:
+    """
+    Manifest path for a sharded events output (given either name), or None for a single NDJSON file.
+    When both exist the newer one is the output of the last generate-events.
+    """
+    if events_file.endswith(MANIFEST_SUFFIX):
+        return events_file
+    manifest_path = events_file + MANIFEST_SUFFIX
+    if not os.path.exists(manifest_path):
+        return None
+    if not os.path.exists(events_file):
+        return manifest_path
+    newer = manifest_path if os.path.getmtime(manifest_path) >= os.path.getmtime(events_file) else events_file
+    logging.warning(f"Both {events_file} and {manifest_path} exist; pushing the newer one, {newer}")
+    return manifest_path if newer == manifest_path else None
+
+def is_valid_event_line(line: bytes, validate: str = 'light') -> bool:
+    """
+    Check an events file line before it is sent as-is.
+    'light' only checks that it looks like a JSON object, 'full' parses it, 'none' accepts anything.
+    """
+    if validate == 'none':
+        return True
+    if validate == 'full':
+        try:
+            return isinstance(json.loads(line), dict)
+        except ValueError:
+            return False
+    line = line.strip()
+    return line[:1] == b'{' and line[-1:] == b'}'
+
+def push_events_to_kafka(events_file: str, kafka_host: str, kafka_topic: str, batch_size: int = 100, validate: str = 'light',
+                         key_field: str = None, producers: int = 1, partitions: int = None, ledger_path: str = None):
+    """
+    Send each line of the events file to Kafka unchanged. With key_field, messages are keyed by that
+    event field (userId, batchId or courseId) so the default partitioner keeps a key on one partition.
+    With producers > 1 the file is split into per-partition streams that run in parallel processes.
+    Acked mids are appended to the ledger (default <events_file>.acked); events already in it are skipped.
+    """
+    manifest_path = resolve_events_manifest(events_file)
+    if manifest_path:
+        return push_event_shards(manifest_path, kafka_host, kafka_topic, validate, key_field, producers,
+                                 ledger_path or default_ledger_path(manifest_path[:-len(MANIFEST_SUFFIX)]))
+    ledger_path = ledger_path or default_ledger_path(events_file)
+    if producers > 1:
+        return push_events_parallel(events_file, kafka_host, kafka_topic, batch_size, validate, key_field, producers, partitions,
+                                    ledger_path)
+    # The events file already holds one serialized event per line; those bytes are sent unchanged
+    producer = connections.kafka_producer(kafka_host)
+    ledger = SentLedger(ledger_path)
+    context = {'kafka_host': kafka_host, 'topic': kafka_topic, 'ledger': ledger_path}
     batch = []
-    total = 0
-    with open(events_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            event = json.loads(line)
-            batch.append(event)
+    total, already_sent = 0, 0
+    progress = metrics.stage('push_kafka')
+    with open(events_file, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            event = line.rstrip(b'\r\n')
+            if not event.strip():
+                continue
+            if not is_valid_event_line(event, validate):
+                logging.error(f"push_events_to_kafka: Skipping invalid event on line {line_no} of {events_file}: {event[:200]!r}")
+                progress.fail()
+                continue
+            mid = extract_key(event, 'mid')
+            if mid and mid in ledger:
+                already_sent += 1
+                continue
+            batch.append(((extract_key(event, key_field) or None) if key_field else None, mid, event))
             total += 1
             if len(batch) >= batch_size:
-                for e in batch:
-                    producer.send(kafka_topic, value=e)
+                for key, mid, e in batch:
+                    send_event(producer, kafka_topic, e, key, mid, ledger, context=context)
+                progress.ok(len(batch))
                 logging.info(f"push_events_to_kafka: Pushed batch of {len(batch)} events to Kafka topic {kafka_topic}")
                 batch = []
             if total % 100 == 0:
-                logging.info(f"push_events_to_kafka: Processed {total} events so far...")
+                logging.info(f"push_events_to_kafka: Processed {total} events so far... {progress.status()}")
         if batch:
-            for e in batch:
-                producer.send(kafka_topic, value=e)
+            for key, mid, e in batch:
+                send_event(producer, kafka_topic, e, key, mid, ledger, context=context)
+            progress.ok(len(batch))
             logging.info(f"push_events_to_kafka: Pushed final batch of {len(batch)} events to Kafka topic {kafka_topic}")
     producer.flush()
-    producer.close()
+    ledger.close()
+    if already_sent:
+        logging.info(f"push_events_to_kafka: Skipped {already_sent} events already acknowledged according to {ledger_path}")
     logging.info(f"push_events_to_kafka: Total events processed: {total}")
 
-def generate_events_from_csv(csv_path: str, event_template_path: str, output_file: str):
+def send_event(producer, kafka_topic: str, event: bytes, key: bytes = None, mid: bytes = None, ledger: SentLedger = None, partition: int = None,
+               context: Dict = None):
+    """Send one event; context (kafka_host, topic, ledger) is journaled with it if the send fails."""
+    future = metrics.kafka_send(producer, kafka_topic, value=event, key=key, partition=partition)
+    if mid and ledger is not None:
+        future.add_callback(lambda _metadata: ledger.record(mid))
+    future.add_errback(reject_event, event=event, key=key, context=context)
+    return future
+
+def reject_event(exc, event: bytes = b'', key: bytes = None, context: Dict = None):
+    """Kafka errback: journal the event for retry-failed."""
+    rejects.record('push_kafka', {'event': event.decode('utf-8'), 'key': key.decode('utf-8') if key else None}, error=exc, context=context)
+
+def topic_partition_count(kafka_host: str, kafka_topic: str) -> int:
+    # A short-lived consumer, closed here: the caller forks producer processes next, and a pooled
+    # producer's sender thread and sockets must not be live in the parent when it does
+    from kafka import KafkaConsumer
+    consumer = KafkaConsumer(bootstrap_servers=[kafka_host])
+    try:
+        return len(consumer.partitions_for_topic(kafka_topic) or ()) or 1
+    finally:
+        consumer.close()
+
+def split_events_by_partition(events_file: str, partitions: int, key_field: str = None, validate: str = 'light', progress=None,
+                              ledger: SentLedger = None) -> Dict[int, str]:
+    """
+    Write the events file as one stream per partition (<events_file>.partitions/p<N>.ndjson).
+    Keyed events go where Kafka's default partitioner would put them; unkeyed ones round-robin.
+    Events already in the ledger are left out.
+    """
+    out_dir = f"{events_file}.partitions"
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {p: os.path.join(out_dir, f"p{p}.ndjson") for p in range(partitions)}
+    files = {p: open(path, 'wb') for p, path in paths.items()}
+    counts = [0] * partitions
+    already_sent = 0
+    try:
+        with open(events_file, 'rb') as f:
+            next_partition = 0
+            for line_no, line in enumerate(f, 1):
+                event = line.rstrip(b'\r\n')
+                if not event.strip():
+                    continue
+                if not is_valid_event_line(event, validate):
+                    logging.error(f"split_events_by_partition: Skipping invalid event on line {line_no} of {events_file}: {event[:200]!r}")
+                    if progress:
+                        progress.fail()
+                    continue
+                if ledger is not None and extract_key(event, 'mid') in ledger:
+                    already_sent += 1
+                    continue
+                key = extract_key(event, key_field) if key_field else b''
+                if key:
+                    partition = partition_for(key, partitions)
+                else:
+                    partition = next_partition
+                    next_partition = (next_partition + 1) % partitions
+                files[partition].write(event + b'\n')
+                counts[partition] += 1
+    finally:
+        for fh in files.values():
+            fh.close()
+    if already_sent:
+        logging.info(f"split_events_by_partition: Skipped {already_sent} events already acknowledged according to {ledger.path}")
+    logging.info(f"split_events_by_partition: {sum(counts)} events split into {partitions} partition streams in {out_dir}: {counts}")
+    return {p: paths[p] for p in range(partitions) if counts[p]}
+
+def push_partition_streams(streams: List, kafka_host: str, kafka_topic: str, key_field: str = None, ledger_path: str = None) -> Dict[str, int]:
+    """Worker process: send each (partition, path) stream to its partition with one producer. Returns counts."""
+    from kafka import KafkaProducer
+    logging_setup.setup_worker_logging()
+    producer = KafkaProducer(bootstrap_servers=[kafka_host])
+    ledger = SentLedger(ledger_path) if ledger_path else None
+    context = {'kafka_host': kafka_host, 'topic': kafka_topic, 'ledger': ledger_path}
+    counts = {'sent': 0, 'acked': 0, 'failed': 0}
+
+    def acked(_metadata):
+        counts['acked'] += 1
+
+    def failed(exc, event=b'', key=None):
+        counts['failed'] += 1
+        logging.error(f"push_partition_streams: Kafka send failed: {exc}")
+        reject_event(exc, event, key, context)
+
+    for partition, path in streams:
+        with open(path, 'rb') as f:
+            for line in f:
+                event = line.rstrip(b'\n')
+                key = (extract_key(event, key_field) or None) if key_field else None
+                future = producer.send(kafka_topic, value=event, key=key, partition=partition)
+                future.add_callback(acked)
+                mid = extract_key(event, 'mid')
+                if mid and ledger is not None:
+                    future.add_callback(lambda _metadata, mid=mid: ledger.record(mid))
+                future.add_errback(failed, event=event, key=key)
+                counts['sent'] += 1
+        logging.info(f"push_partition_streams: Partition {partition} pushed from {path}")
+    producer.flush()
+    producer.close()
+    if ledger is not None:
+        ledger.close()
+    return counts
+
+def push_events_parallel(events_file: str, kafka_host: str, kafka_topic: str, batch_size: int, validate: str,
+                         key_field: str, producers: int, partitions: int = None, ledger_path: str = None):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    progress = metrics.stage('push_kafka')
+    partitions = partitions or topic_partition_count(kafka_host, kafka_topic)
+    ledger = SentLedger(ledger_path) if ledger_path else None
+    streams = sorted(split_events_by_partition(events_file, partitions, key_field, validate, progress, ledger).items())
+    producers = max(1, min(producers, len(streams)))
+    logging.info(f"push_events_parallel: {len(streams)} partition streams of topic {kafka_topic} across {producers} producer processes")
+    total = {'sent': 0, 'acked': 0, 'failed': 0}
+    # Forked workers inherit the loaded modules and config; see logging_setup.setup_worker_logging
+    with ProcessPoolExecutor(max_workers=producers, mp_context=get_context('fork')) as pool:
+        futures = [pool.submit(push_partition_streams, streams[i::producers], kafka_host, kafka_topic, key_field, ledger_path)
+                   for i in range(producers)]
+        for future in futures:
+            counts = future.result()
+            for name in total:
+                total[name] += counts[name]
+    # Worker counters live in the worker processes; fold the totals into this process's metrics
+    metrics.KAFKA_SENT.inc(total['sent'], topic=kafka_topic)
+    metrics.KAFKA_ACKED.inc(total['acked'], topic=kafka_topic)
+    metrics.KAFKA_FAILED.inc(total['failed'], topic=kafka_topic)
+    progress.ok(total['sent'] - total['failed'])
+    progress.fail(total['failed'])
+    logging.info(f"push_events_to_kafka: Total events processed: {total['sent']} ({total['acked']} acked, {total['failed']} failed) "
+                 f"with {producers} producers")
+
+def push_event_shard(path: str, kafka_host: str, kafka_topic: str, validate: str = 'light', key_field: str = None,
+                     ledger_path: str = None, worker: bool = False) -> Dict[str, int]:
+    """Send one events shard with its own producer. Returns sent/acked/failed/skipped/invalid counts."""
+    from kafka import KafkaProducer
+    if worker:
+        logging_setup.setup_worker_logging()
+    producer = KafkaProducer(bootstrap_servers=[kafka_host])
+    ledger = SentLedger(ledger_path) if ledger_path else None
+    context = {'kafka_host': kafka_host, 'topic': kafka_topic, 'ledger': ledger_path}
+    counts = {'sent': 0, 'acked': 0, 'failed': 0, 'skipped': 0, 'invalid': 0}
+
+    def acked(_metadata, mid=None):
+        counts['acked'] += 1
+        if mid and ledger is not None:
+            ledger.record(mid)
+
+    def failed(exc, event=b'', key=None):
+        counts['failed'] += 1
+        logging.error(f"push_event_shard: Kafka send failed for {path}: {exc}")
+        reject_event(exc, event, key, context)
+
+    with open_events(path, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            event = line.rstrip(b'\r\n')
+            if not event.strip():
+                continue
+            if not is_valid_event_line(event, validate):
+                logging.error(f"push_event_shard: Skipping invalid event on line {line_no} of {path}: {event[:200]!r}")
+                counts['invalid'] += 1
+                continue
+            mid = extract_key(event, 'mid')
+            if mid and ledger is not None and mid in ledger:
+                counts['skipped'] += 1
+                continue
+            key = (extract_key(event, key_field) or None) if key_field else None
+            future = producer.send(kafka_topic, value=event, key=key)
+            future.add_callback(acked, mid=mid)
+            future.add_errback(failed, event=event, key=key)
+            counts['sent'] += 1
+    producer.flush()
+    producer.close()
+    if ledger is not None:
+        ledger.close()
+    return counts
+
+def push_event_shards(manifest_path: str, kafka_host: str, kafka_topic: str, validate: str = 'light', key_field: str = None,
+                      producers: int = 1, ledger_path: str = None):
+    """
+    Push every shard listed in the manifest that is not yet 'done', up to `producers` shards at a time.
+    A shard is marked done in the manifest once all its events are acknowledged.
+    """
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(manifest_path)
+    pending = [shard for shard in manifest['shards'] if shard.get('status') != 'done']
+    logging.info(f"push_event_shards: {len(pending)} of {len(manifest['shards'])} shards to push from {manifest_path}")
+    progress = metrics.stage('push_kafka', total=sum(shard['events'] for shard in pending))
+    total = {'sent': 0, 'acked': 0, 'failed': 0, 'skipped': 0, 'invalid': 0}
+
+    def finished(shard, counts):
+        for name in total:
+            total[name] += counts[name]
+        metrics.KAFKA_SENT.inc(counts['sent'], topic=kafka_topic)
+        metrics.KAFKA_ACKED.inc(counts['acked'], topic=kafka_topic)
+        metrics.KAFKA_FAILED.inc(counts['failed'], topic=kafka_topic)
+        progress.ok(counts['acked'] + counts['skipped'])
+        progress.fail(counts['failed'] + counts['invalid'])
+        shard['status'] = 'done' if counts['failed'] == 0 and counts['acked'] == counts['sent'] else 'failed'
+        shard['pushed'] = counts
+        # Only this process rewrites the manifest, after each finished shard
+        write_manifest(manifest_path, manifest)
+        logging.info(f"push_event_shards: Shard {shard['file']} {shard['status']}: {counts} {progress.status()}")
+
+    paths = [os.path.join(base_dir, shard['file']) for shard in pending]
+    if producers > 1 and len(pending) > 1:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from multiprocessing import get_context
+        with ProcessPoolExecutor(max_workers=min(producers, len(pending)), mp_context=get_context('fork')) as pool:
+            futures = {pool.submit(push_event_shard, path, kafka_host, kafka_topic, validate, key_field, ledger_path, True): shard
+                       for shard, path in zip(pending, paths)}
+            for future in as_completed(futures):
+                finished(futures[future], future.result())
+    else:
+        for shard, path in zip(pending, paths):
+            finished(shard, push_event_shard(path, kafka_host, kafka_topic, validate, key_field, ledger_path))
+    failed_shards = [shard['file'] for shard in manifest['shards'] if shard.get('status') != 'done']
+    if failed_shards:
+        logging.error(f"push_event_shards: {len(failed_shards)} shards not fully delivered, rerun push-kafka to retry them: {failed_shards}")
+    logging.info(f"push_events_to_kafka: Total events processed: {total['sent']} ({total['acked']} acked, {total['failed']} failed, "
+                 f"{total['skipped']} already delivered)")
+
+def generate_events_from_csv(csv_path: str, event_template_path: str, output_file: str, shards: int = 1, compression: str = 'none',
+                             rule: str = 'latest'):
     with open(event_template_path, 'r', encoding='utf-8') as f:
         event_template = json.load(f)
     events = []
     count = 0
-    with open(csv_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            user_id = row.get('userId')
-            batch_id = row.get('batchId')
-            if not user_id or not batch_id:
-                logging.warning(f"Skipping row with missing userId or batchId: {row}")
-                continue
-            event = build_event(row, event_template)
-            events.append(event)
-            count += 1
-            if count % 100 == 0:
-                logging.info(f"generate_events_from_csv: Processed {count} records so far...")
-    write_events_to_file(events, output_file)
+    progress = metrics.stage('generate_events')
+    # One event per written enrolment, with the completedOn that update wrote
+    for row in read_winners(csv_path, rule):
+        event = build_event(row, event_template)
+        events.append(event)
+        progress.ok()
+        count += 1
+        if count % 100 == 0:
+            logging.info(f"generate_events_from_csv: Processed {count} records so far...")
+    if shards > 1 or compression != 'none':
+        write_event_shards(events, output_file, shards, compression)
+    else:
+        write_events_to_file(events, output_file)
     logging.info(f"generate_events_from_csv: Total records processed: {count}")
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Post Cassandra update operations: ES delete, event generation, Kafka push.")
+    metrics.add_cli_arguments(parser)
+    profiling.add_cli_arguments(parser)
+    rejects.add_cli_arguments(parser)
     subparsers = parser.add_subparsers(dest='command', required=True)
 
     # ES delete
     parser_delete = subparsers.add_parser('delete-es', help='Delete records from Elasticsearch')
     parser_delete.add_argument('csv_path')
     parser_delete.add_argument('config_path')
+    parser_delete.add_argument('--plan-rule', choices=PLAN_RULES, help=PLAN_RULE_HELP)
+
+    # ES reconcile
+    parser_reconcile = subparsers.add_parser('reconcile-es', help='Find certificates delete-es left in Elasticsearch with a few aggregations and re-delete only those')
+    parser_reconcile.add_argument('csv_path')
+    parser_reconcile.add_argument('config_path')
+    parser_reconcile.add_argument('--report', default='user_enrolments_update/es_reconcile_report.csv', help='CSV of the pairs that had certificates left, or could not be checked')
+    parser_reconcile.add_argument('--report-only', action='store_true', help='List the leftovers without deleting them again')
 
     # Generate events
     parser_generate = subparsers.add_parser('generate-events', help='Generate events and write to file')
     parser_generate.add_argument('csv_path')
     parser_generate.add_argument('event_template_path')
     parser_generate.add_argument('events_output_file')
+    parser_generate.add_argument('--shards', type=int, default=1, help='Write the events as this many shards plus <events_output_file>.manifest.json')
+    parser_generate.add_argument('--compress', choices=sorted(COMPRESSIONS), default='none', help='Compress the shards (zstd needs the zstandard package)')
+    parser_generate.add_argument('--plan-rule', choices=PLAN_RULES, help="Which duplicate (userId, courseId, batchId) record gets the event: latest (default) or earliest completedOn, or last in input order. Use the update's plan_rule")
 
     # Push to Kafka
     parser_push = subparsers.add_parser('push-kafka', help='Push events to Kafka from file (batch size is set in config.yaml as kafka_batch_size)')
-    parser_push.add_argument('events_file')
+    parser_push.add_argument('events_file', help='NDJSON events file, or the manifest (or base name) of sharded events')
     parser_push.add_argument('config_path')
+    parser_push.add_argument('--key', choices=KEY_FIELDS, help="Event field used as the Kafka message key. Overrides config 'kafka_key' (default: no key)")
+    parser_push.add_argument('--producers', type=int, help="Producer processes; above 1 the events are split per partition and pushed in parallel. Overrides config 'kafka_producers' (default 1)")
+    parser_push.add_argument('--ledger', help="File of acknowledged event mids; events listed there are not sent again. Overrides config 'kafka_ledger' (default: <events_file>.acked)")
+    parser_push.add_argument('--validate', choices=VALIDATE_MODES, help="Check each event line before sending: light (default, looks like a JSON object), full (parse it) or none. Overrides config 'kafka_validate'")
 
     # All steps
     parser_all = subparsers.add_parser('all', help='Run all steps: ES delete, generate events, push to Kafka (batch size is set in config.yaml as kafka_batch_size)')
@@ -179,33 +766,72 @@ def main():
     parser_all.add_argument('config_path')
     parser_all.add_argument('event_template_path')
     parser_all.add_argument('events_output_file')
+    parser_all.add_argument('--shards', type=int, help="Number of event shards. Overrides config 'events_shards' (default 1)")
+    parser_all.add_argument('--compress', choices=sorted(COMPRESSIONS), help="Event shard compression. Overrides config 'events_compression' (default none)")
+    parser_all.add_argument('--key', choices=KEY_FIELDS, help="Kafka message key field. Overrides config 'kafka_key'")
+    parser_all.add_argument('--producers', type=int, help="Kafka producer processes. Overrides config 'kafka_producers'")
+    parser_all.add_argument('--ledger', help="File of acknowledged event mids. Overrides config 'kafka_ledger'")
+    parser_all.add_argument('--validate', choices=VALIDATE_MODES, help="Event line check before sending (light, full, none). Overrides config 'kafka_validate'")
+    parser_all.add_argument('--plan-rule', choices=PLAN_RULES, help=PLAN_RULE_HELP)
 
-    args = parser.parse_args()
-    setup_logging()
+    args = parser.parse_args(argv)
+    config = load_config(args.config_path) if getattr(args, 'config_path', None) else {}
+    setup_logging(config)
+    metrics.setup_from_args(args, config)
+    profiling.setup_from_args(args, config, f"post_update_ops-{args.command}")
+    if args.command != 'generate-events':
+        rejects.setup_from_args(args, config, f"post_update_ops-{args.command}")
+    validate = getattr(args, 'validate', None) or config.get('kafka_validate', 'light')
+    key_field = getattr(args, 'key', None) or config.get('kafka_key')
+    if key_field and key_field not in KEY_FIELDS:
+        logging.error(f"kafka_key must be one of {KEY_FIELDS}, got '{key_field}'.")
+        return
+    push_options = {
+        'validate': validate,
+        'key_field': key_field,
+        'producers': getattr(args, 'producers', None) or int(config.get('kafka_producers', 1)),
+        'partitions': config.get('kafka_partitions'),
+        'ledger_path': getattr(args, 'ledger', None) or config.get('kafka_ledger'),
+    }
+    rule = getattr(args, 'plan_rule', None) or config.get('plan_rule', 'latest')
+    es_fields = {
+        'batch_field': config.get('es_batch_field', 'training.batchId'),
+        'recipient_field': config.get('es_recipient_field', 'recipient.id'),
+    }
+    unresolved = 0
 
     if args.command == 'delete-es':
-        config = load_config(args.config_path)
         es_host = config.get('es_host')
         if not es_host:
             logging.error("es_host not found in config file.")
             return
-        delete_from_elasticsearch_for_csv(args.csv_path, es_host)
+        with profiling.stage('delete_es'):
+            delete_from_elasticsearch_for_csv(args.csv_path, es_host, rule)
+
+    elif args.command == 'reconcile-es':
+        es_host = config.get('es_host')
+        if not es_host:
+            logging.error("es_host not found in config file.")
+            return
+        with profiling.stage('reconcile_es'):
+            counts = reconcile_elasticsearch_for_csv(args.csv_path, es_host, args.report, not args.report_only, **es_fields)
+        unresolved = counts['leftover'] + counts['remaining'] + counts['unchecked']
 
     elif args.command == 'generate-events':
-        generate_events_from_csv(args.csv_path, args.event_template_path, args.events_output_file)
+        with profiling.stage('generate_events'):
+            generate_events_from_csv(args.csv_path, args.event_template_path, args.events_output_file, args.shards, args.compress, rule)
 
     elif args.command == 'push-kafka':
-        config = load_config(args.config_path)
         kafka_host = config.get('kafka_host')
         kafka_topic = config.get('kafka_topic')
         kafka_batch_size = config.get('kafka_batch_size', 100)
         if not kafka_host or not kafka_topic:
             logging.error("kafka_host or kafka_topic not found in config file.")
             return
-        push_events_to_kafka(args.events_file, kafka_host, kafka_topic, batch_size=kafka_batch_size)
+        with profiling.stage('push_kafka'):
+            push_events_to_kafka(args.events_file, kafka_host, kafka_topic, batch_size=kafka_batch_size, **push_options)
 
     elif args.command == 'all':
-        config = load_config(args.config_path)
         es_host = config.get('es_host')
         kafka_host = config.get('kafka_host')
         kafka_topic = config.get('kafka_topic')
@@ -216,9 +842,30 @@ def main():
         if not kafka_host or not kafka_topic:
             logging.error("kafka_host or kafka_topic not found in config file.")
             return
-        delete_from_elasticsearch_for_csv(args.csv_path, es_host)
-        generate_events_from_csv(args.csv_path, args.event_template_path, args.events_output_file)
-        push_events_to_kafka(args.events_output_file, kafka_host, kafka_topic, batch_size=kafka_batch_size)
+        with profiling.stage('delete_es'):
+            delete_from_elasticsearch_for_csv(args.csv_path, es_host, rule)
+        if config.get('es_reconcile'):
+            with profiling.stage('reconcile_es'):
+                counts = reconcile_elasticsearch_for_csv(args.csv_path, es_host, config.get('es_reconcile_report', 'user_enrolments_update/es_reconcile_report.csv'),
+                                                         **es_fields)
+            unresolved = counts['remaining'] + counts['unchecked']
+        if unresolved:
+            # New certificates would sit next to the old ones; rerun reconcile-es before generating the events
+            logging.error("all: Not generating or pushing events while old certificates may remain in Elasticsearch.")
+        else:
+            with profiling.stage('generate_events'):
+                generate_events_from_csv(args.csv_path, args.event_template_path, args.events_output_file,
+                                         args.shards or int(config.get('events_shards', 1)),
+                                         args.compress or config.get('events_compression', 'none'), rule)
+            with profiling.stage('push_kafka'):
+                push_events_to_kafka(args.events_output_file, kafka_host, kafka_topic, batch_size=kafka_batch_size, **push_options)
+
+    rejects.close()
+    profiling.finish()
+    metrics.finish_from_args(args)
+    if unresolved:
+        logging.error(f"reconcile: {unresolved} (userId, batchId) pairs may still have certificates in Elasticsearch.")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
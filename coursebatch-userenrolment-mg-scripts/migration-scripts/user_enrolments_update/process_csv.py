@@ -1,64 +1,29 @@
 # NOTE: Run this script from the project root (migration-scripts) for all default paths to work.
 import csv
-import yaml
 import logging
-import requests
 import sys
 import os
 import argparse
-from typing import List, Dict, Any
+import hashlib
+import json
+import time
+from typing import List, Dict, Any, Tuple
 from time import sleep
 
 import platform
-from datetime import datetime
-from logging.handlers import RotatingFileHandler
 
-# Setup logging to file and console
-log_file = os.path.join(os.path.dirname(__file__), 'user_enrolments_update.log')
-log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=2)
-file_handler.setFormatter(log_formatter)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import chunked, connections, dryrun, logging_setup, metrics, profiling, records, rejects, verify
+from common.dates import DateNormalizer
 
-
-def convert_date(date_str: str, try_mmddyyyy: bool = False) -> str:
-    """
-    Robustly parse a date string in common user formats and return 'YYYY-MM-DD 00:00:00'.
-    Accepts e.g. '1/3/2024', '01/03/2024', '2024-03-01', '2024/03/01', etc.
-    Optionally tries MM/DD/YYYY if try_mmddyyyy is True (for single code/date case).
-    Returns empty string if invalid.
-    """
-    if not date_str or not isinstance(date_str, str):
-        return ''
-    date_str = date_str.strip()
-    # Try D/M/Y and Y-M-D formats first
-    for fmt in ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%Y/%m/%d", "%d/%m/%y", "%d-%m-%y"):
-        try:
-            dt = datetime.strptime(date_str, fmt)
-            return dt.strftime("%Y-%m-%d 00:00:00")
-        except Exception:
-            continue
-    # If flagged, try MM/DD/YYYY (US format)
-    if try_mmddyyyy:
-        for fmt in ("%m/%d/%Y", "%m-%d-%Y", "%m/%d/%y", "%m-%d-%y"):
-            try:
-                dt = datetime.strptime(date_str, fmt)
-                return dt.strftime("%Y-%m-%d 00:00:00")
-            except Exception:
-                continue
-    logging.warning(f"Could not parse date: '{date_str}' (tried multiple formats, MM/DD/YYYY allowed={try_mmddyyyy})")
-    return ''
-
-try:
-    from cassandra.cluster import Cluster
-except ImportError:
-    Cluster = None
-    # Will raise error if actual update is attempted without cassandra-driver
+LOG_FILE = os.path.join(os.path.dirname(__file__), 'user_enrolments_update.log')
+DRY_RUN_PLAN = os.path.join(os.path.dirname(__file__), 'user_enrolments_dry_run_plan.ndjson')
+# Lookup caches shared by every process() call when set to a dict (the worker does); None = fresh per run
+LOOKUP_CACHES = None
 
 # Load config
 def load_config(path: str) -> dict:
+    import yaml
     if not os.path.exists(path):
         print(f"\nERROR: Config file '{path}' not found.")
         print("Make sure you are running this command from the project root and using the correct --config path (e.g., 'config.yaml').\n")
@@ -69,7 +34,8 @@ def load_config(path: str) -> dict:
 def null_string_check(s):
     return s if s is not None else ''
 
-def fetch_user_id_and_name(email: str, config: dict):
+def fetch_user_id_and_name(email: str, config: dict, failures: dict = None):
+    # failures, when given, gets why a lookup found nothing: {key: rejects.record() arguments}; the same for the other fetch_*
     url = f"{config['host']}/api/user/v1/search"
     headers = {
         'Authorization': f"Bearer {config['apikey']}",
@@ -82,9 +48,9 @@ def fetch_user_id_and_name(email: str, config: dict):
             "fields": ["userId", "firstName", "lastName"]
         }
     }
-    logging.info(f"Fetching userId and userName for email: {email}")
+    logging.debug(f"Fetching userId and userName for email: {email}")
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=10)
+        resp = metrics.call_api('user_search', connections.http().post, url, headers=headers, json=data, timeout=10)
         if resp.status_code != 200:
             logging.error(f"API call to {url} for email {email} returned status code {resp.status_code}: {resp.text}")
         resp.raise_for_status()
@@ -95,15 +61,20 @@ def fetch_user_id_and_name(email: str, config: dict):
             first_name = content[0].get('firstName', '')
             last_name = content[0].get('lastName', '')
             user_name = f"{null_string_check(first_name)} {null_string_check(last_name)}".strip()
-            logging.info(f"Success: userId for {email} is {user_id}, userName is {user_name}")
+            if logging_setup.sample('user_search'):
+                logging.info(f"Success: userId for {email} is {user_id}, userName is {user_name}")
             return user_id, user_name
         else:
             logging.warning(f"No userId or userName found for {email}")
+            if failures is not None:
+                failures[email] = {'error': 'NotFound', 'status': resp.status_code, 'message': f"No userId or userName found for {email}"}
     except Exception as e:
         logging.error(f"UserId fetch failed for {email}: {e}")
+        if failures is not None:
+            failures[email] = {'error': e}
     return None, None
 
-def fetch_course_id_and_name(course_code: str, config: dict):
+def fetch_course_id_and_name(course_code: str, config: dict, failures: dict = None):
     url = f"{config['host']}/api/composite/v1/search"
     headers = {
         'Content-Type': 'application/json',
@@ -118,9 +89,9 @@ def fetch_course_id_and_name(course_code: str, config: dict):
             "limit": 1
         }
     }
-    logging.info(f"Fetching courseId and courseName for courseCode: {course_code}")
+    logging.debug(f"Fetching courseId and courseName for courseCode: {course_code}")
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=10)
+        resp = metrics.call_api('composite_search', connections.http().post, url, headers=headers, json=data, timeout=10)
         if resp.status_code != 200:
             logging.error(f"API call to {url} for course_code {course_code} returned status code {resp.status_code}: {resp.text}")
         resp.raise_for_status()
@@ -129,15 +100,20 @@ def fetch_course_id_and_name(course_code: str, config: dict):
         if content:
             course_id = content[0].get('identifier', '')
             course_name = content[0].get('name', '')
-            logging.info(f"Success: courseId for {course_code} is {course_id}, courseName is {course_name}")
+            if logging_setup.sample('composite_search'):
+                logging.info(f"Success: courseId for {course_code} is {course_id}, courseName is {course_name}")
             return course_id, course_name
         else:
             logging.warning(f"No courseId or courseName found for {course_code}")
+            if failures is not None:
+                failures[course_code] = {'error': 'NotFound', 'status': resp.status_code, 'message': f"No courseId or courseName found for {course_code}"}
     except Exception as e:
         logging.error(f"CourseId fetch failed for {course_code}: {e}")
+        if failures is not None:
+            failures[course_code] = {'error': e}
     return None, None
 
-def fetch_batch_id(batch_code: str, config: dict) -> str:
+def fetch_batch_id(batch_code: str, config: dict, failures: dict = None) -> str:
     url = f"{config['host']}/api/course/v1/batch/list"
     headers = {
         'accept': 'application/json',
@@ -152,9 +128,9 @@ def fetch_batch_id(batch_code: str, config: dict) -> str:
             "fields": ["identifier"]
         }
     }
-    logging.info(f"Fetching batchId for batchName: {batch_code}")
+    logging.debug(f"Fetching batchId for batchName: {batch_code}")
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=10)
+        resp = metrics.call_api('batch_list', connections.http().post, url, headers=headers, json=data, timeout=10)
         if resp.status_code != 200:
             logging.error(f"API call to {url} for batch_code {batch_code} returned status code {resp.status_code}: {resp.text}")
         resp.raise_for_status()
@@ -162,12 +138,17 @@ def fetch_batch_id(batch_code: str, config: dict) -> str:
         content = res.get('result', {}).get('response', {}).get('content', [])
         if content and 'identifier' in content[0]:
             batch_id = content[0]['identifier']
-            logging.info(f"Success: batchId for {batch_code} is {batch_id}")
+            if logging_setup.sample('batch_list'):
+                logging.info(f"Success: batchId for {batch_code} is {batch_id}")
             return batch_id
         else:
             logging.warning(f"No batchId found for {batch_code}")
+            if failures is not None:
+                failures[batch_code] = {'error': 'NotFound', 'status': resp.status_code, 'message': f"No batchId found for {batch_code}"}
     except Exception as e:
         logging.error(f"BatchId fetch failed for {batch_code}: {e}")
+        if failures is not None:
+            failures[batch_code] = {'error': e}
     return None
 
 def parse_csv(input_path: str) -> List[Dict[str, Any]]:
@@ -185,11 +166,28 @@ def parse_csv(input_path: str) -> List[Dict[str, Any]]:
     logging.info(f"parse_csv: Total records processed: {count}")
     return rows
 
+OUTPUT_FIELDS = list(records.Enrolment.FIELDS)
+
+def parse_output_csv(output_path: str) -> List[records.Enrolment]:
+    """parse_csv for an output CSV of generate: the rows as compact Enrolment records (common/records.py)."""
+    rows = []
+    with open(output_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        count = 0
+        for row in reader:
+            # Trim spaces from all field values
+            get = row.get
+            rows.append(records.Enrolment(*[(get(field) or '').strip() for field in OUTPUT_FIELDS]))
+            count += 1
+            if count % 100 == 0:
+                logging.info(f"parse_output_csv: Processed {count} records so far...")
+    logging.info(f"parse_output_csv: Total records processed: {count}")
+    return rows
+
 def write_csv(output_path: str, rows: List[Dict[str, Any]]):
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    fieldnames = ["email", "userId", "userName", "learnerProfileCode", "courseCode", "courseId", "courseName", "batchName", "batchId", "completedOn"]
     with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=OUTPUT_FIELDS)
         writer.writeheader()
         count = 0
         for row in rows:
@@ -199,53 +197,192 @@ def write_csv(output_path: str, rows: List[Dict[str, Any]]):
                 logging.info(f"write_csv: Written {count} records so far...")
     logging.info(f"write_csv: Total records written: {count}")
 
-def process(input_csv: str, output_csv: str, config: dict):
-    logging.info(f"Starting process: Reading input CSV {input_csv}")
-    input_rows = parse_csv(input_csv)
-    output_rows = []
-    missing_users, missing_courses, missing_batches = set(), set(), set()
-    total, success = 0, 0
+def prepare_rows(input_rows: List[Dict[str, Any]]) -> Tuple[List[records.PreparedRow], int]:
+    """
+    Validate input rows before any API call: split Codes and completion dates and parse the dates.
+    Returns (prepared, skipped) where prepared has one PreparedRow per valid input row:
+    {'email', 'learnerProfileCode', 'entries': ((code, completedOn), ...)}.
+    """
+    # Date format order is inferred once for the completion date column
+    date_normalizer = DateNormalizer.for_values(
+        d for row in input_rows for d in (row.get('cours complétés le') or '').split(','))
+    prepared, skipped = [], 0
     for row in input_rows:
         email = row['email']
-        learnerProfileCode = row['Groupe']
         codes = [c.strip() for c in row['Codes'].split(',')]
         dates = [d.strip() for d in row['cours complétés le'].split(',')]
         if len(codes) != len(dates):
             logging.warning(f"Codes and dates count mismatch for {email}")
+            skipped += 1
             continue
-        userId, userName = fetch_user_id_and_name(email, config)
-        if not userId:
-            missing_users.add(email)
-        valid = True
         parsed_dates = []
         # If only one code/date, allow MM/DD/YYYY parsing
-        if len(codes) == 1 and len(dates) == 1:
-            parsed = convert_date(dates[0], try_mmddyyyy=True)
+        if len(codes) == 1:
+            parsed = date_normalizer.convert(dates[0], try_mmddyyyy=True)
             if not parsed:
                 logging.warning(f"Skipping row for {email}: invalid completion date '{dates[0]}' in '{row['cours complétés le']}' (single entry, tried MM/DD/YYYY)")
+                skipped += 1
                 continue
             parsed_dates.append(parsed)
         else:
             for d in dates:
-                parsed = convert_date(d)
+                parsed = date_normalizer.convert(d)
                 if not parsed:
                     logging.warning(f"Skipping row for {email}: invalid completion date '{d}' in '{row['cours complétés le']}'")
-                    valid = False
                     break
                 parsed_dates.append(parsed)
-            if not valid:
+            if len(parsed_dates) != len(dates):
+                skipped += 1
                 continue
-        if not valid:
+        prepared.append(records.PreparedRow(email=email, learnerProfileCode=row['Groupe'], entries=zip(codes, parsed_dates)))
+    logging.info(f"prepare_rows: {len(prepared)} valid rows, {skipped} skipped")
+    return prepared, skipped
+
+def prepare_chunk(input_csv: str, start: int, end: int, fieldnames: List[str], worker: bool = False) -> Tuple[List[records.PreparedRow], int]:
+    """prepare_rows for one byte range of the input CSV (--ingest parallel, see common/chunked.py)."""
+    if worker:
+        logging_setup.setup_worker_logging()
+    return prepare_rows(chunked.read_rows(input_csv, start, end, fieldnames))
+
+def prepare_input(input_csv: str, ingest: str = 'rows', workers: int = None) -> Tuple[List[records.PreparedRow], int]:
+    if ingest == 'columnar':
+        from common import columnar
+        return columnar.prepare_enrolments(input_csv)
+    if ingest == 'parallel':
+        prepared, skipped = [], 0
+        for chunk_rows, chunk_skipped in chunked.map_chunks(input_csv, prepare_chunk, workers):
+            prepared.extend(chunk_rows)
+            skipped += chunk_skipped
+        logging.info(f"prepare_input: {len(prepared)} valid rows, {skipped} skipped (ingest=parallel)")
+        return prepared, skipped
+    return prepare_rows(parse_csv(input_csv))
+
+def row_hash(row: Dict[str, Any]) -> str:
+    """Content hash of a prepared input row (after trimming and date normalization)."""
+    content = json.dumps([row['email'], row['learnerProfileCode'], row['entries']], ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def load_previous_from_csvs(previous_input: str, previous_output: str, ingest: str = 'rows',
+                            workers: int = None) -> Dict[str, List[records.Enrolment]]:
+    """
+    Rebuild {row hash: output rows} from a previous generate run's input and output CSVs.
+    Only input rows whose every code/date made it into the previous output are included,
+    so rows that failed to resolve last time are resolved again.
+    """
+    prepared, _ = prepare_input(previous_input, ingest, workers)
+    by_entry = {}
+    for out in parse_output_csv(previous_output):
+        by_entry[(out['email'], out['learnerProfileCode'], out['courseCode'], out['completedOn'])] = out
+    previous = {}
+    for row in prepared:
+        outputs = [by_entry.get((row['email'], row['learnerProfileCode'], code, completed_on)) for code, completed_on in row['entries']]
+        if all(outputs):
+            previous[row_hash(row)] = outputs
+    logging.info(f"load_previous_from_csvs: {len(previous)} resolved rows carried over from {previous_input} / {previous_output}")
+    return previous
+
+def load_manifest(path: str) -> Dict[str, List[records.Enrolment]]:
+    """Read a row-hash manifest written by a previous generate run (one JSON object per line)."""
+    previous = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                previous[entry['hash']] = [records.Enrolment.from_mapping(row) for row in entry['rows']]
+    logging.info(f"load_manifest: {len(previous)} resolved rows loaded from {path}")
+    return previous
+
+def write_manifest(path: str, resolved: Dict[str, List[Dict[str, Any]]]):
+    dir_name = os.path.dirname(path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for h, rows in resolved.items():
+            f.write(json.dumps({'hash': h, 'rows': rows}, ensure_ascii=False, default=records.to_json) + '\n')
+    os.replace(tmp_path, path)
+    logging.info(f"write_manifest: {len(resolved)} resolved rows written to {path}")
+
+def default_delta_path(output_csv: str) -> str:
+    root, ext = os.path.splitext(output_csv)
+    return f"{root}_delta{ext or '.csv'}"
+
+def process(input_csv: str, output_csv: str, config: dict, ingest: str = 'rows',
+            previous: Dict[str, List[records.Enrolment]] = None, delta_csv: str = None, manifest_path: str = None, sink=None,
+            prepared: List[Dict[str, Any]] = None, rejects_context: Dict[str, Any] = None):
+    """
+    Resolve the input CSV into output_csv. In delta mode (`previous` given), rows whose content hash
+    was fully resolved before are carried forward without any API call, and only the output rows
+    that are new since the previous run are also written to delta_csv.
+    sink, if given, is called with the output records of each input row as soon as they are resolved.
+    Entries that cannot be resolved are journaled (common/rejects.py) with rejects_context, by default
+    this output_csv; retry-failed passes already prepared rows and the output they belong to.
+    """
+    if prepared is None:
+        logging.info(f"Starting process: Reading input CSV {input_csv} (ingest={ingest})")
+        # All validation happens before the first lookup API call
+        prepared, skipped = prepare_input(input_csv, ingest, config.get('ingest_workers'))
+    else:
+        skipped = 0
+    rejects_context = rejects_context or {'output': output_csv}
+    delta_mode = previous is not None
+    previous = previous or {}
+    previous_outputs = {tuple(r[f] for f in OUTPUT_FIELDS) for rows in previous.values() for r in rows}
+    resolved = {}
+    carried, delta_rows = 0, []
+    output_rows = []
+    missing_users, missing_courses, missing_batches = set(), set(), set()
+    # User, course and batch lookups repeat across rows; successful results are reused for the whole run
+    caches = LOOKUP_CACHES if LOOKUP_CACHES is not None else {}
+    user_cache, course_cache, batch_cache = (caches.setdefault(name, {}) for name in ('user', 'course', 'batch'))
+    # Why the lookups of this run found nothing, for the rejects file
+    user_failures, course_failures, batch_failures = {}, {}, {}
+    progress = metrics.stage('generate', total=len(prepared) + skipped)
+    progress.fail(skipped)
+    total, success = 0, 0
+    for row_number, row in enumerate(prepared, 1):
+        if row_number % 100 == 0:
+            logging.info(f"process: Processed {row_number} valid input rows so far... {progress.status()}")
+        h = row_hash(row)
+        if h in previous:
+            output_rows.extend(previous[h])
+            resolved[h] = previous[h]
+            if sink and previous[h]:
+                sink(previous[h])
+            carried += 1
+            progress.ok()
             continue
-        userId, userName = fetch_user_id_and_name(email, config)
+        email = row['email']
+        learnerProfileCode = row['learnerProfileCode']
+        row_outputs = []
+        metrics.cache_lookup('user', email in user_cache)
+        if email in user_cache:
+            userId, userName = user_cache[email]
+        else:
+            userId, userName = fetch_user_id_and_name(email, config, user_failures)
+            if userId:
+                user_cache[email] = (userId, userName)
         if not userId:
             missing_users.add(email)
-        for code, completedOn_fmt in zip(codes, parsed_dates):
-            courseId, courseName = fetch_course_id_and_name(code, config)
+        row_complete = True
+        for code, completedOn_fmt in row['entries']:
+            metrics.cache_lookup('course', code in course_cache)
+            if code in course_cache:
+                courseId, courseName = course_cache[code]
+            else:
+                courseId, courseName = fetch_course_id_and_name(code, config, course_failures)
+                if courseId:
+                    course_cache[code] = (courseId, courseName)
             if not courseId:
                 missing_courses.add(code)
             batchName = f"{code}_{learnerProfileCode}"
-            batchId = fetch_batch_id(batchName, config) or ''
+            metrics.cache_lookup('batch', batchName in batch_cache)
+            if batchName in batch_cache:
+                batchId = batch_cache[batchName]
+            else:
+                batchId = fetch_batch_id(batchName, config, batch_failures) or ''
+                if batchId:
+                    batch_cache[batchName] = batchId
             if not batchId:
                 missing_batches.add(batchName)
             # Skip record if any of userId, courseId, or batchId is empty
@@ -257,24 +394,42 @@ def process(input_csv: str, output_csv: str, config: dict):
                     missing_courses.add(code)
                 if not batchId:
                     missing_batches.add(batchName)
+                if not userId:
+                    failure = user_failures.get(email)
+                elif not courseId:
+                    failure = course_failures.get(code)
+                else:
+                    failure = batch_failures.get(batchName)
+                rejects.record('generate', {'email': email, 'learnerProfileCode': learnerProfileCode, 'entries': [[code, completedOn_fmt]]},
+                               context=rejects_context, **(failure or {'error': 'NotFound'}))
+                row_complete = False
                 continue
-            output_rows.append({
-                "email": email,
-                "userId": userId,
-                "userName": userName or '',
-                "learnerProfileCode": learnerProfileCode,
-                "courseCode": code,
-                "courseId": courseId,
-                "courseName": courseName or '',
-                "batchName": batchName,
-                "batchId": batchId,
-                "completedOn": completedOn_fmt
-            })
+            row_outputs.append(records.Enrolment(
+                email=email,
+                userId=userId,
+                userName=userName or '',
+                learnerProfileCode=learnerProfileCode,
+                courseCode=code,
+                courseId=courseId,
+                courseName=courseName or '',
+                batchName=batchName,
+                batchId=batchId,
+                completedOn=completedOn_fmt
+            ))
             total += 1
             if total % 100 == 0:
                 logging.info(f"process: Processed {total} output records so far...")
             success += 1
-    logging.info(f"process: Total output records processed: {total}")
+        output_rows.extend(row_outputs)
+        if sink and row_outputs:
+            sink(row_outputs)
+        delta_rows.extend(r for r in row_outputs if tuple(r[f] for f in OUTPUT_FIELDS) not in previous_outputs)
+        if row_complete:
+            resolved[h] = row_outputs
+            progress.ok()
+        else:
+            progress.fail()
+    logging.info(f"process: Total output records processed: {total} {progress.status()}")
     logging.info(f"process: Total processed: {total}, Success: {success}")
     if missing_users:
         logging.warning(f"Missing userIds for: {sorted(missing_users)}")
@@ -285,8 +440,112 @@ def process(input_csv: str, output_csv: str, config: dict):
     # Only valid and complete records are written to output_rows and the CSV.
     # No missing users/courses/batches are added to the CSV.
     write_csv(output_csv, output_rows)
+    if delta_mode:
+        logging.info(f"process: Delta mode: {carried} unchanged rows carried forward, {len(prepared) - carried} rows resolved, "
+                     f"{len(delta_rows)} new output records")
+        write_csv(delta_csv or default_delta_path(output_csv), delta_rows)
+    if manifest_path:
+        write_manifest(manifest_path, resolved)
     return output_rows
 
+PLAN_FIELDS = OUTPUT_FIELDS + ["sourceRecords"]
+PLAN_RULES = ('latest', 'earliest', 'last')
+
+def supersedes(row: Dict[str, Any], current: Dict[str, Any], rule: str = 'latest') -> bool:
+    """Whether row wins over current, an earlier record with the same key, under the plan rule."""
+    return (current is None or rule == 'last'
+            or (rule == 'latest' and row['completedOn'] > current['completedOn'])
+            or (rule == 'earliest' and row['completedOn'] < current['completedOn']))
+
+def plan_writes(rows: List[Dict[str, Any]], rule: str = 'latest') -> List[records.PlannedWrite]:
+    """
+    Collapse records with the same (userId, courseId, batchId) into one write and sort the result
+    by the Cassandra primary key, so each row is written once and writes to a partition are adjacent.
+    rule decides which record wins: 'latest' / 'earliest' completedOn, or 'last' in input order.
+    Each planned record carries sourceRecords, the number of input records it replaces.
+    """
+    if rule not in PLAN_RULES:
+        raise ValueError(f"Unknown plan rule '{rule}', expected one of {PLAN_RULES}")
+    planned, counts = {}, {}
+    incomplete = 0
+    for row in rows:
+        key = (row['userId'], row['courseId'], row['batchId'])
+        if not all(key):
+            incomplete += 1
+            continue
+        counts[key] = counts.get(key, 0) + int(row.get('sourceRecords') or 1)
+        if supersedes(row, planned.get(key), rule):
+            planned[key] = row
+    plan = []
+    for key in sorted(planned):
+        winner = planned[key]
+        plan.append(records.PlannedWrite(*[winner.get(f, '') for f in OUTPUT_FIELDS], sourceRecords=counts[key]))
+    collapsed = sum(counts.values()) - len(plan)
+    logging.info(f"plan_writes: {len(rows)} records -> {len(plan)} writes ({collapsed} duplicates collapsed with rule '{rule}', "
+                 f"{incomplete} incomplete skipped)")
+    return plan
+
+def write_plan(plan_path: str, plan: List[Dict[str, Any]]):
+    dir_name = os.path.dirname(plan_path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    with open(plan_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=PLAN_FIELDS)
+        writer.writeheader()
+        writer.writerows(plan)
+    users = len({row['userId'] for row in plan})
+    batches = len({(row['courseId'], row['batchId']) for row in plan})
+    logging.info(f"write_plan: {len(plan)} writes for {users} users in {batches} course batches written to {plan_path}")
+
+EXPORT_COLUMNS = ['userid', 'courseid', 'batchid', 'completedon', 'issued_certificates']
+DEFAULT_EXPORT_CHUNK_ROWS = 1000000
+
+def export_bulk_load(rows: List[Dict[str, Any]], config: dict, export_dir: str, chunk_rows: int = DEFAULT_EXPORT_CHUNK_ROWS) -> dict:
+    """
+    Write the planned updates as cqlsh COPY FROM / DSBulk CSV files for the user_enrolments table,
+    plus manifest.json with per-file row counts and SHA-256 checksums.
+    Unlike the UPDATE ... IF EXISTS path, a bulk load upserts: keys missing in Cassandra are created.
+    """
+    keyspace = config.get('cassandra', {}).get('keyspace', 'sunbird_courses')
+    table = config.get('cassandra', {}).get('user_enrolments_table', 'user_enrolments')
+    plan = plan_writes(rows, config.get('plan_rule', 'latest'))
+    os.makedirs(export_dir, exist_ok=True)
+    files = []
+    for start in range(0, len(plan), chunk_rows):
+        name = f"{table}_{len(files) + 1:05d}.csv"
+        path = os.path.join(export_dir, name)
+        digest = hashlib.sha256()
+        with open(path, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile, lineterminator='\n')
+            writer.writerow(EXPORT_COLUMNS)
+            for row in plan[start:start + chunk_rows]:
+                # completedOn is a UTC midnight; the explicit offset parses the same in cqlsh and DSBulk.
+                # An empty issued_certificates loads as null, like "SET issued_certificates = null".
+                writer.writerow([row['userId'], row['courseId'], row['batchId'], f"{row['completedOn']}+0000", ''])
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        count = min(chunk_rows, len(plan) - start)
+        files.append({'file': name, 'rows': count, 'bytes': os.path.getsize(path), 'sha256': digest.hexdigest()})
+        logging.info(f"export_bulk_load: Written {count} rows to {path}")
+    columns = ', '.join(EXPORT_COLUMNS)
+    manifest = {
+        'keyspace': keyspace,
+        'table': table,
+        'columns': EXPORT_COLUMNS,
+        'rows': len(plan),
+        'source_records': len(rows),
+        'plan_rule': config.get('plan_rule', 'latest'),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'files': files,
+        'cqlsh': [f"COPY {keyspace}.{table} ({columns}) FROM '{f['file']}' WITH HEADER = TRUE;" for f in files],
+        'dsbulk': f"dsbulk load -url {export_dir} -k {keyspace} -t {table} -header true",
+    }
+    with open(os.path.join(export_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(f"export_bulk_load: {len(plan)} rows in {len(files)} files, manifest written to {os.path.join(export_dir, 'manifest.json')}")
+    return manifest
+
 def generate_cassandra_queries(rows: List[Dict[str, Any]], config: dict):
     queries = []
     keyspace = config.get('cassandra', {}).get('keyspace', 'your_keyspace')
@@ -306,7 +565,11 @@ def generate_cassandra_queries(rows: List[Dict[str, Any]], config: dict):
     logging.info(f"generate_cassandra_queries: Total queries generated: {count}")
     return queries
 
-def execute_cassandra_queries(queries, cassandra_config):
+def execute_cassandra_queries(queries, cassandra_config, progress=None, rows=None):
+    """
+    Run the queries one by one; a failed query is journaled with rows[i] (the record it writes) when rows are given.
+    Returns the indexes of the queries that failed.
+    """
     import sys
     # Check Python version
     major, minor = sys.version_info[:2]
@@ -314,7 +577,7 @@ def execute_cassandra_queries(queries, cassandra_config):
         logging.error("Python 3.12+ is not supported by cassandra-driver. Please use Python 3.11 or lower for actual Cassandra updates.")
         sys.exit(1)
     try:
-        from cassandra.cluster import Cluster
+        import cassandra.cluster  # noqa: F401
     except ImportError:
         logging.error("cassandra-driver is not installed. Run 'pip install cassandra-driver' to enable actual updates.")
         sys.exit(1)
@@ -329,69 +592,168 @@ def execute_cassandra_queries(queries, cassandra_config):
         host = url
         port = 9042
     processed = 0
+    failed = []
+    table = cassandra_config.get('user_enrolments_table', 'user_enrolments')
     try:
-        cluster = Cluster([host], port=port)
-        session = cluster.connect(cassandra_config['keyspace'])
-        for query in queries:
+        # Reused by every batch of the run (and every job of a worker)
+        session = connections.cassandra_session(host, port, cassandra_config['keyspace'])
+        for i, query in enumerate(queries):
             try:
-                session.execute(query)
+                metrics.execute_cassandra(session, query, table=table)
                 processed += 1
+                if progress:
+                    progress.ok()
                 if processed % 100 == 0:
                     logging.info(f"execute_cassandra_queries: Executed {processed} queries so far...")
-                logging.info(f"[CASSANDRA] Executed: {query}")
+                if logging_setup.sample('cassandra_execute'):
+                    logging.info(f"[CASSANDRA] Executed: {query}")
             except Exception as e:
                 logging.error(f"[CASSANDRA] Failed: {query}\nError: {e}")
-        session.shutdown()
-        cluster.shutdown()
+                rejects.record('update', dict(rows[i]) if rows else {'cql': query}, error=e, context={'table': table})
+                failed.append(i)
+                if progress:
+                    progress.fail()
     except Exception as e:
         logging.error(f"[CASSANDRA] Connection failed: {e}")
         sys.exit(1)
     logging.info(f"execute_cassandra_queries: Total queries executed: {processed}")
+    return failed
 
 def update_cassandra(rows: List[Dict[str, Any]], config: dict, dry_run: bool):
     logging.info(f"update_cassandra called. Rows to process: {len(rows)}")
+    # Idempotent on an existing plan; guarantees one write per key for a raw generate output too
+    rows = plan_writes(rows, config.get('plan_rule', 'latest'))
+    # The rows a query is generated for, in the same order, so a failed write is journaled with its record
+    rows = [row for row in rows if row['userId'] and row['courseId'] and row['batchId']]
     queries = generate_cassandra_queries(rows, config)
     batch_size = config.get('batch_size', 50)
     cassandra_url = config.get('cassandra', {}).get('connection_url', 'cassandra://localhost:9042')
     sleep_time = config.get('cassandra_batch_sleep', 0.1)
+    progress = metrics.stage('update', total=len(queries))
     processed = 0
+    if dry_run:
+        # One plan line per statement instead of logging each one; no throttling sleeps
+        logging.info(f"[DRY RUN] Would execute {len(queries)} queries on {cassandra_url} in batches of {batch_size}")
+        table = config.get('cassandra', {}).get('user_enrolments_table', 'user_enrolments')
+        with dryrun.PlanWriter.from_config(config, DRY_RUN_PLAN) as plan:
+            for q in queries:
+                plan.add(f"UPDATE {table}", cql=q)
+        progress.ok(len(queries))
+        logging.info(f"update_cassandra: Total queries processed: {len(queries)}")
+        return
     for i in range(0, len(queries), batch_size):
         batch = queries[i:i+batch_size]
-        if dry_run:
-            logging.info(f"[DRY RUN] Would execute batch on {cassandra_url}:")
-            for q in batch:
-                logging.info(q)
-        else:
-            execute_cassandra_queries(batch, config['cassandra'])
+        execute_cassandra_queries(batch, config['cassandra'], progress, rows[i:i+batch_size])
         processed += len(batch)
-        logging.info(f"update_cassandra: Processed {processed} queries so far...")
+        logging.info(f"update_cassandra: Processed {processed} queries so far... {progress.status()}")
         sleep(sleep_time)
     logging.info(f"update_cassandra: Total queries processed: {processed}")
 
-def main():
-    setup_logging()
-    parser = argparse.ArgumentParser(description="CSV to Cassandra migration utility. Two steps: generate (CSV), update (Cassandra). Run from the project root.")
-    parser.add_argument('command', choices=['generate', 'update'], help="Step to run: 'generate' to create user_enrolments_output.csv, 'update' to update Cassandra from user_enrolments_output.csv")
+def verify_cassandra(rows: List[Dict[str, Any]], config: dict, report_path: str, concurrency: int = verify.DEFAULT_CONCURRENCY):
+    """
+    Read back the writes update_cassandra makes for these rows, one SELECT per userid partition, and write
+    the rows whose completedon or issued_certificates differ (or that are missing) to report_path.
+    """
+    cassandra_cfg = config.get('cassandra', {})
+    keyspace = cassandra_cfg.get('keyspace', 'sunbird_courses')
+    table = cassandra_cfg.get('user_enrolments_table', 'user_enrolments')
+    # The same deduplication as update_cassandra, so each key is compared with the value that won
+    plan = plan_writes(rows, config.get('plan_rule', 'latest'))
+    expected = verify.group_by_partition(
+        ((row['userId'],), (row['courseId'], row['batchId']), {'completedon': row['completedOn'], 'issued_certificates': None})
+        for row in plan)
+    logging.info(f"verify_cassandra: Reading back {len(plan)} rows in {len(expected)} partitions ({concurrency} reads in flight)")
+    host, port = verify.split_host_port(cassandra_cfg.get('connection_url', 'cassandra://localhost:9042'))
+    session = verify.cassandra_session(host, port, keyspace)
+    query = f"SELECT courseid, batchid, completedon, issued_certificates FROM {keyspace}.{table} WHERE userid = ?"
+    checks = {
+        'completedon': lambda expected_value, actual: verify.normalize_timestamp(actual) == verify.normalize_timestamp(expected_value),
+        'issued_certificates': lambda expected_value, actual: verify.is_empty(actual),
+    }
+    return verify.verify_partitions(session, table, query, expected, ('userid',), ('courseid', 'batchid'), checks,
+                                    report_path, concurrency)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CSV to Cassandra migration utility. Steps: generate (CSV), plan (deduplicated write plan, optional), update (Cassandra). Run from the project root.")
+    parser.add_argument('command', choices=['generate', 'plan', 'update', 'export', 'verify'], help="Step to run: 'generate' to create user_enrolments_output.csv, 'plan' to write the deduplicated write plan from it, 'update' to update Cassandra from the output CSV or the plan, 'export' to write cqlsh COPY / DSBulk files instead, 'verify' to read the updated rows back and report the ones that differ")
     parser.add_argument('--config', default='config.yaml', help='Path to config.yaml (relative to project root)')
     parser.add_argument('--input', default='user_enrolments_update/user_enrolments_input.csv', help='Input CSV (relative to project root, for generate)')
     parser.add_argument('--output', default='user_enrolments_update/user_enrolments_output.csv', help='Output CSV (relative to project root, for generate and update)')
+    parser.add_argument('--plan', default='user_enrolments_update/user_enrolments_plan.csv', help='Write plan CSV written by plan (relative to project root)')
+    parser.add_argument('--plan-rule', choices=PLAN_RULES, help="Which duplicate (userId, courseId, batchId) record wins: latest (default) or earliest completedOn, or last in input order. Overrides config 'plan_rule'")
+    parser.add_argument('--export-dir', default='user_enrolments_update/export', help='Directory for the export CSV files and manifest.json (relative to project root)')
+    parser.add_argument('--export-chunk-rows', type=int, default=DEFAULT_EXPORT_CHUNK_ROWS, help=f'Rows per export CSV file (default {DEFAULT_EXPORT_CHUNK_ROWS})')
+    parser.add_argument('--previous-input', help='Delta mode (generate): input CSV of the previous run; use with --previous-output')
+    parser.add_argument('--previous-output', help='Delta mode (generate): output CSV of the previous run; use with --previous-input')
+    parser.add_argument('--manifest', help='Delta mode (generate): row-hash manifest. Read as the previous run if it exists (and no --previous-input is given), then rewritten')
+    parser.add_argument('--delta-output', help='Delta mode (generate): CSV of only the new output records (default: <output>_delta.csv)')
+    parser.add_argument('--verify-report', default='user_enrolments_update/verify_mismatches.csv', help='Verify: CSV of the rows that are missing or differ from the output CSV (relative to project root)')
+    parser.add_argument('--verify-concurrency', type=int, help=f"Verify: SELECTs in flight at once. Overrides config 'verify_concurrency' (default {verify.DEFAULT_CONCURRENCY})")
     parser.add_argument('--dry_run', type=str, choices=['true', 'false'], help='Override dry_run from config (true/false)')
-    args = parser.parse_args()
+    parser.add_argument('--ingest', choices=['rows', 'columnar', 'parallel'], help="Input preparation for generate: 'rows' (default, csv module), 'columnar' (pyarrow, vectorized; needs pyarrow) or 'parallel' (csv module in a process per CPU). Overrides config 'ingest'")
+    parser.add_argument('--ingest-workers', type=int, help="Processes for --ingest parallel. Overrides config 'ingest_workers' (default: one per available CPU)")
+    dryrun.add_cli_arguments(parser)
+    metrics.add_cli_arguments(parser)
+    profiling.add_cli_arguments(parser)
+    rejects.add_cli_arguments(parser)
+    args = parser.parse_args(argv)
     config = load_config(args.config)
+    logging_setup.setup_logging(LOG_FILE, config)
+    metrics.setup_from_args(args, config)
+    profiling.setup_from_args(args, config, f"process_csv-{args.command}")
+    if args.command in ('generate', 'update'):
+        rejects.setup_from_args(args, config, f"process_csv-{args.command}")
+    dryrun.apply_cli_arguments(args, config)
+    if args.plan_rule:
+        config['plan_rule'] = args.plan_rule
+    if args.ingest_workers:
+        config['ingest_workers'] = args.ingest_workers
     dry_run = config.get('dry_run', True)
     if args.dry_run is not None:
         dry_run = args.dry_run.lower() == 'true'
 
-    if args.command == 'generate':
-        process(args.input, args.output, config)
-    elif args.command == 'update':
-        if not os.path.exists(args.output):
-            logging.error(f"Output CSV '{args.output}' not found. Please run the 'generate' step first to create it.")
-            sys.exit(1)
-        rows = parse_csv(args.output)
-        update_cassandra(rows, config, dry_run)
-    else:
-        parser.print_help()
+    with profiling.stage(args.command):
+        if args.command == 'generate':
+            ingest = args.ingest or config.get('ingest', 'rows')
+            previous = None
+            if args.previous_input or args.previous_output:
+                if not (args.previous_input and args.previous_output):
+                    logging.error("--previous-input and --previous-output must be given together.")
+                    sys.exit(1)
+                previous = load_previous_from_csvs(args.previous_input, args.previous_output, ingest, config.get('ingest_workers'))
+            elif args.manifest and os.path.exists(args.manifest):
+                previous = load_manifest(args.manifest)
+            process(args.input, args.output, config, ingest=ingest, previous=previous,
+                    delta_csv=args.delta_output, manifest_path=args.manifest)
+        elif args.command == 'plan':
+            if not os.path.exists(args.output):
+                logging.error(f"Output CSV '{args.output}' not found. Please run the 'generate' step first to create it.")
+                sys.exit(1)
+            write_plan(args.plan, plan_writes(parse_output_csv(args.output), config.get('plan_rule', 'latest')))
+        elif args.command == 'export':
+            if not os.path.exists(args.output):
+                logging.error(f"Output CSV '{args.output}' not found. Please run the 'generate' step first to create it.")
+                sys.exit(1)
+            export_bulk_load(parse_output_csv(args.output), config, args.export_dir, args.export_chunk_rows)
+        elif args.command == 'update':
+            if not os.path.exists(args.output):
+                logging.error(f"Output CSV '{args.output}' not found. Please run the 'generate' step first to create it.")
+                sys.exit(1)
+            rows = parse_output_csv(args.output)
+            update_cassandra(rows, config, dry_run)
+        elif args.command == 'verify':
+            if not os.path.exists(args.output):
+                logging.error(f"Output CSV '{args.output}' not found. Please run the 'generate' step first to create it.")
+                sys.exit(1)
+            counts = verify_cassandra(parse_output_csv(args.output), config, args.verify_report,
+                                      args.verify_concurrency or int(config.get('verify_concurrency', verify.DEFAULT_CONCURRENCY)))
+        else:
+            parser.print_help()
+    rejects.close()
+    profiling.finish()
+    metrics.finish_from_args(args)
+    if args.command == 'verify' and counts['verified'] < sum(counts.values()):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
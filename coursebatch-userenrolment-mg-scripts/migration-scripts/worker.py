@@ -0,0 +1,296 @@
+# NOTE: Run this script from the project root (migration-scripts) for all default paths to work.
+"""
+Long-running worker for the userEnrolmentsUpdate Deployment.
+
+Takes migration jobs -- a migrate.py command plus its options -- from a local
+HTTP endpoint and/or a spool directory and runs them in this process, one
+after another or --concurrency at a time. The HTTP session, Cassandra sessions,
+Kafka producers (common/connections.py) and the user/course/batch lookup
+caches stay warm between jobs, so a small correction starts immediately.
+
+    POST /jobs          {"command": "update", "args": ["--dry_run", "false"]}  -> 202 {"id": ...}
+    GET  /jobs          all jobs of this worker, GET /jobs/<id> one of them
+    POST /caches/clear  forget the cached lookups
+    GET  /healthz
+
+Spool: a <name>.json file with the same body renamed into <spool>/incoming/
+(write it elsewhere first, so it is complete when picked up) is moved to
+running/ while it runs, then to done/ or failed/ next to a <name>.result.json.
+Jobs left in running/ by a killed worker go to failed/.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import connections, logging_setup, metrics, profiling
+import migrate
+
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.log')
+DEFAULT_PORT = 8080
+DEFAULT_POLL_SECONDS = 2.0
+SPOOL_DIRS = ('incoming', 'running', 'done', 'failed')
+# Commands that journal rejected rows (common/rejects.py). The journal is process-wide, so these
+# jobs run one at a time whatever --concurrency is, and each one gets its own rejects file
+JOURNALING_COMMANDS = {'generate', 'update', 'course-batches', 'delete-es', 'reconcile-es', 'push-kafka', 'post-update', 'pipeline', 'retry-failed'}
+
+
+def load_config(path: str) -> dict:
+    import yaml
+    if not os.path.exists(path):
+        print(f"\nERROR: Config file '{path}' not found.")
+        sys.exit(1)
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
+
+
+class Worker:
+    def __init__(self, concurrency: int = 1, spool_dir: str = None, poll_seconds: float = DEFAULT_POLL_SECONDS):
+        self.concurrency = max(1, concurrency)
+        self.spool_dir = spool_dir
+        self.poll_seconds = poll_seconds
+        self.jobs = OrderedDict()
+        self.caches = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._runners = []
+        self._server = None
+        if self.concurrency > 1:
+            # The profiling session is process-wide; a job profiled from its config runs unprofiled
+            profiling.disable(f"the worker runs {self.concurrency} jobs at a time")
+        # Lookups resolved by one job are reused by the next
+        migrate.load_script('user_enrolments_update/process_csv.py').LOOKUP_CACHES = self.caches
+
+    def submit(self, body: dict, job_id: str = None, spool_file: str = None) -> dict:
+        """Validate and queue a job. Raises ValueError for a bad job."""
+        if not isinstance(body, dict):
+            raise ValueError('job must be a JSON object')
+        command, args = body.get('command'), body.get('args', [])
+        if command not in migrate.COMMANDS or command == 'worker':
+            raise ValueError(f"command must be one of {[c for c in migrate.COMMANDS if c != 'worker']}, got {command!r}")
+        if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+            raise ValueError('args must be a list of strings')
+        if self._stopping.is_set():
+            raise ValueError('worker is shutting down')
+        if self.concurrency > 1 and any(arg.startswith('--profile=') for arg in migrate.split_shared_options(args)[0]):
+            raise ValueError('--profile needs a worker with --concurrency 1: concurrent jobs would share one profiling session')
+        job = {'id': job_id or uuid.uuid4().hex[:12], 'command': command, 'args': args, 'status': 'queued', 'submitted_at': _now()}
+        with self._lock:
+            if job['id'] in self.jobs:
+                # The same spool file name dropped again
+                job['id'] = f"{job['id']}-{uuid.uuid4().hex[:6]}"
+            self.jobs[job['id']] = job
+        job['_spool_file'] = spool_file
+        self._queue.put(job['id'])
+        logging.info(f"Job {job['id']} queued: {command} {' '.join(args)}")
+        return self.describe(job)
+
+    @staticmethod
+    def describe(job: dict) -> dict:
+        return {k: v for k, v in job.items() if not k.startswith('_')}
+
+    def run_job(self, job: dict):
+        with self._journal_lock if job['command'] in JOURNALING_COMMANDS else nullcontext():
+            self._run_job(job)
+
+    def _run_job(self, job: dict):
+        command = job['command']
+        _, prefix, _ = migrate.COMMANDS[command]
+        shared, rest = migrate.split_shared_options(job['args'])
+        job.update(status='running', started_at=_now())
+        logging.info(f"Job {job['id']} started: {command} {' '.join(job['args'])}")
+        start = time.perf_counter()
+        try:
+            migrate.load_command(command)(shared + prefix + rest)
+            job['status'] = 'done'
+        except SystemExit as e:  # the scripts exit on fatal errors
+            job['status'] = 'done' if e.code in (None, 0) else 'failed'
+            if job['status'] == 'failed':
+                job['error'] = f"exit status {e.code}"
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed: {type(e).__name__}: {e}", exc_info=True)
+            job.update(status='failed', error=f"{type(e).__name__}: {e}")
+        # A job that exited early still writes its profile (--profile) before the next job starts one
+        profiling.finish()
+        job.update(finished_at=_now(), seconds=round(time.perf_counter() - start, 3))
+        logging.info(f"Job {job['id']} {job['status']} in {job['seconds']}s")
+        if job.get('_spool_file'):
+            self._finish_spool_file(job)
+
+    def _runner(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            self.run_job(self.jobs[job_id])
+
+    # --- Spool directory ------------------------------------------------------------
+
+    def _spool_path(self, state: str, name: str = '') -> str:
+        return os.path.join(self.spool_dir, state, name)
+
+    def _finish_spool_file(self, job: dict):
+        name = os.path.basename(job['_spool_file'])
+        target = 'done' if job['status'] == 'done' else 'failed'
+        os.replace(job['_spool_file'], self._spool_path(target, name))
+        with open(self._spool_path(target, f"{os.path.splitext(name)[0]}.result.json"), 'w', encoding='utf-8') as f:
+            json.dump(self.describe(job), f, indent=2)
+
+    def _reject_spool_file(self, path: str, error: str):
+        name = os.path.basename(path)
+        logging.error(f"Spool job {name} rejected: {error}")
+        os.replace(path, self._spool_path('failed', name))
+        with open(self._spool_path('failed', f"{os.path.splitext(name)[0]}.result.json"), 'w', encoding='utf-8') as f:
+            json.dump({'id': os.path.splitext(name)[0], 'status': 'failed', 'error': error}, f, indent=2)
+
+    def _poll_spool(self):
+        for state in SPOOL_DIRS:
+            os.makedirs(self._spool_path(state), exist_ok=True)
+        for name in sorted(os.listdir(self._spool_path('running'))):
+            if name.endswith('.json'):
+                self._reject_spool_file(self._spool_path('running', name), 'interrupted by a worker restart')
+        logging.info(f"Watching {self._spool_path('incoming')} for job files")
+        while not self._stopping.is_set():
+            for name in sorted(os.listdir(self._spool_path('incoming'))):
+                if not name.endswith('.json'):
+                    continue
+                # Moving the file claims it
+                path = self._spool_path('running', name)
+                os.replace(self._spool_path('incoming', name), path)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        body = json.load(f)
+                    self.submit(body, job_id=os.path.splitext(name)[0], spool_file=path)
+                except ValueError as e:
+                    self._reject_spool_file(path, str(e))
+            self._stopping.wait(self.poll_seconds)
+
+    # --- HTTP -----------------------------------------------------------------------
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        worker = self
+
+        class JobHandler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0].rstrip('/')
+                if path == '/healthz':
+                    self._reply(200, {'status': 'stopping' if worker._stopping.is_set() else 'ok', 'connections': connections.stats()})
+                elif path == '/jobs':
+                    with worker._lock:
+                        self._reply(200, [worker.describe(job) for job in worker.jobs.values()])
+                elif path.startswith('/jobs/') and path[len('/jobs/'):] in worker.jobs:
+                    self._reply(200, worker.describe(worker.jobs[path[len('/jobs/'):]]))
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                path = self.path.split('?', 1)[0].rstrip('/')
+                if path == '/caches/clear':
+                    worker.caches.clear()
+                    logging.info("Lookup caches cleared")
+                    self._reply(200, {'status': 'cleared'})
+                    return
+                if path != '/jobs':
+                    self._reply(404, {'error': 'not found'})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'null')
+                    self._reply(202, worker.submit(body))
+                except ValueError as e:
+                    self._reply(400, {'error': str(e)})
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), JobHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='worker-http', daemon=True).start()
+        logging.info(f"Accepting jobs on http://{host}:{self._server.server_address[1]}/jobs")
+        return self._server
+
+    # --- Lifecycle ------------------------------------------------------------------
+
+    def start(self):
+        for n in range(self.concurrency):
+            thread = threading.Thread(target=self._runner, name=f"job-runner-{n}", daemon=True)
+            thread.start()
+            self._runners.append(thread)
+        if self.spool_dir:
+            threading.Thread(target=self._poll_spool, name='spool', daemon=True).start()
+
+    def stop(self):
+        """Stop taking jobs, finish the queued and running ones, then close the pooled connections."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        logging.info("Worker stopping: finishing queued and running jobs")
+        if self._server is not None:
+            self._server.shutdown()
+        for _ in self._runners:
+            self._queue.put(None)
+        for thread in self._runners:
+            thread.join()
+        connections.close_all()
+        logging.info("Worker stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Long-running migration worker: runs migrate.py commands submitted over local HTTP "
+                                                 "or a spool directory, with connections and lookup caches kept warm. Run from the project root.")
+    parser.add_argument('--config', default='config.yaml', help='Path to config.yaml (worker settings only; jobs pass their own --config)')
+    parser.add_argument('--port', type=int, help=f"HTTP port for jobs, 0 to disable. Overrides config 'worker_port' (default {DEFAULT_PORT})")
+    parser.add_argument('--host', help="Address the HTTP endpoint binds to. Overrides config 'worker_host' (default 127.0.0.1, local only)")
+    parser.add_argument('--spool', help="Spool directory for job files (incoming/, running/, done/, failed/). Overrides config 'worker_spool' (default: disabled)")
+    parser.add_argument('--concurrency', type=int, help="Jobs run at the same time. Overrides config 'worker_concurrency' (default 1)")
+    parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS, help='How often the spool directory is checked')
+    metrics.add_cli_arguments(parser)
+    args = parser.parse_args(argv)
+    config = load_config(args.config) if os.path.exists(args.config) else {}
+    logging_setup.setup_logging(LOG_FILE, config)
+    metrics.setup_from_args(args, config)
+    port = args.port if args.port is not None else int(config.get('worker_port', DEFAULT_PORT))
+    spool = args.spool or config.get('worker_spool')
+    if not port and not spool:
+        logging.error("Nothing to take jobs from: give --port or --spool.")
+        sys.exit(1)
+    worker = Worker(args.concurrency or int(config.get('worker_concurrency', 1)), spool, args.poll_seconds)
+    worker.start()
+    if port:
+        worker.serve(port, args.host or config.get('worker_host', '127.0.0.1'))
+    stopped = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopped.set())
+    logging.info(f"Worker ready (concurrency={worker.concurrency})")
+    while not stopped.wait(1):
+        pass
+    worker.stop()
+    metrics.finish_from_args(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import csv
+import gzip
 import json
 import re
 import requests
 import argparse
 import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 
 CSV_FILE = 'fw-c-t.csv'
 
@@ -32,18 +39,186 @@ with open(CSV_FILE, 'r', encoding='utf-8') as f:
 # Store framework codes
 framework_codes = []
 
+class DryRunPlan:
+    """Requests a dry run would send, one compact JSON line each (gzipped if the path ends in .gz)."""
+
+    def __init__(self, path='dry_run_plan.ndjson', sample=5):
+        self.path = path
+        self.sample = sample
+        self.counts = Counter()
+        self.samples = []
+        self._file = None
+
+    def add(self, method, url, data=None):
+        if self._file is None:
+            self._file = gzip.open(self.path, 'wt', encoding='utf-8') if self.path.endswith('.gz') else open(self.path, 'w', encoding='utf-8')
+        # Headers are left out: they are the same for every request and carry the API key
+        line = json.dumps({'method': method, 'url': url, 'data': data}, ensure_ascii=False, separators=(',', ':'))
+        self._file.write(line + '\n')
+        endpoint = re.sub(r'/(update|publish)/[^/]+$', r'/\1/{id}', url.split('?')[0].replace(host, '', 1))
+        self.counts[f"{method} {endpoint}"] += 1
+        if len(self.samples) < self.sample:
+            self.samples.append(line)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        logging.info(f"Dry run: {sum(self.counts.values())} requests written to {self.path}")
+        for endpoint, count in sorted(self.counts.items()):
+            logging.info(f"Dry run:   {endpoint}: {count}")
+        for line in self.samples:
+            logging.info(f"Dry run sample: {line}")
+
+dry_run_plan = DryRunPlan()
+
+class SyncJournal:
+    """Append-only record of created frameworks, categories, terms and associations, flushed line by line."""
+
+    def __init__(self, path='sync_journal.ndjson'):
+        self.path = path
+        self._file = None
+
+    def record(self, kind, **fields):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        entry = {'kind': kind}
+        entry.update(fields)
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def load(self):
+        entries = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # A crash can leave the last line incomplete
+                        logging.warning(f"Ignoring unreadable journal line in {self.path}: {line.strip()[:200]}")
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+journal = SyncJournal()
+
+class StepProfiler:
+    """Per-step profile (--profile): wall vs CPU time, top functions and, in full mode, peak memory.
+
+    full   cProfile and tracemalloc; writes <dir>/<step>.prof (pstats, snakeviz)
+    sample the main thread's stack every `interval` seconds; cheap, writes <dir>/<step>.folded (flamegraph.pl, speedscope)
+    """
+
+    def __init__(self, mode=None, directory='profiles', interval=0.01, top=10):
+        self.mode = mode
+        self.directory = directory
+        self.interval = interval
+        self.top = top
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        if not self.mode:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        record = {'step': name, 'mode': self.mode}
+        stacks, stop, profile = Counter(), threading.Event(), None
+        if self.mode == 'full':
+            import cProfile
+            import tracemalloc
+            tracemalloc.start()
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            threading.Thread(target=self._sample, args=(threading.get_ident(), stacks, stop), daemon=True).start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall_start, 3)
+            record['cpu_s'] = round(time.process_time() - cpu_start, 3)
+            if profile is not None:
+                import pstats
+                import tracemalloc
+                profile.disable()
+                record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+                tracemalloc.stop()
+                path = os.path.join(self.directory, f"{name}.prof")
+                profile.dump_stats(path)
+                stats = pstats.Stats(profile).stats
+                record['top'] = [{'function': f"{func} ({os.path.basename(file)}:{line})", 'calls': nc, 'own_s': round(tt, 4), 'cumulative_s': round(ct, 4)}
+                                 for (file, line, func), (cc, nc, tt, ct, callers) in sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]]
+            else:
+                stop.set()
+                path = os.path.join(self.directory, f"{name}.folded")
+                with open(path, 'w', encoding='utf-8') as f:
+                    for stack, count in stacks.most_common():
+                        f.write(f"{';'.join(stack)} {count}\n")
+                own = Counter()
+                for stack, count in stacks.items():
+                    own[stack[-1]] += count
+                total = sum(own.values()) or 1
+                record['top'] = [{'function': function, 'share': round(count / total, 4)} for function, count in own.most_common(self.top)]
+            record['output'] = path
+            self.steps.append(record)
+            logging.info(f"Profile {name}: wall {record['wall_s']}s, cpu {record['cpu_s']}s"
+                         + (f", peak traced {record['peak_traced_mb']} MB" if 'peak_traced_mb' in record else '')
+                         + (f"; top: {', '.join(entry['function'] for entry in record['top'][:3])}" if record['top'] else ''))
+
+    def _sample(self, ident, stacks, stop):
+        while not stop.wait(self.interval):
+            frame, stack = sys._current_frames().get(ident), []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                stacks[tuple(reversed(stack))] += 1
+
+    def close(self):
+        if not self.steps:
+            return
+        path = os.path.join(self.directory, 'report.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'argv': sys.argv, 'steps': self.steps}, f, indent=2)
+        logging.info(f"Profile report written to {path}")
+
+profiler = StepProfiler()
+
+CATEGORIES = [
+    {"name": "Domain", "code": "domain"},
+    {"name": "Skill", "code": "skill"},
+    {"name": "Sub Skill", "code": "subSkill"},
+    {"name": "Observable Element", "code": "observableElement"}
+]
+# (category, suffix of dry-run term ids, CSV name column, CSV code column)
+TERM_COLUMNS = [
+    ('domain', 'domain', 'Domain_Description', 'Domain_Code'),
+    ('skill', 'skill', 'Competency_Description', 'Competency_Code'),
+    ('subSkill', 'subskill', 'Sub-competency_Description', 'Sub-competency_Code'),
+    ('observableElement', 'observableelement', 'Observable elements', 'Code observable element'),
+]
+# Parent category -> category of the terms it is associated with
+ASSOCIATED_CATEGORY = {'domain': 'skill', 'skill': 'subSkill', 'subSkill': 'observableElement'}
+
 def send_request(method, url, headers, data=None, dry_run=False):
     if dry_run:
-        logging.info(f"Dry run: {method} {url}")
-        logging.info(f"Headers: {headers}")
-        if data:
-            logging.info(f"Data: {json.dumps(data, indent=2, ensure_ascii=False)}")
+        dry_run_plan.add(method, url, data)
         return None
     try:
         if method == 'POST':
             response = requests.post(url, headers=headers, json=data)
         elif method == 'PATCH':
             response = requests.patch(url, headers=headers, json=data)
+        elif method == 'GET':
+            response = requests.get(url, headers=headers)
         logging.info(f"Response status: {response.status_code}")
         if response.status_code != 200:
             logging.error(f"Response text: {response.text}")
@@ -107,12 +282,7 @@ def create_frameworks(dry_run=False):
 
 def create_master_and_categories(dry_run=False):
     # Create categories for each framework
-    categories = [
-        {"name": "Domain", "code": "domain"},
-        {"name": "Skill", "code": "skill"},
-        {"name": "Sub Skill", "code": "subSkill"},
-        {"name": "Observable Element", "code": "observableElement"}
-    ]
+    categories = CATEGORIES
 
     total_categories = len(framework_codes) * len(categories)
     logging.info(f"Starting to create {total_categories} categories across {len(framework_codes)} frameworks")
@@ -230,6 +400,7 @@ def create_terms(dry_run=False):
                     node_id = result.get('node_id', [None])[0]
                     if node_id:
                         term_ids['domain'][framework_code] = node_id
+                        journal.record('term', category='domain', key=framework_code, id=node_id)
                     created_domains.add(domain_code)
                     logging.info(f"Domain term {original_code} created successfully for {framework_code}")
                     domain_count += 1
@@ -270,6 +441,7 @@ def create_terms(dry_run=False):
                     node_id = result.get('node_id', [None])[0]
                     if node_id:
                         term_ids['skill'][skill_key] = node_id
+                        journal.record('term', category='skill', key=skill_key, id=node_id)
                     created_skills[framework_code].add(skill_code)
                     logging.info(f"Skill term {row['Competency_Code']} created successfully for {framework_code}")
                     skill_count += 1
@@ -310,6 +482,7 @@ def create_terms(dry_run=False):
                     node_id = result.get('node_id', [None])[0]
                     if node_id:
                         term_ids['subSkill'][subskill_key] = node_id
+                        journal.record('term', category='subSkill', key=subskill_key, id=node_id)
                     created_subskills[framework_code].add(subskill_code)
                     logging.info(f"Subskill term {row['Sub-competency_Code']} created successfully for {framework_code}")
                     subskill_count += 1
@@ -350,6 +523,7 @@ def create_terms(dry_run=False):
                     node_id = result.get('node_id', [None])[0]
                     if node_id:
                         term_ids['observableElement'][observable_key] = node_id
+                        journal.record('term', category='observableElement', key=observable_key, id=node_id)
                     created_observable_elements[framework_code].add(observable_code)
                     logging.info(f"Observable element term {row['Code observable element']} created successfully for {framework_code}")
                     observable_count += 1
@@ -368,6 +542,130 @@ def create_terms(dry_run=False):
     logging.info("Term IDs saved to term_ids.json")
     logging.info(f"Term creation completed: Domains: {domain_count}, Skills: {skill_count}, Subskills: {subskill_count}, Observable Elements: {observable_count}")
 
+def create_term_chunk(framework_code, category, chunk, dry_run=False):
+    """
+    Create a list of terms of one category in a single term/create request.
+    chunk is a list of (term_ids key, (name, code)). Returns {term_ids key: node_id} for the created terms.
+    """
+    url = f"{host}/api/framework/v1/term/create?framework={framework_code}&category={category}"
+    headers = {
+        'Content-Type': 'application/json',
+        'accept': 'application/json',
+        'X-Channel-Id': channel_id,
+        'Authorization': f'Bearer {apikey}'
+    }
+    data = {
+        "request": {
+            "term": [{"name": name, "code": code} for _, (name, code) in chunk]
+        }
+    }
+    response = send_request('POST', url, headers, data, dry_run)
+    if dry_run:
+        suffix = next(suffix for cat, suffix, _, _ in TERM_COLUMNS if cat == category)
+        if category == 'domain':
+            return {key: f"{framework_code.lower()}_domain" for key, _ in chunk}
+        return {key: f"{framework_code.lower()}_{suffix}_{code.lower()}" for key, (_, code) in chunk}
+    if not (response and response.status_code == 200):
+        logging.error(f"Failed to create {len(chunk)} {category} terms for {framework_code}: {[code for _, (_, code) in chunk]}")
+        return {}
+    node_ids = response.json().get('result', {}).get('node_id') or []
+    if isinstance(node_ids, str):
+        node_ids = [node_ids]
+    if len(node_ids) == len(chunk):
+        matched = dict(zip((key for key, _ in chunk), node_ids))
+    else:
+        # Unexpected count: match the returned identifiers on their trailing term code
+        logging.warning(f"Expected {len(chunk)} node ids for {category} terms of {framework_code}, got {len(node_ids)}")
+        matched = {}
+        for key, (_, code) in chunk:
+            for node_id in node_ids:
+                if node_id.lower().endswith(f"_{code.lower()}"):
+                    matched[key] = node_id
+                    break
+    for key, (_, code) in chunk:
+        if key in matched:
+            journal.record('term', category=category, key=key, id=matched[key])
+        else:
+            logging.error(f"No node id returned for {category} term {code} of {framework_code}")
+    logging.info(f"{len(matched)}/{len(chunk)} {category} terms created successfully for {framework_code}")
+    return matched
+
+def to_framework_code(domain_code):
+    match = re.search(r'(\d+)$', domain_code)
+    if match:
+        return domain_code[:match.start()] + '_' + match.group(1)
+    return domain_code
+
+def load_desired_terms():
+    """
+    Parse fw-c-t.csv into {framework_code: {category: {term_ids key: (name, code)}}} and
+    {framework_code: {parent category: {parent key: set of child keys}}}, keyed like term_ids.json.
+    """
+    terms = {}
+    associations = {}
+    created_domains = set()
+    with open(CSV_FILE, 'r', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for idx, row in enumerate(reader, start=1):
+            row = {k.strip(): v.strip() for k, v in row.items()}
+            original_code = row.get('Domain_Code')
+            if original_code is None:
+                logging.warning(f"Row {idx}: Missing 'Domain_Code' column. Row data: {row}")
+                continue
+            framework_code = to_framework_code(original_code)
+            if framework_code not in framework_codes:
+                logging.debug(f"Row {idx}: Skipping because framework_code {framework_code} not in initialized frameworks {framework_codes}")
+                continue
+            fw_terms = terms.setdefault(framework_code, {category: {} for category, _, _, _ in TERM_COLUMNS})
+            keys = {}
+            for category, _, name_column, code_column in TERM_COLUMNS:
+                if category == 'domain':
+                    # One domain term per domain code, stored under the framework code
+                    keys[category] = framework_code
+                    if original_code.lower() in created_domains:
+                        continue
+                    created_domains.add(original_code.lower())
+                else:
+                    keys[category] = f"{framework_code}_{row[code_column].lower()}"
+                if keys[category] not in fw_terms[category]:
+                    fw_terms[category][keys[category]] = (row[name_column], row[code_column])
+            fw_associations = associations.setdefault(framework_code, {category: {} for category in ASSOCIATED_CATEGORY})
+            for category, child_category in ASSOCIATED_CATEGORY.items():
+                fw_associations[category].setdefault(keys[category], set()).add(keys[child_category])
+    return terms, associations
+
+def create_terms_batched(dry_run=False, batch_size=100):
+    """
+    Same result as create_terms, but the terms of each (framework, category) are sent
+    as lists of up to batch_size terms per term/create request.
+    """
+    global framework_codes
+    if not framework_codes:
+        framework_codes.extend(to_framework_code(code) for code in code_to_area)
+
+    logging.info(f"Starting batched term creation for {len(framework_codes)} frameworks ({batch_size} terms per request)")
+    desired_terms, _ = load_desired_terms()
+    term_ids = {category: {} for category, _, _, _ in TERM_COLUMNS}
+    counts = Counter()
+    requests_sent = 0
+    for framework_code, fw_terms in desired_terms.items():
+        for category, terms in fw_terms.items():
+            items = list(terms.items())
+            for start in range(0, len(items), batch_size):
+                chunk = items[start:start + batch_size]
+                logging.info(f"Creating {len(chunk)} {category} terms for framework {framework_code}")
+                created = create_term_chunk(framework_code, category, chunk, dry_run)
+                requests_sent += 1
+                term_ids[category].update(created)
+                counts[category] += len(created)
+
+    cleaned_term_ids = clean_dict(term_ids)
+    with open('term_ids.json', 'w', encoding='utf-8') as f:
+        json.dump(cleaned_term_ids, f, ensure_ascii=False)
+    logging.info("Term IDs saved to term_ids.json")
+    logging.info(f"Term creation completed in {requests_sent} requests: Domains: {counts['domain']}, Skills: {counts['skill']}, "
+                 f"Subskills: {counts['subSkill']}, Observable Elements: {counts['observableElement']}")
+
 def update_associations(dry_run=False):
     global framework_codes
     if not framework_codes:
@@ -582,6 +880,174 @@ def publish_frameworks(dry_run=False):
             logging.error(f"Failed to publish framework {framework_code}")
     logging.info(f"Framework publishing completed: {success_count}/{len(framework_codes)} successful")
 
+def read_framework(framework_code):
+    """Read a framework with all its categories and terms. Returns (ok, framework); framework is None if it does not exist."""
+    url = f"{host}/api/framework/v1/read/{framework_code}?categories={','.join(cat['code'] for cat in CATEGORIES)}"
+    headers = {
+        'accept': 'application/json',
+        'X-Channel-Id': channel_id,
+        'Authorization': f'Bearer {apikey}'
+    }
+    # Reads are sent in dry-run mode too: the diff needs the current state. Not through send_request,
+    # which logs every non-200 as an error; a 404 only means the framework is still to be created
+    try:
+        response = requests.get(url, headers=headers)
+    except Exception as e:
+        logging.error(f"Reading framework {framework_code} failed: {e}")
+        return False, None
+    if response.status_code == 404:
+        return True, None
+    if response.status_code != 200:
+        logging.error(f"Reading framework {framework_code} failed: {response.status_code} {response.text}")
+        return False, None
+    return True, response.json().get('result', {}).get('framework')
+
+def sync_frameworks(dry_run=False, batch_size=100):
+    """
+    Bring every framework in line with fw-c-t.csv: read its current state, then create only the
+    missing framework, categories and terms, update only the associations that differ and
+    publish only frameworks that changed or are not Live. Everything created is appended to
+    the journal as soon as it succeeds, so a rerun after a crash picks up where it stopped.
+    """
+    global framework_codes
+    if not framework_codes:
+        framework_codes.extend(to_framework_code(code) for code in code_to_area)
+    framework_names = {to_framework_code(code): area for code, area in code_to_area.items()}
+    desired_terms, desired_associations = load_desired_terms()
+    logging.info(f"Starting sync of {len(framework_codes)} frameworks")
+
+    # What earlier runs created, even if the read API does not show it yet
+    term_ids = {category: {} for category, _, _, _ in TERM_COLUMNS}
+    journaled_frameworks = set()
+    journaled_categories = set()
+    journaled_associations = {}
+    for entry in journal.load():
+        if entry.get('kind') == 'framework':
+            journaled_frameworks.add(entry['code'])
+        elif entry.get('kind') == 'category':
+            journaled_categories.add((entry['framework'], entry['code']))
+        elif entry.get('kind') == 'term':
+            term_ids[entry['category']][entry['key']] = entry['id']
+        elif entry.get('kind') == 'associations':
+            journaled_associations[(entry['category'], entry['key'])] = set(entry['ids'])
+
+    headers = {
+        'Content-Type': 'application/json',
+        'accept': 'application/json',
+        'X-Channel-Id': channel_id,
+        'Authorization': f'Bearer {apikey}'
+    }
+    changes = Counter()
+    failed = []
+    for framework_code in framework_codes:
+        ok, framework = read_framework(framework_code)
+        if not ok:
+            logging.error(f"Failed to read framework {framework_code}, skipping it")
+            failed.append(framework_code)
+            continue
+        changed = False
+        if framework is None and framework_code not in journaled_frameworks:
+            name = framework_names[framework_code] + " Framework"
+            logging.info(f"Creating framework: {framework_code} ({name})")
+            data = {
+                "request": {
+                    "framework": {
+                        "name": name,
+                        "description": name,
+                        "type": "SkillMap",
+                        "code": framework_code,
+                        "channels": [{"identifier": channel_id}],
+                        "systemDefault": "Yes"
+                    }
+                }
+            }
+            response = send_request('POST', f"{host}/api/framework/v1/create", headers, data, dry_run)
+            if not dry_run and not (response and response.status_code == 200):
+                logging.error(f"Failed to create framework {framework_code}")
+                failed.append(framework_code)
+                continue
+            if not dry_run:
+                journal.record('framework', code=framework_code)
+            changes['frameworks'] += 1
+            changed = True
+
+        existing_categories = {cat.get('code'): cat for cat in (framework or {}).get('categories') or []}
+        existing_associations = {}
+        for cat in CATEGORIES:
+            category = cat['code']
+            if category in existing_categories:
+                for term in existing_categories[category].get('terms') or []:
+                    key = framework_code if category == 'domain' else f"{framework_code}_{term['code'].lower()}"
+                    term_ids[category][key] = term['identifier']
+                    existing_associations[(category, key)] = {assoc['identifier'] for assoc in term.get('associations') or []}
+            elif (framework_code, category) not in journaled_categories:
+                logging.info(f"Creating category: {cat['name']} ({category}) for framework {framework_code}")
+                url = f"{host}/api/framework/v1/category/create?framework={framework_code}"
+                response = send_request('POST', url, headers, {"request": {"category": cat}}, dry_run)
+                if not dry_run and not (response and response.status_code == 200):
+                    logging.error(f"Failed to create category {cat['name']} for {framework_code}")
+                    continue
+                if not dry_run:
+                    journal.record('category', framework=framework_code, code=category)
+                changes['categories'] += 1
+                changed = True
+
+        for category, terms in desired_terms.get(framework_code, {}).items():
+            missing = [(key, term) for key, term in terms.items() if key not in term_ids[category]]
+            for start in range(0, len(missing), batch_size):
+                chunk = missing[start:start + batch_size]
+                logging.info(f"Creating {len(chunk)} missing {category} terms for framework {framework_code}")
+                created = create_term_chunk(framework_code, category, chunk, dry_run)
+                term_ids[category].update(created)
+                changes['terms'] += len(created)
+                changed = changed or bool(created)
+
+        for category, parents in desired_associations.get(framework_code, {}).items():
+            child_category = ASSOCIATED_CATEGORY[category]
+            for parent_key, child_keys in parents.items():
+                if parent_key not in term_ids[category]:
+                    continue
+                wanted = {term_ids[child_category][key] for key in child_keys if key in term_ids[child_category]}
+                current = existing_associations.get((category, parent_key))
+                if current is None:
+                    current = journaled_associations.get((category, parent_key), set())
+                if not wanted or wanted == current:
+                    continue
+                raw_node_id = term_ids[category][parent_key]
+                node_id = raw_node_id.split('_')[-1] if '_' in raw_node_id else raw_node_id
+                logging.info(f"Updating {category} associations for {framework_code} (node_id: {node_id}): {len(wanted)} terms, {len(current)} before")
+                url = f"{host}/api/framework/v1/term/update/{node_id}?framework={framework_code}&category={category}"
+                data = {"request": {"term": {"associations": [{"identifier": term_id} for term_id in sorted(wanted)]}}}
+                response = send_request('PATCH', url, headers, data, dry_run)
+                if not dry_run and not (response and response.status_code == 200):
+                    logging.error(f"Failed to update {category} associations for {framework_code} (node_id: {node_id})")
+                    continue
+                if not dry_run:
+                    journal.record('associations', category=category, key=parent_key, ids=sorted(wanted))
+                changes['associations'] += 1
+                changed = True
+
+        if changed or (framework or {}).get('status') != 'Live':
+            logging.info(f"Publishing framework {framework_code}")
+            response = send_request('POST', f"{host}/api/framework/v1/publish/{framework_code}", headers, {}, dry_run)
+            if dry_run or (response and response.status_code == 200):
+                changes['publishes'] += 1
+            else:
+                logging.error(f"Failed to publish framework {framework_code}")
+                failed.append(framework_code)
+        else:
+            logging.info(f"Framework {framework_code} is up to date")
+
+    journal.close()
+    with open('term_ids.json', 'w', encoding='utf-8') as f:
+        json.dump(clean_dict(term_ids), f, ensure_ascii=False)
+    logging.info("Term IDs saved to term_ids.json")
+    logging.info(f"Sync completed: Frameworks created: {changes['frameworks']}, Categories created: {changes['categories']}, "
+                 f"Terms created: {changes['terms']}, Associations updated: {changes['associations']}, "
+                 f"Frameworks published: {changes['publishes']}, Failed frameworks: {len(failed)}")
+    if failed:
+        logging.error(f"Frameworks not fully synced (rerun --step sync): {sorted(set(failed))}")
+
 def clean_string(s):
     return s.replace('\u00a0', ' ')
 
@@ -595,27 +1061,64 @@ def clean_dict(d):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Framework Creation Script")
-    parser.add_argument('--step', choices=['setup', 'terms', 'associations', 'publish', 'all'], required=True, help="Step to run: setup=frameworks/categories, terms=term creation, associations=update associations, publish=publish frameworks, all=all steps")
-    parser.add_argument('--dry-run', action='store_true', help="Print requests without sending them")
+    parser.add_argument('--step', choices=['setup', 'terms', 'associations', 'publish', 'all', 'sync'], required=True, help="Step to run: setup=frameworks/categories, terms=term creation, associations=update associations, publish=publish frameworks, all=all steps, sync=read each framework and apply only the missing changes")
+    parser.add_argument('--dry-run', action='store_true', help="Write the requests to a plan file instead of sending them")
+    parser.add_argument('--dry-run-plan', default='dry_run_plan.ndjson', help="Dry run plan file, one JSON request per line (.gz to compress)")
+    parser.add_argument('--dry-run-sample', type=int, default=5, help="Number of planned requests echoed to the log")
+    parser.add_argument('--journal', default='sync_journal.ndjson', help="File the created frameworks, categories, term IDs and associations are journaled to as they are created (read back by --step sync)")
+    parser.add_argument('--term-batch-size', type=int, default=config.get('term_batch_size', 1), help="Terms per term/create request; above 1 the terms of each framework and category are sent in lists of this size (default: config.json 'term_batch_size', else 1)")
+    parser.add_argument('--profile', nargs='?', const='full', choices=['full', 'sample'], help="Profile each step: full (cProfile + tracemalloc, slow) or sample (stack sampling, cheap); a bare --profile means full")
+    parser.add_argument('--profile-dir', default='profiles', help="Directory for the per-step profiles and report.json")
     args = parser.parse_args()
+    dry_run_plan = DryRunPlan(args.dry_run_plan, args.dry_run_sample)
+    journal = SyncJournal(args.journal)
+    profiler = StepProfiler(args.profile, args.profile_dir)
+
+    def run_create_terms():
+        with profiler.step('terms'):
+            if args.term_batch_size > 1:
+                create_terms_batched(args.dry_run, args.term_batch_size)
+            else:
+                create_terms(args.dry_run)
+
+    def run_setup():
+        with profiler.step('setup'):
+            create_frameworks(args.dry_run)
+            create_master_and_categories(args.dry_run)
+
+    def run_associations():
+        with profiler.step('associations'):
+            update_associations(args.dry_run)
+
+    def run_publish():
+        with profiler.step('publish'):
+            publish_frameworks(args.dry_run)
     
-    if args.step == 'setup':
-        logging.info("Running setup: Create frameworks and categories")
-        create_frameworks(args.dry_run)
-        create_master_and_categories(args.dry_run)
-    elif args.step == 'terms':
-        logging.info("Running terms: Create terms")
-        create_terms(args.dry_run)
-    elif args.step == 'associations':
-        logging.info("Running associations: Update associations")
-        update_associations(args.dry_run)
-    elif args.step == 'publish':
-        logging.info("Running publish: Publish frameworks")
-        publish_frameworks(args.dry_run)
-    elif args.step == 'all':
-        logging.info("Running all steps")
-        create_frameworks(args.dry_run)
-        create_master_and_categories(args.dry_run)
-        create_terms(args.dry_run)
-        update_associations(args.dry_run)
-        publish_frameworks(args.dry_run)
+    # A step that raises still finishes the plan file (a .gz needs its trailer), the journal and the profile
+    try:
+        if args.step == 'setup':
+            logging.info("Running setup: Create frameworks and categories")
+            run_setup()
+        elif args.step == 'terms':
+            logging.info("Running terms: Create terms")
+            run_create_terms()
+        elif args.step == 'associations':
+            logging.info("Running associations: Update associations")
+            run_associations()
+        elif args.step == 'publish':
+            logging.info("Running publish: Publish frameworks")
+            run_publish()
+        elif args.step == 'all':
+            logging.info("Running all steps")
+            run_setup()
+            run_create_terms()
+            run_associations()
+            run_publish()
+        elif args.step == 'sync':
+            logging.info("Running sync: Create, associate and publish only what is missing")
+            with profiler.step('sync'):
+                sync_frameworks(args.dry_run, max(1, args.term_batch_size))
+    finally:
+        dry_run_plan.close()
+        journal.close()
+        profiler.close()